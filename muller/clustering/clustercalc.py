@@ -1,27 +1,60 @@
 """ Implements a class which can compute statistical values over a set of clusters. Implemented as its own class to make is usable elsewhere."""
-import itertools
-import statistics
-from typing import Dict, List, Tuple, Union
+from typing import Dict, Iterator, List, Optional, Tuple, Union
 
+import numpy
 from loguru import logger
 
-from muller.clustering.metrics import DistanceCache
+from muller.clustering.metrics import DistanceCache, distance_engine
 
 ClusterType = List[str]
 
+# Reduces a block of distances to a single between-cluster distance.
+BETWEEN_CLUSTER_METHODS = {
+	'min':  numpy.min,
+	'max':  numpy.max,
+	'mean': numpy.mean
+}
+
 
 class ClusterSet:
-	""" Provides descriptive statistics for a set of clusters."""
-	def __init__(self, clusters: List[ClusterType], distances: Union[DistanceCache, Dict[Tuple[str, str], float]]):
+	"""
+		Provides descriptive statistics for a set of clusters.
+		The members of every cluster are located within `distances` and arranged cluster-by-cluster, so every statistic
+		is an array reduction over blocks of rows of the square distance matrix rather than a lookup of each pair.
+		Only one block is held in memory at a time.
+	Parameters
+	----------
+	clusters: List[ClusterType]
+		Each cluster is a non-empty list of labels in `distances`.
+	distances: Union[DistanceCache, Dict[Tuple[str, str], float]]
+	block_size: int
+		The maximum number of distances to hold in a single block.
+	"""
+	def __init__(self, clusters: List[ClusterType], distances: Union[DistanceCache, Dict[Tuple[str, str], float]],
+			block_size: int = distance_engine.CHUNK_SIZE):
 		if not isinstance(distances, DistanceCache):
 			self.distances = DistanceCache(distances)
 		else:
 			self.distances = distances
 
-		self.number_of_points = len(self.distances.squareform().index)
+		self.number_of_points = len(self.distances.labels)
+		self.block_size = block_size
 
 		self.clusters = clusters
 		self._genotypes = None  # Cache for the `self.genotypes` property.
+		# Calculated by `self._calculate_statistics()` when first needed.
+		self._cluster_distances: Optional[Dict[str, numpy.ndarray]] = None
+		self._within_variations: Optional[numpy.ndarray] = None
+		self._member_sums: Optional[numpy.ndarray] = None
+		self._member_maxima: Optional[numpy.ndarray] = None
+
+		self.sizes = numpy.array([len(cluster) for cluster in clusters], dtype = numpy.int64)
+		# The index of the first member of each cluster in `self.positions`.
+		self.starts = numpy.concatenate([[0], numpy.cumsum(self.sizes)[:-1]]).astype(numpy.int64)
+		# The position of each member within `self.distances.labels`, grouped by cluster.
+		self.positions = numpy.array([self.distances.index[label] for cluster in clusters for label in cluster], dtype = numpy.int64)
+		# The index of the cluster each member belongs to.
+		self.membership = numpy.repeat(numpy.arange(len(clusters)), self.sizes)
 
 	def __len__(self) -> int:
 		return len(self.clusters)
@@ -29,6 +62,73 @@ class ClusterSet:
 	def __getitem__(self, item):
 		return self.genotypes[item]
 
+	def _iterate_blocks(self) -> Iterator[Tuple[int, int, numpy.ndarray]]:
+		""" Yields the [`start`, `stop`) range of members in each block and the distances from those members to every member."""
+		total = len(self.positions)
+		rows = max(1, self.block_size // max(total, 1))
+		for start, stop in distance_engine.iterate_chunks(total, rows):
+			yield start, stop, self.distances.get_block(self.positions[start:stop], self.positions)
+
+	def _calculate_statistics(self):
+		"""
+			Scans the distance matrix once to calculate the distances between every pair of clusters, the sums used for
+			the within-cluster variation and, if they fit within `self.block_size`, the sum and maximum of the distances
+			from each member to every cluster.
+		"""
+		total = len(self)
+		members = len(self.positions)
+		minimum = numpy.full((total, total), numpy.inf)
+		maximum = numpy.full((total, total), -numpy.inf)
+		sums = numpy.zeros((total, total))
+		# The sum of the distances and squared distances from each member to the rest of its cluster.
+		within_sums = numpy.zeros(members)
+		within_squares = numpy.zeros(members)
+		if members * total <= self.block_size:
+			self._member_sums = numpy.zeros((members, total))
+			self._member_maxima = numpy.zeros((members, total))
+
+		for start, stop, block in self._iterate_blocks():
+			rows = numpy.arange(stop - start)
+			membership = self.membership[start:stop]
+			# Members are grouped by cluster, so the rows of each cluster are contiguous within the block.
+			boundaries = numpy.flatnonzero(numpy.diff(membership, prepend = -1))
+			clusters = membership[boundaries]
+
+			member_minima = numpy.minimum.reduceat(block, self.starts, axis = 1)
+			member_maxima = numpy.maximum.reduceat(block, self.starts, axis = 1)
+			member_sums = numpy.add.reduceat(block, self.starts, axis = 1)
+			for ufunc, array, reduced in [(numpy.minimum, minimum, member_minima), (numpy.maximum, maximum, member_maxima), (numpy.add, sums, member_sums)]:
+				array[clusters] = ufunc(array[clusters], ufunc.reduceat(reduced, boundaries, axis = 0))
+
+			within_sums[start:stop] = member_sums[rows, membership]
+			within_squares[start:stop] = numpy.add.reduceat(block ** 2, self.starts, axis = 1)[rows, membership]
+			if self._member_sums is not None:
+				self._member_sums[start:stop] = member_sums
+				self._member_maxima[start:stop] = member_maxima
+
+		self._cluster_distances = {
+			'min':  minimum,
+			'max':  maximum,
+			'mean': sums / numpy.outer(self.sizes, self.sizes)
+		}
+		# Each pair was included once for each member.
+		pair_sums = numpy.bincount(self.membership, weights = within_sums, minlength = total) / 2
+		pair_squares = numpy.bincount(self.membership, weights = within_squares, minlength = total) / 2
+		pairs = self.sizes * (self.sizes - 1) / 2
+		deviations = pair_squares - numpy.divide(pair_sums ** 2, pairs, out = numpy.zeros(total), where = pairs > 0)
+		# Clusters with a single member have no variation.
+		self._within_variations = numpy.maximum(deviations, 0) / self.sizes
+
+	def get_cluster_distances(self) -> Dict[str, numpy.ndarray]:
+		"""
+			Returns the minimum, maximum and mean distance between the members of every pair of clusters as a
+			(clusters, clusters) array for each method in `BETWEEN_CLUSTER_METHODS`. The diagonal includes the distance
+			between each member and itself.
+		"""
+		if self._cluster_distances is None:
+			self._calculate_statistics()
+		return self._cluster_distances
+
 	def calculate_index(self) -> float:
 		""" Calculates the CH index for the clusters."""
 
@@ -38,37 +138,27 @@ class ClusterSet:
 		result = (B / len(self) - 1) / (W / (self.number_of_points - len(self)))
 		return result
 
-	def calculate_between_cluster_variation(self):
-		clusters = self.get_genotypes(self.clusters)
-		combinations = itertools.combinations(clusters.keys(), 2)
-		cluster_distances = list()
-		for left_genotype, right_genotype in combinations:
-			# Need to calculate the distance between these two clusters
-			left_cluster = clusters[left_genotype]
-			right_cluster = clusters[right_genotype]
-
-			distance = self.calculate_distance_between_clusters(left_cluster, right_cluster, 'min')
-			#logger.debug(f"{left_genotype}, {right_genotype}, ({len(left_cluster), len(right_cluster)}), {distance}")
-			cluster_distances.append(distance)
+	def calculate_between_cluster_variation(self) -> float:
+		if len(self) < 2:
+			message = "The between-cluster variation requires at least two clusters."
+			raise ValueError(message)
+		minimum = self.get_cluster_distances()['min']
+		cluster_distances = minimum[numpy.triu_indices(len(self), k = 1)]
 
-		mean_cluster_distance = statistics.mean(cluster_distances)
-		variances = [(i - mean_cluster_distance) ** 2 for i in cluster_distances]
-		return sum(variances) / len(clusters)
+		mean_cluster_distance = cluster_distances.mean()
+		variances = (cluster_distances - mean_cluster_distance) ** 2
+		return float(variances.sum() / len(self))
 
 	def calculate_distance_between_clusters(self, left_cluster: ClusterType, right_cluster: ClusterType, method = 'min') -> float:
 		# Need to pair the left trajectories with the right trajectories, but not left to left.
-
-		between_cluster_distances = [self.distances[left, right] for right in right_cluster for left in left_cluster]
-
-		if method == 'min':
-			return min(between_cluster_distances)
-		elif method == 'max':
-			return max(between_cluster_distances)
-		elif method == 'mean':
-			return statistics.mean(between_cluster_distances)
-		else:
+		try:
+			reduce = BETWEEN_CLUSTER_METHODS[method]
+		except KeyError:
 			message = f"Invalid method for calculating the between-cluster distance: '{method}'"
 			raise ValueError(message)
+		left = [self.distances.index[i] for i in left_cluster]
+		right = [self.distances.index[i] for i in right_cluster]
+		return float(reduce(self.distances.get_block(left, right)))
 
 	def calculate_silhouette_coefficient(self, label: str, cluster_label: str, other_label: str):
 		""" Calculates the Silhouette Coefficient for a single point.
@@ -83,22 +173,49 @@ class ClusterSet:
 		"""
 		pass
 
-	def calculate_silhouette_coefficients(self) -> Dict[str, float]:
-		coefficients = dict()
-		for cluster_name, cluster in self.genotypes.items():
-			if len(cluster) == 1: continue
-			closest_cluster = self.get_closest_cluster(cluster_name)
-			closest_cluster_members = self[closest_cluster]
-			for member in cluster:
-				distances_between_other_members = [self.distances[member, other] for other in cluster]
-				distances_between_closest_cluster = [self.distances[member, other] for other in closest_cluster_members]
-				# -1 sincec `member` is included as 0
-				average_distance = sum(distances_between_other_members) / (len(distances_between_other_members) - 1)
-				average_distance_closest = sum(distances_between_closest_cluster) / len(distances_between_closest_cluster)
-				c = (average_distance_closest - average_distance) / (max(distances_between_closest_cluster + distances_between_other_members))
-				coefficients[member] = c
+	def calculate_silhouette_array(self) -> numpy.ndarray:
+		"""
+			Calculates the silhouette coefficient of every member, in the same order as `self.positions`.
+			Members of clusters with a single member are NaN.
+		"""
+		if len(self) < 2 and (self.sizes > 1).any():
+			message = "The silhouette coefficient requires at least two clusters."
+			raise ValueError(message)
+		closest = self.get_closest_clusters()
+		other = closest[self.membership]
+		rows = numpy.arange(len(self.positions))
+		if self._member_sums is not None:
+			distances_own = self._member_sums[rows, self.membership]
+			distances_closest = self._member_sums[rows, other]
+			maximum = numpy.maximum(self._member_maxima[rows, self.membership], self._member_maxima[rows, other])
+		else:
+			# Too many clusters to keep the distance from every member to every cluster.
+			distances_own = numpy.zeros(len(self.positions))
+			distances_closest = numpy.zeros(len(self.positions))
+			maximum = numpy.zeros(len(self.positions))
+			for start, stop, block in self._iterate_blocks():
+				sums = numpy.add.reduceat(block, self.starts, axis = 1)
+				maxima = numpy.maximum.reduceat(block, self.starts, axis = 1)
+				selection = numpy.arange(stop - start)
+				distances_own[start:stop] = sums[selection, self.membership[start:stop]]
+				distances_closest[start:stop] = sums[selection, other[start:stop]]
+				maximum[start:stop] = numpy.maximum(maxima[selection, self.membership[start:stop]], maxima[selection, other[start:stop]])
+
+		with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+			# -1 since each member is included in its own cluster as 0
+			average_distance = distances_own / (self.sizes[self.membership] - 1)
+			average_distance_closest = distances_closest / self.sizes[other]
+			coefficients = (average_distance_closest - average_distance) / maximum
+		coefficients[self.sizes[self.membership] == 1] = numpy.nan
 		return coefficients
 
+	def calculate_silhouette_coefficients(self) -> Dict[str, float]:
+		""" Calculates the silhouette coefficient of every member of a cluster with more than one member."""
+		coefficients = self.calculate_silhouette_array()
+		labels = [label for cluster in self.clusters for label in cluster]
+		is_valid = self.sizes[self.membership] > 1
+		return {label: value for label, value, valid in zip(labels, coefficients.tolist(), is_valid) if valid}
+
 	@property
 	def genotypes(self) -> Dict[str, ClusterType]:
 		if self._genotypes is None:
@@ -108,22 +225,24 @@ class ClusterSet:
 	@staticmethod
 	def calculate_within_cluster_variation(cluster: ClusterType, pair_array: DistanceCache) -> float:
 		""" Row labels and column names are samples."""
-
 		if len(cluster) > 1:
-			cluster_distances = [pair_array[i, j] for i, j in itertools.combinations(cluster, 2)]
+			positions = [pair_array.index[i] for i in cluster]
+			block = pair_array.get_block(positions, positions)
+			cluster_distances = block[numpy.triu_indices(len(cluster), k = 1)]
 		else:
-			cluster_distances = [0]
-		cluster_mean = statistics.mean(cluster_distances)
+			cluster_distances = numpy.zeros(1)
+		cluster_mean = cluster_distances.mean()
 
-		variances = [(i - cluster_mean) ** 2 for i in cluster_distances]
-		W = sum(variances) / len(cluster)
-		return W
+		variances = (cluster_distances - cluster_mean) ** 2
+		W = variances.sum() / len(cluster)
+		return float(W)
 
 	def calculate_within_cluster_variations(self) -> float:
 		""" Calulates the total within-cluster variation for all clusters in `clusters`.
 		"""
-		cluster_variations = [self.calculate_within_cluster_variation(cluster, self.distances) for cluster in self.clusters]
-		return sum(cluster_variations)
+		if self._within_variations is None:
+			self._calculate_statistics()
+		return float(self._within_variations.sum())
 
 	def get_genotypes(self, clusters: List[ClusterType] = None) -> Dict[str, ClusterType]:
 		""" Generates labels for each cluster."""
@@ -135,18 +254,29 @@ class ClusterSet:
 				_names = {i.split('-')[1] for i in cluster}
 			except IndexError:
 				_names = set()
-			if len(_names) == 1:
+			if len(_names) == 1 and "genotype-" + list(_names)[0] not in clusterdict:
 				genotype_name = "genotype-" + list(_names)[0]
 			else:
+				# Also used when several clusters share a common name, so no cluster is overwritten.
 				genotype_name = f"genotype-{index}"
+				# The name may already have been derived from the members of an earlier cluster.
+				copy = 1
+				while genotype_name in clusterdict:
+					copy += 1
+					genotype_name = f"genotype-{index}.{copy}"
 			clusterdict[genotype_name] = cluster
 		return clusterdict
 
+	def get_closest_clusters(self) -> numpy.ndarray:
+		""" Returns the index of the closest other cluster to each cluster, based on the minimum between-cluster distance."""
+		minimum = self.get_cluster_distances()['min'].copy()
+		numpy.fill_diagonal(minimum, numpy.inf)
+		return numpy.argmin(minimum, axis = 1)
+
 	def get_closest_cluster(self, label: str) -> str:
 		""" Return the label of the closest cluster to `label`"""
-		dist = dict()
-		for name, cluster in self.genotypes.items():
-			if name == label: continue
-			d = self.calculate_distance_between_clusters(self[label], self[name])
-			dist[name] = d
-		return min(dist.items(), key = lambda s: s[1])[0] 
+		names = list(self.genotypes.keys())
+		if len(names) < 2:
+			message = f"There are no other clusters to compare '{label}' to."
+			raise ValueError(message)
+		return names[self.get_closest_clusters()[names.index(label)]]
@@ -1,17 +1,20 @@
+import math
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 import re
+import numpy
 import pandas
 from loguru import logger
+from scipy import sparse
 
 try:
-	from muller.clustering import metrics, genotype_reorder, hierarchy
+	from muller.clustering import metrics, genotype_reorder, hierarchy, nn_chain, sparse_graph
 	from .. import filters
 	from muller.dataio import projectdata
 
 except ModuleNotFoundError:
 	from ..filters import filters
-	from . import metrics, hierarchy
+	from . import metrics, hierarchy, nn_chain, sparse_graph
 def is_trajectory_labeled_by_genotype(label):
 	regex = "trajectory-[a-z]+-[0-9]+"
 	match = re.search(regex, label)
@@ -37,6 +40,26 @@ def generate_genotype_name(index: int, members: List[str]):
 	genotype_label = f"genotype-{genotype_name}"
 	return genotype_label
 
+def group_identical_trajectories(trajectories: pandas.DataFrame) -> Tuple[pandas.DataFrame, Dict[str, List[str]]]:
+	"""
+		Groups the trajectories with identical frequencies at every timepoint, such as linked mutations called on the same reads.
+	Returns
+	-------
+	pandas.DataFrame
+		The first trajectory of each group (by label), in the same order as `trajectories`.
+	Dict[str, List[str]]
+		Maps the label of each representative trajectory to every trajectory in its group, including itself.
+	"""
+	# Adding 0 converts -0.0 to 0.0 so both have the same bytes.
+	values = numpy.ascontiguousarray(trajectories.values, dtype = float) + 0.0
+	groups: Dict[bytes, List[str]] = dict()
+	for label, row in sorted(zip(trajectories.index, values), key = lambda i: i[0]):
+		groups.setdefault(row.tobytes(), list()).append(label)
+	duplicates = {members[0]: members for members in groups.values()}
+	representatives = trajectories.loc[[i for i in trajectories.index if i in duplicates]]
+	return representatives, duplicates
+
+
 class ClusterMutations:
 	"""
 	Parameters
@@ -48,18 +71,59 @@ class ClusterMutations:
 	starting_genotypes: List[List[str]]
 		A list of genotypes to start the clustering algorithm with. The distance metrics will be modified so that the trajectories specified are
 		grouped together.
+	threads: Optional[int]
+		The number of processes to use when calculating the pairwise distances.
+	filename_distances: Optional[Path]
+		If given, the pairwise distances are written to a memory-mapped file at this location rather than being held in memory.
+	filename_pairwise: Optional[Path]
+		Reuses the pairwise distances saved by a previous run (usually tables/.distance.npz, or the output folder of the run)
+		rather than calculating them again. Trajectories which were removed since then are dropped and only the distances
+		to the trajectories which were added are calculated.
+	distance_cache: Optional[metrics.PersistentDistanceCache]
+		A cache of pairwise distances shared between runs. Only the pairs missing from the cache are calculated.
+	area_backend: str
+		How the areas are calculated for the 'jaccard' metric. Either 'numeric' or 'shapely'.
+	linkage_backend: str
+		How the linkage table is generated. Either 'scipy' or 'nn-chain'. See `hierarchy.LINKAGE_BACKENDS`.
+	sparse_graph_bound: Optional[float]
+		If given, only the pairs of trajectories within this distance are kept and the trajectories are clustered with
+		`sparse_graph.SparseGraphCluster` instead. The full distance matrix is never generated.
+	sparse_method: str
+		One of `sparse_graph.SPARSE_METHODS`. Only used with `sparse_graph_bound`.
+	prune_bound: Optional[float]
+		Skips the pairs of trajectories which are guaranteed to be farther apart than this distance. They are assigned the
+		maximum distance. Defaults to `sparse_graph_bound`, since those pairs are not kept in the sparse graph anyway.
+	verify_pruning: bool
+		Also calculates the pruned pairs to check that none of them are within `prune_bound`.
+	filename_statistics: Optional[Path]
+		Saves the per-pair binomial sums to this file. If it already exists and was generated from the same trajectories,
+		only the timepoints added since then are calculated. See `metrics.PairStatistics`.
+	deduplicate: bool
+		Only calculates the distances between trajectories with different frequencies. Each group of identical trajectories
+		is clustered as a single weighted observation and is always assigned to the same genotype.
 	"""
 
 	def __init__(self, metric: str, dlimit: float, flimit: float,
-			starting_genotypes: Optional[List[List[str]]] = None, threads: Optional[int] = None):
+			starting_genotypes: Optional[List[List[str]]] = None, threads: Optional[int] = None,
+			filename_distances: Optional[Path] = None, filename_pairwise: Optional[Path] = None,
+			distance_cache: Optional[metrics.PersistentDistanceCache] = None, area_backend: str = 'numeric',
+			linkage_backend: str = 'scipy', sparse_graph_bound: Optional[float] = None, sparse_method: str = 'components',
+			prune_bound: Optional[float] = None, verify_pruning: bool = False, deduplicate: bool = False,
+			filename_statistics: Optional[Path] = None):
 		self.metric: str = metric
 		self.dlimit: float = dlimit
 		self.flimit: float = flimit
 		self.known_genotypes: List[List[str]] = starting_genotypes if starting_genotypes else []
-		self.filename_pairwise = None
+		self.filename_pairwise = filename_pairwise
+		self.filename_distances = filename_distances
+		self.distance_cache = distance_cache
 		self.pairwise_distances_full = None # overwritten in self.get_pairwise_distances.
+		self.deduplicate = deduplicate
+		self.filename_statistics = filename_statistics
+		if filename_statistics and metric not in metrics.INCREMENTAL_METRICS:
+			logger.warning(f"The pair statistics are not used with the '{metric}' metric.")
+			self.filename_statistics = None
 
-		#self.filename_pairwise = filename_pairwise # Could be used to reuse a table of pairwise distances.
 		# The `breakpoints` value is a bit arbitrary, so it should be safe to hard-code it.
 		# 	This will actually prevent the most common error when sorting genotypes (i.e. no breakpoints given) so it's worth
 		#	hard-coding it to prevent that issue.
@@ -71,57 +135,133 @@ class ClusterMutations:
 			metric = self.metric,
 			threads = threads
 		)
+		if prune_bound is None:
+			prune_bound = sparse_graph_bound
+		self.distance_engine = metrics.DistanceEngine(
+			detection_limit = self.dlimit,
+			fixed_limit = self.flimit,
+			metric = self.metric,
+			threads = threads,
+			area_backend = area_backend,
+			prune_bound = prune_bound,
+			verify_pruning = verify_pruning
+		)
 
-		self.clusterer = hierarchy.HierarchalCluster()
+		self.clusterer = hierarchy.HierarchalCluster(linkage_backend = linkage_backend)
+		self.sparse_graph_bound = sparse_graph_bound
+		self.sparse_clusterer = sparse_graph.SparseGraphCluster(sparse_method)
 
 		self.organizer = genotype_reorder.SortGenotypeTableWorkflow(
 			dlimit = dlimit,
 			flimit = flimit
 		)
 
-	@staticmethod
-	def _calculate_mean_frequencies_of_trajectories(name: str, genotype_timeseries: pandas.DataFrame, genotype: List[str]) -> pandas.Series:
+	@property
+	def distance_parameters(self) -> Dict[str, Any]:
 		"""
-			Generates a mean timeseries for a genotype given the timeseries of member trajectories.
-		Parameters
-		----------
-		name: str
-			The name to assign to this genotype. Usually just 'genotype-' forllowed by an integer.
-		genotype_timeseries: pandas.DataFrame
-			A dataframe of member trajectory timeseries.
-		genotype: List[str]
-			A list of the labels of all member trajectories. Used to track the which trajectories belong to this genotype.
-
-		Returns
-		-------
-		pandas.DataFrame
-			The calculated mean of all member trajectories at each timepoint.
+			The parameters which affect the pairwise distances. Saved alongside the distances so they can be safely reused.
+			Pruned pairs are assigned the maximum distance, so `prune_bound` is included when pairs are pruned.
 		"""
-		mean_genotype_timeseries = genotype_timeseries.mean()
-		mean_genotype_timeseries.index = [int(i) for i in mean_genotype_timeseries.index]
-		mean_genotype_timeseries['members'] = "|".join(map(str, genotype))
-		mean_genotype_timeseries.name = name
-
-		return mean_genotype_timeseries
-
-	@staticmethod
-	def _load_pairwise_distances(filename: Path) -> Dict[Tuple[str, str], float]:
-		""" Reads pre-computed pairwise distances from a previous run. Typically found in the /tables/.distance.tsv table."""
-		table_distance_pairwise = pandas.read_csv(filename, sep = "\t")
+		prune_bound = self.distance_engine.prune_bound if self.distance_engine.is_pruning else None
+		return {'metric': self.metric, 'dlimit': self.dlimit, 'flimit': self.flimit, 'prune_bound': prune_bound}
 
-		pair_array = dict()
-		for index, row in table_distance_pairwise.iterrows():
-			values = {(index, i): row[i] for i in table_distance_pairwise.columns}
-			values_inverse = {k[::-1]: v for k, v in
-				values.items()}  # Faster to include reversed keys rather than trying to get (l,r) and (r,l) keys.
+	def _load_pairwise_distances(self, filename: Path) -> metrics.DistanceCache:
+		"""
+			Reads pre-computed pairwise distances from a previous run. Typically found in the /tables/.distance.npz file.
+			The /tables/.distance.tsv table can also be used, but the parameters used to generate it cannot be checked.
+			If `filename` is the output folder of a previous run, the .distance.npz file in its `tables` folder is used.
+		"""
+		filename = Path(filename)
+		if filename.is_dir():
+			candidates = sorted(filename.glob("tables/*.distance.npz"))
+			if len(candidates) != 1:
+				message = f"Expected a single 'tables/*.distance.npz' file in '{filename}', found {len(candidates)}."
+				raise ValueError(message)
+			filename = candidates[0]
+		if filename.suffix == '.npz':
+			return metrics.DistanceCache.read_binary(filename, self.distance_parameters)
+
+		logger.warning(f"Cannot verify the parameters used to calculate the distances in '{filename}'.")
+		table_distance_pairwise = pandas.read_csv(filename, sep = "\t", index_col = 0)
+		table_distance_pairwise.index = table_distance_pairwise.columns
+		cache = metrics.DistanceCache.from_squareform(table_distance_pairwise)
+		# Assume the current parameters so the distances can be reused once they are saved as a .distance.npz file.
+		cache.parameters = self.distance_parameters
+		return cache
+
+	def _update_pairwise_distances(self, cache: metrics.DistanceCache, trajectories: pandas.DataFrame) -> metrics.DistanceCache:
+		"""
+			Updates the distances loaded from a previous run to match `trajectories`. Trajectories which are no longer present
+			are removed and only the pairs with a new trajectory are calculated. Every pair which could not be compared,
+			including the pairs from the previous run, is assigned the maximum distance of the updated pairs so the distances
+			are the same as a new calculation.
+		"""
+		previous = len(cache.labels)
+		cache.reduce(trajectories.index)
+		removed = previous - len(cache.labels)
+		reused = len(cache.labels) * (len(cache.labels) - 1) // 2
+
+		rows = cache.add_labels(trajectories.index)
+		calculated = 0
+		if len(rows):
+			self.distance_engine.load(trajectories.loc[cache.labels])
+			for left, right, values in self.distance_engine.iterate_rows(rows):
+				values[values == metrics.distance_engine.PRUNED_DISTANCE] = math.nan
+				cache.set_pairs(left, right, values)
+				calculated += len(values)
+		cache.replace_missing()
+		logger.info(
+			f"Reused {reused} of {reused + calculated} pairwise distances. Removed {removed} and added {len(rows)} trajectories "
+			f"since the previous run."
+		)
+		return cache
 
-			pair_array.update(values)
-			pair_array.update(values_inverse)
 
-		return pair_array
 
 
+	@staticmethod
+	def get_member_positions(all_genotypes: List[List[str]], labels: pandas.Index) -> List[numpy.ndarray]:
+		""" Converts the members of each genotype into the positions of the member trajectories in `labels`."""
+		index = {label: position for position, label in enumerate(labels)}
+		member_positions = list()
+		for genotype in all_genotypes:
+			try:
+				member_positions.append(numpy.array([index[i] for i in genotype], dtype = numpy.int64))
+			except KeyError as exception:
+				logger.critical(f"Missing Trajectory Labels: {genotype} - {labels}")
+				raise exception
+		return member_positions
 
+	@staticmethod
+	def calculate_mean_frequencies(member_positions: List[numpy.ndarray], values: numpy.ndarray) -> numpy.ndarray:
+		"""
+			Calculates the mean of the member trajectories of every genotype at once by multiplying a sparse
+			genotype x trajectory membership matrix with the trajectory array. Missing values are ignored, the same as
+			`pandas.DataFrame.mean`.
+		Parameters
+		----------
+		member_positions: List[numpy.ndarray]
+			The row of each member trajectory in `values`, for each genotype.
+		values: numpy.ndarray
+			2-D array of the trajectory frequencies.
+		"""
+		rows = numpy.repeat(numpy.arange(len(member_positions)), [len(i) for i in member_positions])
+		columns = numpy.concatenate(member_positions) if member_positions else numpy.empty(0, dtype = numpy.int64)
+		membership = sparse.csr_matrix((numpy.ones(len(columns)), (rows, columns)), shape = (len(member_positions), len(values)))
+
+		detected = ~numpy.isnan(values)
+		totals = membership @ numpy.where(detected, values, 0)
+		counts = membership @ detected.astype(float)
+		with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+			return totals / counts
+
+	def _calculate_genotype_means(self, all_genotypes: List[List[str]], timeseries: pandas.DataFrame) -> Tuple[pandas.DataFrame, List[numpy.ndarray]]:
+		""" Returns the table of mean genotype frequencies and the positions of the members of each genotype in `timeseries`."""
+		member_positions = self.get_member_positions(all_genotypes, timeseries.index)
+		means = self.calculate_mean_frequencies(member_positions, timeseries.values.astype(float))
+		names = pandas.Index([f"genotype-{index}" for index in range(1, len(all_genotypes) + 1)], name = 'Genotype')
+		columns = pandas.Index([int(i) for i in timeseries.columns], dtype = object)
+		return pandas.DataFrame(means, index = names, columns = columns), member_positions
 
 	def calculate_mean_genotype(self, all_genotypes: List[List[str]], timeseries: pandas.DataFrame) -> pandas.DataFrame:
 		"""
@@ -140,49 +280,60 @@ class ClusterMutations:
 		member trajectories are listed under the 'members' column.
 		every column represents a timepoint.
 		"""
-		mean_genotypes = list()
-		for index, genotype in enumerate(all_genotypes, start = 1):
-			try:
-				genotype_timeseries = timeseries.loc[genotype]
-			except Exception as exception:
-				logger.critical(f"Missing Trajectory Labels: {genotype} - {timeseries.index}")
-				raise exception
-			#genotype_name = generate_genotype_name(index, genotype_timeseries.index)
-			genotype_name = f"genotype-{index}"
-			mean_genotype_timeseries = self._calculate_mean_frequencies_of_trajectories(genotype_name, genotype_timeseries, genotype)
-			mean_genotypes.append(mean_genotype_timeseries)
-
-		mean_genotypes = pandas.DataFrame(mean_genotypes)
-		# For consistency
-		mean_genotypes.index.name = 'Genotype'
-
+		mean_genotypes, member_positions = self._calculate_genotype_means(all_genotypes, timeseries)
 		# Place the `members` column in the leftmost column
-		mean_genotypes = mean_genotypes[['members'] + [i for i in mean_genotypes if i != 'members']]
-
+		mean_genotypes.insert(0, 'members', ["|".join(map(str, genotype)) for genotype in all_genotypes])
 		return mean_genotypes
 
 	def generate_genotype_table(self, timepoints: pandas.DataFrame, genotypes: List[List[str]]) -> Tuple[pandas.DataFrame, Dict[str,List[str]]]:
-
-		mean_genotypes = self.calculate_mean_genotype(genotypes, timepoints)
-
-		# Try to keep the genotype members separate so that `mean_genotypes` is consistent.
 		# The table should only have the timeseries frequency values and be indexed by genotype label.
-		genotype_members = mean_genotypes.pop('members')
-		# Convert the `genotype_members` pandas.Series object to a dictionary mapping genotypes to member trajectories.
-		genotype_members = {k: v.split('|') for k, v in genotype_members.items()}
+		mean_genotypes, member_positions = self._calculate_genotype_means(genotypes, timepoints)
+		labels = numpy.array([str(i) for i in timepoints.index], dtype = object)
+		genotype_members = {name: labels[positions].tolist() for name, positions in zip(mean_genotypes.index, member_positions)}
 
 		return mean_genotypes, genotype_members
 
 	def get_pairwise_distances(self, trajectories: pandas.DataFrame):
 		if self.filename_pairwise:
-			pair_array = self._load_pairwise_distances(self.filename_pairwise)
+			logger.info(f"Loading the pairwise distances from '{self.filename_pairwise}'")
+			if self.filename_distances:
+				logger.warning("The memory-mapped distances are not used when loading the pairwise distances from a previous run.")
+			self.pairwise_distances_full = self._update_pairwise_distances(
+				self._load_pairwise_distances(self.filename_pairwise), trajectories
+			)
+		elif self.filename_statistics:
+			trajectories = trajectories.loc[sorted(trajectories.index)]
+			self.distance_engine.load(trajectories)
+			statistics = metrics.PairStatistics.load_or_calculate(self.distance_engine, self.filename_statistics)
+			statistics.save(self.filename_statistics)
+			# Written to the memory-mapped file, if given, rather than copied in memory.
+			distances = nn_chain.copy_distances(statistics.distances, self.filename_distances)
+			missing = metrics.distance_engine.find_missing_distances(distances)
+			metrics.distance_engine.replace_missing_distances(distances)
+			if isinstance(distances, numpy.memmap):
+				distances.flush()
+			self.pairwise_distances_full = metrics.DistanceCache.from_condensed(self.distance_engine.labels, distances, missing = missing)
+			# The pair statistics are calculated for every pair, so none of the pairs were pruned.
+			self.pairwise_distances_full.parameters = dict(self.distance_parameters, prune_bound = None)
 		else:
-			pair_array = self.distance_calculator.run(trajectories)
-
-		self.pairwise_distances_full = metrics.DistanceCache(pair_array)  # Keep a record of the pairwise distances before filtering.
+			# Sort the trajectories beforehand so the condensed vector is already in the label order used by the cache.
+			trajectories = trajectories.loc[sorted(trajectories.index)]
+			labels, distances = self.distance_engine.run(trajectories, self.filename_distances, self.distance_cache)
+			self.pairwise_distances_full = metrics.DistanceCache.from_condensed(labels, distances, missing = self.distance_engine.missing)
+			self.pairwise_distances_full.parameters = self.distance_parameters
+		# Keep a record of the pairwise distances before filtering.
 		return self.pairwise_distances_full
 
-	def run(self, trajectories: pandas.DataFrame, distance_cutoff:Optional[float] = None) -> projectdata.DataGenotypeInference:
+	def get_distance_graph(self, trajectories: pandas.DataFrame) -> sparse_graph.DistanceGraph:
+		""" Same as `get_pairwise_distances`, but only the pairs within `self.sparse_graph_bound` are kept."""
+		if self.filename_pairwise:
+			return sparse_graph.DistanceGraph.from_distance_cache(self.get_pairwise_distances(trajectories), self.sparse_graph_bound)
+		if self.distance_cache is not None or self.filename_distances:
+			logger.warning("The distance cache and memory-mapped distances are not used with the sparse distance graph.")
+		return sparse_graph.DistanceGraph.from_engine(self.distance_engine, trajectories, self.sparse_graph_bound)
+
+	def run(self, trajectories: pandas.DataFrame, distance_cutoff:Optional[float] = None, similarity_cutoffs: Optional[List[float]] = None,
+			cutoff_criterion: Optional[str] = None) -> projectdata.DataGenotypeInference:
 		"""
 			Run the genotype clustering workflow.
 		Parameters
@@ -196,19 +347,54 @@ class ClusterMutations:
 					Each trajectory/timepoint will include the observed frequency at each timepoint.
 		distance_cutoff: Optional[float]
 			Used to determine the distance cutoff when clustering genomtypes.
+		similarity_cutoffs: Optional[List[float]]
+			Additional cutoffs to cut the linkage table at. See `HierarchalCluster.run`.
+		cutoff_criterion: Optional[str]
+			Selects the best cutoff from `similarity_cutoffs` based on this statistic.
 		"""
 
 		modified_trajectories = trajectories.copy(deep = True)  # To avoid unintended changes
 
-		# Calculate the pairwise distances between each pair of mutational trajectories.
-		pairwise_distances = self.get_pairwise_distances(modified_trajectories)
-
-		# Calculate the genotypes
-		cluster_result = self.clusterer.run(
-			pairwise_distances,
-			starting_genotypes = self.known_genotypes,
-			similarity_cutoff = distance_cutoff
-		)
+		if self.deduplicate and self.sparse_graph_bound is None:
+			unique_trajectories, duplicates = group_identical_trajectories(modified_trajectories)
+			logger.info(f"Found {len(unique_trajectories)} unique trajectories out of {len(modified_trajectories)}")
+			representative = {member: label for label, members in duplicates.items() for member in members}
+			# Members which are not in the table are left as-is so they are still reported as missing.
+			known_genotypes = [list(dict.fromkeys(representative.get(i, i) for i in genotype)) for genotype in self.known_genotypes]
+			if len(unique_trajectories) == len(modified_trajectories):
+				duplicates = None
+		else:
+			if self.deduplicate:
+				logger.warning("Identical trajectories are not grouped when using the sparse distance graph.")
+			unique_trajectories, duplicates = modified_trajectories, None
+			known_genotypes = self.known_genotypes
+
+		if self.sparse_graph_bound is not None:
+			if similarity_cutoffs or cutoff_criterion:
+				logger.warning("The similarity cutoffs are not tested when using the sparse distance graph.")
+			# Only the pairs within the bound are kept, so the full distance matrix is not available afterwards.
+			pairwise_distances = None
+			cluster_result = self.sparse_clusterer.run(
+				self.get_distance_graph(modified_trajectories),
+				starting_genotypes = self.known_genotypes,
+				similarity_cutoff = distance_cutoff
+			)
+		else:
+			# Calculate the pairwise distances between each pair of mutational trajectories.
+			pairwise_distances = self.get_pairwise_distances(unique_trajectories)
+			weights = [len(duplicates[label]) for label in pairwise_distances.labels] if duplicates else None
+
+			# Calculate the genotypes
+			cluster_result = self.clusterer.run(
+				pairwise_distances,
+				starting_genotypes = known_genotypes,
+				similarity_cutoff = distance_cutoff,
+				similarity_cutoffs = similarity_cutoffs,
+				cutoff_criterion = cutoff_criterion,
+				weights = weights
+			)
+			if duplicates:
+				cluster_result.clusters = [[member for label in cluster for member in duplicates[label]] for cluster in cluster_result.clusters]
 		genotype_table, genotype_members = self.generate_genotype_table(modified_trajectories, cluster_result.clusters)
 
 		sorted_genotype_table = self.organizer.run(genotype_table)
@@ -1,9 +1,12 @@
+from typing import Any, List, Tuple
+
+import numpy
 import pandas
 
 try:
 	from muller.inheritance import timepoint_detection
 except ModuleNotFoundError:
-	from muller.inheritance import timepoint_detection
+	from ..inheritance import timepoint_detection
 
 
 class SortGenotypeTableWorkflow:
@@ -26,86 +29,89 @@ class SortGenotypeTableWorkflow:
 		# self.breakpoints = sorted([1.0, 0.9, 0.8, 0.7, 0.6, 0.5, 0.4, 0.3, 0.2, 0.1, 0.0] + [self.dlimit, self.flimit], reverse = True)
 		self.breakpoints = [1.0, 0.9, 0.8, 0.7, 0.6, 0.5, 0.4, 0.3, 0.2, 0.1, 0.0]
 
-	@staticmethod
-	def _build_sorted_frequency_table(original_frequencies: pandas.DataFrame, thresholds: pandas.DataFrame) -> pandas.DataFrame:
-		# Sort genotypes based on frequency if two or more share the same fixed timepoint, detection timpoint, threshold timepoint.
-		# Iterate over the conbinations of 'firstFixed', 'firstDetected', and 'firstThreshold' and sort trajectories that belong to the sample combination.
-		# Need to build a new trajectory table based on the sorted timepoint table.
-
-		freq_groups = list()
-		# Group the
-		groups = thresholds.groupby(by = list(thresholds.columns))
-		for (ff, fd, ft), group in groups:
-			# Each group will look like this:
-			#   	firstFixed firstDetected firstThreshold
-			# 15          0            25              0
-			# 10          0            25              0
-			# if ft == 130:  # dummy value assigned above. Revert back to 0 since '130' isn't a valid timepoint.
-			#	ft = 0
-			# Get a table of the original frequencies at each timepoint for the genotypes present in `group`
-			trajectories: pandas.DataFrame = original_frequencies.loc[group.index]
-			if len(group) < 2:
-				# There is only one genotype in this combination of timepoints. No need to sort.
-				freq_groups.append(trajectories)
-			else:
-				# More than one genotype share this combination of key timepoints. Sort by frequency.
-				# Sort from highest to lowest using the timpoint columns as the sorting keys.
-				# trajectories = trajectories.sort_values(by = [ff, ft, fd], ascending = False)
-				trajectories = trajectories.sort_values(by = [fd, ft, ff], ascending = False)
-				freq_groups.append(trajectories)
-
-		try:
-			freq_df = pandas.concat(freq_groups)
-		except ValueError:
-			# Can't concatenate an empty dataframe
-			freq_df = None
-
-		return freq_df
-
-	def _sort_genotype_frequencies(self, genotype_trajectories: pandas.DataFrame, frequency_breakpoint: float) -> pandas.DataFrame:
-		"""
-			Sorts the genotype table based on the timepoints that first satisfy the threshold requirements.
-		Parameters
-		----------
-		genotype_trajectories
-		frequency_breakpoint
-		"""
-		# Get the values for each genotype at the first timepoint. This will be used to check if the genotype existed at the first timepoint
-		# or has an initial detected timepoint of 0 due to the way pandas returns indicies.
-		detection_cutoff = min(self.dlimit, frequency_breakpoint)
-		transposed = genotype_trajectories.transpose()
-
-		first_detected_reduced = timepoint_detection.get_first_detected_timepoint(transposed, detection_cutoff)
-		first_above_threshold_reduced = timepoint_detection.get_first_significant_timepoint(transposed, self.slimit)
-		# Use the frequency breakpoint rather than the fixed cutoff.
-		first_fixed_reduced = timepoint_detection.get_first_fixed_timepoint(transposed, frequency_breakpoint)
-
-		combined_df: pandas.DataFrame = pandas.concat(
-			[first_fixed_reduced, first_detected_reduced, first_above_threshold_reduced],
-			axis = 1, sort = False)
-		df = combined_df[~combined_df['firstFixed'].isna()]
-
-		if frequency_breakpoint == self.flimit:
-			df = df.dropna()
-		df = df[['firstDetected', 'firstFixed', 'firstThreshold']]
-		sorted_frequencies = df.sort_values(by = ['firstDetected', 'firstThreshold'], ascending = True)
-
-		# Sort genotypes based on frequency if two or more share the same fixed timepoint, detection timpoint, threshold timepoint.
-		# Iterate over the conbinations of 'firstFixed', 'firstDetected', and 'firstThreshold' and sort trajectories that belong to the sample combination.
-		# Need to build a new trajectory table based on the sorted timepoint table.
-		freq_df = self._build_sorted_frequency_table(genotype_trajectories, sorted_frequencies)
-
-		return freq_df
-
 	@staticmethod
 	def remove_trajectories_below_threshold(df: pandas.DataFrame, threshold: float) -> pandas.DataFrame:
 		""" Removes all genotypes that do not have at least one frequency above the given threshold."""
 		result = df[df.max(axis = 1) >= threshold]
 		return result
 
+	@staticmethod
+	def _get_timepoint_ranks(columns: List[Any]) -> numpy.ndarray:
+		""" The rank of each timepoint label, so timepoints are compared by label rather than by column position."""
+		ranks = numpy.empty(len(columns), dtype = numpy.int64)
+		ranks[pandas.Index(columns).argsort(kind = 'mergesort')] = numpy.arange(len(columns))
+		return ranks
+
+	def get_sort_keys(self, values: numpy.ndarray, columns: List[Any]) -> Tuple[numpy.ndarray, List[numpy.ndarray]]:
+		"""
+			Calculates the breakpoint each genotype is sorted under and the keys used to order the genotypes within it.
+			A genotype is sorted under the first (highest) breakpoint where it:
+				- has a frequency of at least the breakpoint,
+				- exceeds the breakpoint after the first timepoint (any timepoint for the last breakpoint of 0), and
+				- was detected above min(dlimit, breakpoint) after the first timepoint or was already above it at the first timepoint.
+			Timepoints are identified by their label, so a "first timepoint" of 0 is the timepoint labeled 0.
+		Parameters
+		----------
+		values: numpy.ndarray
+			2-D array of the genotype frequencies.
+		columns: List[Any]
+			The timepoint of each column of `values`.
+
+		Returns
+		-------
+		Tuple[numpy.ndarray, List[numpy.ndarray]]
+			The position of the breakpoint in `self.breakpoints` each genotype is sorted under (-1 if none) and the sort
+			keys for `numpy.lexsort`, from least to most significant.
+		"""
+		breakpoints = numpy.array(self.breakpoints, dtype = float)
+		rows = numpy.arange(len(values))
+		is_zero = numpy.array([column == 0 for column in columns], dtype = bool)
+		ranks = self._get_timepoint_ranks(columns)
+
+		detection_cutoffs = numpy.minimum(self.dlimit, breakpoints)
+		# Every cutoff is checked at once. Genotypes which never exceed a cutoff are assigned the first timepoint, the same as `idxmax`.
+		first, _ = timepoint_detection.get_crossings(values, numpy.concatenate([breakpoints, detection_cutoffs, [self.slimit]]))
+		first = timepoint_detection.to_positions(first)
+		first_fixed = first[:len(breakpoints)]
+		first_detected = first[len(breakpoints):-1]
+		first_threshold = first[-1]
+
+		with numpy.errstate(invalid = 'ignore'):
+			maximum = numpy.where(numpy.isnan(values), -numpy.inf, values).max(axis = 1, initial = -numpy.inf)
+			initial = values[:, 0] if values.shape[1] else numpy.full(len(values), numpy.nan)
+			eligible = maximum >= breakpoints[:, numpy.newaxis]
+			# Genotypes which never exceed a breakpoint were assigned the first timepoint and are excluded by the same check.
+			eligible &= ~is_zero[first_fixed] | (breakpoints == 0)[:, numpy.newaxis]
+			eligible &= ~is_zero[first_detected] | (initial > detection_cutoffs[:, numpy.newaxis])
+			# Genotypes which were not above the threshold at the first timepoint are treated as crossing it at the last timepoint.
+			first_threshold = numpy.where((first_threshold == 0) & ~(initial > self.slimit), values.shape[1] - 1, first_threshold)
+
+		has_breakpoint = eligible.any(axis = 0)
+		breakpoint_index = numpy.where(has_breakpoint, eligible.argmax(axis = 0), -1)
+		selected = numpy.where(has_breakpoint, breakpoint_index, 0)
+		first_fixed = first_fixed[selected, rows]
+		first_detected = first_detected[selected, rows]
+
+		def descending(positions: numpy.ndarray) -> numpy.ndarray:
+			# Higher frequencies first, missing values last.
+			frequencies = values[rows, positions]
+			return numpy.where(numpy.isnan(frequencies), numpy.inf, -frequencies)
+
+		keys = [
+			rows,
+			descending(first_detected), descending(first_threshold), descending(first_fixed),
+			ranks[first_threshold], ranks[first_fixed], ranks[first_detected],
+			breakpoint_index
+		]
+		return breakpoint_index, keys
+
 	def run(self, unsorted_genotypes: pandas.DataFrame):
 		"""
 			Sorts the muller_genotypes based on when they were first detected and first fixed.
+			The genotypes are assigned to the highest frequency breakpoint they qualify for, then ordered by breakpoint, by the
+			timepoints they were first detected, fixed and above the significance threshold, and finally by their frequencies
+			at those timepoints, from highest to lowest. Every key is calculated for every breakpoint at once and the
+			final order comes from a single lexicographic sort.
 		Parameters
 		----------
 		unsorted_genotypes: pandas.Dataframe
@@ -115,22 +121,12 @@ class SortGenotypeTableWorkflow:
 		-------
 		sorted_genotype: pandas.DataFrame
 		"""
-		sorted_genotypes = list()
-		current_genotypes: pandas.DataFrame = unsorted_genotypes.copy()
-		for frequency in self.breakpoints:
-			# Ignore genotypes that do not have at least on timepoint exceeding the current frequency.
-			# This should be taken care of suring the filtering step.
-			genotypes_above_threshold = self.remove_trajectories_below_threshold(current_genotypes, frequency)
-
-			sorted_dataframe = self._sort_genotype_frequencies(
-				genotype_trajectories = genotypes_above_threshold,
-				frequency_breakpoint = frequency
-			)
-			if sorted_dataframe is not None:
-				current_genotypes = current_genotypes.drop(sorted_dataframe.index)
-				sorted_genotypes.append(sorted_dataframe)
-		df = pandas.concat(sorted_genotypes, sort = False)
-		df = unsorted_genotypes.reindex(df.index)
+		values = unsorted_genotypes.to_numpy(dtype = float)
+		breakpoint_index, keys = self.get_sort_keys(values, list(unsorted_genotypes.columns))
+		order = numpy.lexsort(keys)
+		# Genotypes which never qualify for a breakpoint are left out of the sorted table.
+		order = order[breakpoint_index[order] >= 0]
+		df = unsorted_genotypes.iloc[order]
 
 		# Make sure the genotype column is labelled correctly.
 		df.index.name = "Genotype"
@@ -1,19 +1,36 @@
-import itertools
+import math
+import statistics
 from typing import *
 
 import numpy
 import pandas
 from loguru import logger
 from scipy.cluster import hierarchy
-from scipy.spatial import distance
 
 try:
+	from muller.clustering import nn_chain
+	from muller.clustering.clustercalc import ClusterSet
+	from muller.clustering.metrics import distance_engine
 	from muller.clustering.metrics.distance_cache import DistanceCache
 	from muller.dataio import projectdata
 except ModuleNotFoundError:
+	from muller.clustering import nn_chain
+	from muller.clustering.clustercalc import ClusterSet
+	from muller.clustering.metrics import distance_engine
 	from muller.clustering.metrics.distance_cache import DistanceCache
 	from muller.dataio import projectdata
 
+# The number of values which are collected in memory once the memory-mapped selection has narrowed the search range.
+SELECTION_SIZE = 2 ** 20
+SELECTION_BINS = 1024
+
+# The statistics which can be used to select the best similarity cutoff. Larger values are better for both.
+CUTOFF_CRITERIA = ['silhouette', 'calinski-harabasz']
+# The similarity cutoffs tested when a criterion is given without a list of cutoffs.
+DEFAULT_SIMILARITY_CUTOFFS = [round(0.01 * i, 2) for i in range(1, 21)]
+# 'scipy' uses `scipy.cluster.hierarchy.linkage`, 'nn-chain' uses `nn_chain.linkage`, which needs less memory.
+LINKAGE_BACKENDS = ['scipy', 'nn-chain']
+
 
 def format_linkage_matrix(linkage_table, total_members: Optional[int]) -> pandas.DataFrame:
 	linkage_dataframe = pandas.DataFrame(linkage_table, columns = ["left", "right", "distance", "observations"])
@@ -28,20 +45,215 @@ def format_linkage_matrix(linkage_table, total_members: Optional[int]) -> pandas
 	return linkage_dataframe
 
 
+def _iterate_between(values: numpy.ndarray, lower: float, upper: float, chunk_size: int):
+	""" Yields the values strictly between `lower` and `upper`, one chunk of `values` at a time."""
+	for start, stop in distance_engine.iterate_chunks(len(values), chunk_size):
+		chunk = numpy.asarray(values[start:stop])
+		yield chunk[(chunk > lower) & (chunk < upper)]
+
+
+def _select_chunked(values: numpy.ndarray, rank: int, lower: float, upper: float, chunk_size: int) -> float:
+	"""
+		Streaming version of `select_order_statistics` for arrays which should not be copied into memory, such as
+		memory-mapped distance vectors. Each pass over the array counts the values in `SELECTION_BINS` equal-width bins of
+		the current search range and narrows the range to the bin containing `rank`, until the remaining values fit in memory.
+	"""
+	low = min(chunk.min() for chunk in _iterate_between(values, lower, upper, chunk_size) if len(chunk))
+	high = numpy.nextafter(max(chunk.max() for chunk in _iterate_between(values, lower, upper, chunk_size) if len(chunk)), math.inf)
+	while True:
+		# The values within the search range are in [`low`, `high`)
+		if numpy.nextafter(low, math.inf) >= high:
+			return float(low)
+		edges = numpy.linspace(low, high, SELECTION_BINS + 1)
+		counts = numpy.zeros(SELECTION_BINS, dtype = numpy.int64)
+		for chunk in _iterate_between(values, lower, upper, chunk_size):
+			chunk = chunk[(chunk >= low) & (chunk < high)]
+			counts += numpy.bincount(numpy.searchsorted(edges[1:-1], chunk, side = 'right'), minlength = SELECTION_BINS)
+
+		if counts.sum() <= SELECTION_SIZE:
+			selected = numpy.concatenate([chunk[(chunk >= low) & (chunk < high)] for chunk in _iterate_between(values, lower, upper, chunk_size)])
+			return float(numpy.partition(selected, rank)[rank])
+
+		cumulative = numpy.cumsum(counts)
+		index = int(numpy.searchsorted(cumulative, rank, side = 'right'))
+		if index:
+			rank -= int(cumulative[index - 1])
+		low, high = edges[index], edges[index + 1]
+
+
+def select_order_statistics(values: numpy.ndarray, ranks: List[int], lower: float, upper: float,
+		chunk_size: int = distance_engine.CHUNK_SIZE) -> List[float]:
+	"""
+		Returns the `ranks`-th smallest values (0-indexed) among the elements of `values` strictly between `lower` and `upper`.
+		Uses `numpy.partition` (linear time) rather than sorting. Memory-mapped arrays are scanned in chunks instead.
+	"""
+	if isinstance(values, numpy.memmap):
+		return [_select_chunked(values, rank, lower, upper, chunk_size) for rank in ranks]
+	values = numpy.asarray(values)
+	selected = values[(values > lower) & (values < upper)]
+	selected = numpy.partition(selected, sorted(set(ranks)))
+	return [float(selected[rank]) for rank in ranks]
+
+
+def _get_maximum(values: numpy.ndarray, chunk_size: int = distance_engine.CHUNK_SIZE) -> float:
+	maximum = -math.inf
+	for start, stop in distance_engine.iterate_chunks(len(values), chunk_size):
+		chunk = numpy.asarray(values[start:stop])
+		chunk = chunk[~numpy.isnan(chunk)]
+		if len(chunk):
+			maximum = max(maximum, float(chunk.max()))
+	return maximum
+
+
+def _count_between(values: numpy.ndarray, lower: float, upper: float, chunk_size: int = distance_engine.CHUNK_SIZE) -> int:
+	return sum(len(chunk) for chunk in _iterate_between(values, lower, upper, chunk_size))
+
+
+def _get_quantile_position(quantile: float, size: int) -> Tuple[float, int, int]:
+	""" Same steps as `pandas.Series.quantile` -> `numpy.percentile(method = 'linear')`."""
+	q = numpy.float64(quantile) * 100.0 / 100
+	position = (size - 1) * q
+	if position >= size - 1:
+		index_previous = index_next = size - 1
+	elif position < 0:
+		index_previous = index_next = 0
+	else:
+		index_previous = int(math.floor(position))
+		index_next = index_previous + 1
+	return position, index_previous, index_next
+
+
+def interpolate_quantiles(quantiles: Iterable[float], total: int, select: Callable[[List[int]], List[float]]) -> List[float]:
+	"""
+		Calculates `quantiles` of `total` values which are each present twice, using the same linear interpolation as
+		`pandas.Series.quantile`. `select` returns the order statistics (0-indexed) at the requested ranks.
+	"""
+	quantiles = list(quantiles)
+	if total == 0:
+		return [math.nan for _ in quantiles]
+
+	# Each value is present twice when both orientations are included, so the value at position `i` is the `i // 2`-th value.
+	positions = [_get_quantile_position(quantile, 2 * total) for quantile in quantiles]
+	ranks = sorted({index // 2 for _, index_previous, index_next in positions for index in (index_previous, index_next)})
+	selected = dict(zip(ranks, select(ranks)))
+
+	result = list()
+	for position, index_previous, index_next in positions:
+		previous = numpy.float64(selected[index_previous // 2])
+		following = numpy.float64(selected[index_next // 2])
+		gamma = position - numpy.floor(position)
+		difference = following - previous
+		if gamma >= 0.5:
+			result.append(float(following - difference * (1 - gamma)))
+		else:
+			result.append(float(previous + difference * gamma))
+	return result
+
+
+def calculate_weighted_cutoff_quantiles(quantiles: Iterable[float], distances: numpy.ndarray, weights: Sequence[int],
+		chunk_size: int = distance_engine.CHUNK_SIZE) -> List[float]:
+	"""
+		Same as `calculate_cutoff_quantiles` for a condensed distance vector where each observation represents `weights`
+		identical observations. The result is identical to the quantiles of the distance vector with every copy, since the
+		distance between two copies is 0 and is never counted. The selected distances are sorted in memory.
+	"""
+	weights = numpy.asarray(weights, dtype = numpy.int64)
+	maximum = _get_maximum(distances, chunk_size)
+	offsets = distance_engine.get_row_offsets(len(weights))
+	values = list()
+	counts = list()
+	for start, stop in distance_engine.iterate_chunks(len(distances), chunk_size):
+		chunk = numpy.asarray(distances[start:stop])
+		selected = numpy.flatnonzero((chunk > 0) & (chunk < maximum))
+		left, right = distance_engine.condensed_index_to_pairs(start + selected, len(weights), offsets)
+		values.append(chunk[selected])
+		counts.append(weights[left] * weights[right])
+	values = numpy.concatenate(values) if values else numpy.empty(0)
+	counts = numpy.concatenate(counts) if counts else numpy.empty(0, dtype = numpy.int64)
+	order = numpy.argsort(values, kind = 'mergesort')
+	values = values[order]
+	cumulative = numpy.cumsum(counts[order])
+	total = int(cumulative[-1]) if len(cumulative) else 0
+
+	def select(ranks: List[int]) -> List[float]:
+		return [float(values[i]) for i in numpy.searchsorted(cumulative, ranks, side = 'right')]
+
+	return interpolate_quantiles(quantiles, total, select)
+
+
+def calculate_cutoff_quantiles(quantiles: Iterable[float], distances: numpy.ndarray, chunk_size: int = distance_engine.CHUNK_SIZE,
+		weights: Optional[Sequence[int]] = None) -> List[float]:
+	"""
+		Calculates each of `quantiles` of the pairwise distances between 0 and the maximum distance (both exclusive).
+		`distances` is the condensed distance vector, but the result is identical to
+		`pandas.Series(both_orientations).quantile(quantile)`, which was used when the distances were held in a dict with
+		both orientations of every pair. Only the order statistics needed for the linear interpolation are selected.
+		If `weights` are given, uses `calculate_weighted_cutoff_quantiles` instead.
+	"""
+	if weights is not None:
+		return calculate_weighted_cutoff_quantiles(quantiles, distances, weights, chunk_size)
+	distances = numpy.asanyarray(distances)
+	maximum = _get_maximum(distances, chunk_size)
+	total = _count_between(distances, 0, maximum, chunk_size)
+	return interpolate_quantiles(quantiles, total, lambda ranks: select_order_statistics(distances, ranks, 0, maximum, chunk_size))
+
+
+def calculate_cutoff_quantile(quantile: float, distances: numpy.ndarray, chunk_size: int = distance_engine.CHUNK_SIZE) -> float:
+	""" Same as `calculate_cutoff_quantiles` for a single quantile."""
+	return calculate_cutoff_quantiles([quantile], distances, chunk_size)[0]
+
+
+def order_linkage_table(linkage_table: pandas.DataFrame, distances: numpy.ndarray) -> pandas.DataFrame:
+	"""
+		Reorders the branches of `linkage_table` so the distance between adjacent leaves is minimized. Only the order
+		of the two children of each merge changes, so the clusters are the same. This is much slower than generating the
+		linkage table and only affects how the dendrogram is drawn.
+	Parameters
+	----------
+	linkage_table: pandas.DataFrame
+		The linkage table generated by `HierarchalCluster.link_clusters`.
+	distances: numpy.ndarray
+		The condensed distance vector used to generate the linkage table.
+	"""
+	Z = linkage_table[['left', 'right', 'distance', 'observations']].values
+	Z = hierarchy.optimal_leaf_ordering(Z, distances)
+	return format_linkage_matrix(Z, len(linkage_table) + 1)
+
+
 class HierarchalCluster:
-	def __init__(self, linkage: str = 'ward', cluster: str = 'distance'):
+	"""
+	Parameters
+	----------
+	linkage: str
+		The linkage method passed to `scipy.cluster.hierarchy.linkage`.
+	cluster: str
+		How to cut the linkage table. One of 'distance', 'monocrit' or 'inconsistent'.
+	optimal_ordering: bool
+		Whether to reorder the leaves of the linkage table as it is generated. This does not affect the clusters, so
+		the leaves are left unordered by default and ordered with `order_linkage_table` only when the dendrogram is drawn.
+	linkage_backend: str
+		One of `LINKAGE_BACKENDS`. Both generate the same linkage table. Weighted observations are always linked with 'nn-chain'.
+	"""
+	def __init__(self, linkage: str = 'ward', cluster: str = 'distance', optimal_ordering: bool = False,
+			linkage_backend: str = 'scipy'):
+		if linkage_backend not in LINKAGE_BACKENDS:
+			message = f"'{linkage_backend}' is not a valid linkage backend. Expected one of {LINKAGE_BACKENDS}"
+			raise ValueError(message)
 		self.linkage_method = linkage
 		self.cluster_method = cluster
+		self.optimal_ordering = optimal_ordering
+		self.linkage_backend = linkage_backend
 
 	@staticmethod
-	def _add_starting_genotypes(pair_array, starting_genotypes) -> Dict[str, str]:
+	def _add_starting_genotypes(pair_array: DistanceCache, starting_genotypes: List[List[str]]) -> DistanceCache:
+		"""
+			Sets the distance between members of each known genotype to 0 so they are grouped together. Modifies `pair_array`
+			in place, so pass a copy if the original distances are needed.
+		"""
 		for genotype in starting_genotypes:
-			combinations = itertools.combinations(genotype, 2)
-			values = dict()
-			for a, b in combinations:
-				values[a, b] = 0
-				values[b, a] = 0
-			pair_array = pair_array.update(values)
+			missing = pair_array.set_group(genotype, 0)
+			if missing:
+				logger.warning(f"The following members of a known genotype are not in the distance matrix and will be ignored: {missing}")
 		return pair_array
 
 	@staticmethod
@@ -77,19 +289,35 @@ class HierarchalCluster:
 		return list(cluster_map.values())
 
 
-	def link_clusters(self, distances: numpy.ndarray, num: int) -> pandas.DataFrame:
-		Z = hierarchy.linkage(distances, method = self.linkage_method, optimal_ordering = True)
+	def link_clusters(self, distances: numpy.ndarray, num: int, weights: Optional[Sequence[int]] = None) -> pandas.DataFrame:
+		""" `weights` is the number of identical observations each row represents, if any row represents more than one."""
+		if weights is not None:
+			Z = nn_chain.linkage(distances, num, method = self.linkage_method, sizes = weights)
+			if self.optimal_ordering:
+				Z = hierarchy.optimal_leaf_ordering(Z, distances)
+		elif self.linkage_backend == 'nn-chain':
+			Z = nn_chain.linkage(distances, num, method = self.linkage_method)
+			if self.optimal_ordering:
+				Z = hierarchy.optimal_leaf_ordering(Z, distances)
+		else:
+			Z = hierarchy.linkage(distances, method = self.linkage_method, optimal_ordering = self.optimal_ordering)
 
 		return format_linkage_matrix(Z, num)
 
-	def cluster(self, linkage_table: pandas.DataFrame, cutoff: float, labels: Optional[Iterable[str]] = None) -> List[List[Union[int, str]]]:
-		inconsistent = self._get_inconsistent(linkage_table.values)
+	def cluster(self, linkage_table: pandas.DataFrame, cutoff: float, labels: Optional[Iterable[str]] = None,
+			inconsistent: Optional[pandas.DataFrame] = None) -> List[List[Union[int, str]]]:
+		"""
+			Cuts the linkage table at `cutoff`. `inconsistent` can be given to avoid recalculating it when the same
+			linkage table is cut more than once. It is only used by the 'monocrit' and 'inconsistent' methods.
+		"""
 		if self.cluster_method == 'distance':
 			clusters = self._cluster_by_distance(linkage_table.values, cutoff)
 		elif self.cluster_method == 'monocrit':
+			if inconsistent is None: inconsistent = self._get_inconsistent(linkage_table.values)
 			clusters = self._cluster_by_monocrit(linkage_table.values, cutoff, inconsistent)
 
 		elif self.cluster_method == 'inconsistent':
+			if inconsistent is None: inconsistent = self._get_inconsistent(linkage_table.values)
 			clusters = self._cluster_by_inconsistent(linkage_table.values, cutoff, inconsistent)
 		else:
 			message = f"'{self.cluster_method}' is not a currently supported clustering method when using hierarchical clustering."
@@ -101,15 +329,87 @@ class HierarchalCluster:
 
 		return clusters
 	@staticmethod
-	def adjust_similarity_cutoff(quantile:float, distances: List[float])->float:
-		""" Adjusts the `similarity_cutoff` value to work with the distance observations."""
+	def adjust_similarity_cutoff(quantile:float, distances: numpy.ndarray, weights: Optional[Sequence[int]] = None)->float:
+		"""
+			Adjusts the `similarity_cutoff` value to work with the distance observations.
+			`distances` should be the condensed distance vector (see `calculate_cutoff_quantile`).
+		"""
+		return calculate_cutoff_quantiles([quantile], distances, weights = weights)[0]
 
-		#result = pandas.Series(distances).quantile(quantile)
-		result = pandas.Series([i for i in distances if 0 < i < max(distances)]).quantile(quantile)
-		return result
 
+	@staticmethod
+	def score_clusters(clusters: List[List[str]], pair_array: DistanceCache) -> Dict[str, float]:
+		""" Calculates the `ClusterSet` quality indices for a set of clusters. Indices which are undefined for the clusters are NaN."""
+		cluster_set = ClusterSet(clusters, pair_array)
+		try:
+			index = cluster_set.calculate_index()
+		except (ZeroDivisionError, statistics.StatisticsError, ValueError):
+			# Requires at least two clusters and fewer clusters than points.
+			index = math.nan
+		try:
+			coefficients = list(cluster_set.calculate_silhouette_coefficients().values())
+		except (ZeroDivisionError, ValueError):
+			coefficients = list()
+		silhouette = statistics.mean(coefficients) if coefficients else math.nan
+		return {'calinskiHarabasz': index, 'silhouette': silhouette}
 
-	def run(self, pair_array: DistanceCache, starting_genotypes: List[List[str]] = None, similarity_cutoff: Optional[float] = None) -> projectdata.DataHierarchalCluster:
+	def sweep(self, linkage_table: pandas.DataFrame, pair_array: DistanceCache, similarity_cutoffs: Iterable[float],
+			score: bool = True, weights: Optional[Sequence[int]] = None) -> Tuple[pandas.DataFrame, Dict[float, List[List[str]]]]:
+		"""
+			Cuts a single linkage table at each of `similarity_cutoffs`.
+		Parameters
+		----------
+		linkage_table: pandas.DataFrame
+			The linkage table generated by `link_clusters`.
+		pair_array: DistanceCache
+		similarity_cutoffs: Iterable[float]
+			The quantiles of the pairwise distances to cut the linkage table at.
+		score: bool
+			Whether to calculate the quality indices for each set of clusters. Each label is counted once, regardless of `weights`.
+		weights: Optional[Sequence[int]]
+			The number of identical observations each label represents. Used to calculate the distance cutoffs.
+		Returns
+		-------
+		pandas.DataFrame
+			One row per cutoff with the distance cutoff, number of clusters and quality indices.
+		Dict[float, List[List[str]]]
+			The clusters generated for each similarity cutoff.
+		"""
+		similarity_cutoffs = list(similarity_cutoffs)
+		reduced_linkage_table = linkage_table[['left', 'right', 'distance', 'observations']]
+		inconsistent = None if self.cluster_method == 'distance' else self._get_inconsistent(reduced_linkage_table.values)
+		distance_cutoffs = calculate_cutoff_quantiles(similarity_cutoffs, pair_array.triangle(), weights = weights)
+
+		records = list()
+		cluster_map = dict()
+		for similarity_cutoff, distance_cutoff in zip(similarity_cutoffs, distance_cutoffs):
+			clusters = self.cluster(reduced_linkage_table, distance_cutoff, pair_array.labels, inconsistent)
+			cluster_map[similarity_cutoff] = clusters
+			record = {
+				'similarityCutoff': similarity_cutoff,
+				'distanceCutoff':   distance_cutoff,
+				'clusters':         len(clusters)
+			}
+			if score:
+				record.update(self.score_clusters(clusters, pair_array))
+			records.append(record)
+		return pandas.DataFrame(records), cluster_map
+
+	@staticmethod
+	def select_cutoff(table: pandas.DataFrame, criterion: str) -> Optional[float]:
+		""" Returns the similarity cutoff with the highest value of `criterion`, or None if it is undefined for every cutoff."""
+		if criterion not in CUTOFF_CRITERIA:
+			message = f"'{criterion}' is not a valid criterion. Expected one of {CUTOFF_CRITERIA}"
+			raise ValueError(message)
+		column = 'calinskiHarabasz' if criterion == 'calinski-harabasz' else criterion
+		values = table[column]
+		if values.isna().all():
+			return None
+		return float(table.loc[values.idxmax(), 'similarityCutoff'])
+
+	def run(self, pair_array: DistanceCache, starting_genotypes: List[List[str]] = None, similarity_cutoff: Optional[float] = None,
+			similarity_cutoffs: Optional[Iterable[float]] = None, cutoff_criterion: Optional[str] = None,
+			weights: Optional[Sequence[int]] = None) -> projectdata.DataHierarchalCluster:
 		"""
 		Parameters
 		----------
@@ -118,14 +418,27 @@ class HierarchalCluster:
 			Each element should be a list of trajectories known to be in the same genotype.
 		similarity_cutoff: Optional[float]
 			If not given, the similarity cutoff will be generated automatically.
+		similarity_cutoffs: Optional[Iterable[float]]
+			Additional similarity cutoffs to cut the same linkage table at. The number of clusters and quality indices for
+			each cutoff are saved in `table_cutoffs`.
+		cutoff_criterion: Optional[str]
+			One of `CUTOFF_CRITERIA`. If given, the cutoff from `similarity_cutoffs` (or `DEFAULT_SIMILARITY_CUTOFFS`)
+			with the best value is used instead of `similarity_cutoff`.
+		weights: Optional[Sequence[int]]
+			The number of identical observations each label of `pair_array` represents, in the same order as the labels.
+			The clusters are the same as if every copy was included.
 		"""
 
-		# If known genotypes are given, modify the pair_array so that they will be grouped together.
+		# If known genotypes are given, modify a copy of the pair_array so that they will be grouped together.
+		# The original distances are left as-is since they are saved and may be reused by later runs.
+		filename_known = None
 		if starting_genotypes:
-			pair_array = self._add_starting_genotypes(pair_array, starting_genotypes)
-		squaremap = pair_array.squareform()
-		distance_array = distance.squareform(squaremap.values)
-		linkage_table = self.link_clusters(distance_array, len(squaremap.index))
+			if pair_array.is_memory_mapped:
+				filename_known = pair_array.filename.with_suffix('.known.npy')
+			pair_array = self._add_starting_genotypes(pair_array.copy(filename_known), starting_genotypes)
+		distance_array = pair_array.triangle()
+		labels = pair_array.labels
+		linkage_table = self.link_clusters(distance_array, len(labels), weights)
 		reduced_linkage_table = linkage_table[['left', 'right', 'distance', 'observations']]  # Removes the extra column
 
 		if similarity_cutoff is None:
@@ -133,18 +446,41 @@ class HierarchalCluster:
 		else:
 			quantile = similarity_cutoff
 
-		distance_cutoff = self.adjust_similarity_cutoff(quantile, list(pair_array.pairwise_values.values()))
+		if cutoff_criterion and not similarity_cutoffs:
+			similarity_cutoffs = DEFAULT_SIMILARITY_CUTOFFS
+		if similarity_cutoffs:
+			table_cutoffs, cluster_map = self.sweep(linkage_table, pair_array, similarity_cutoffs, weights = weights)
+			logger.info(f"Clusters generated for each similarity cutoff:\n{table_cutoffs.to_string(index = False)}")
+		else:
+			table_cutoffs, cluster_map = None, dict()
+
+		if cutoff_criterion:
+			selected = self.select_cutoff(table_cutoffs, cutoff_criterion)
+			if selected is None:
+				logger.warning(f"Could not select a similarity cutoff using '{cutoff_criterion}'. Using {quantile} instead.")
+			else:
+				logger.info(f"Selected similarity cutoff {selected} using '{cutoff_criterion}'")
+				quantile = selected
+
+		distance_cutoff = self.adjust_similarity_cutoff(quantile, pair_array.triangle(), weights)
 
 		logger.debug(f"Using Hierarchical Clustering with similarity cutoff {distance_cutoff}")
 
-		clusters = self.cluster(reduced_linkage_table, distance_cutoff, squaremap.index)
+		if quantile in cluster_map:
+			clusters = cluster_map[quantile]
+		else:
+			clusters = self.cluster(reduced_linkage_table, distance_cutoff, labels)
 
 		result = projectdata.DataHierarchalCluster(
 			clusters = clusters,
 			table_linkage = linkage_table,
 			distance_cutoff = distance_cutoff,
-			distance_quantile = quantile
+			distance_quantile = quantile,
+			table_cutoffs = table_cutoffs
 		)
+		if filename_known is not None:
+			# Release the memory-mapped copy before removing it.
+			del pair_array, distance_array
+			filename_known.unlink()
 
 		return result
-
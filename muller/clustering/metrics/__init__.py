@@ -1,3 +1,6 @@
 from .distance_cache import DistanceCache
 from .distance_calculator import DistanceCalculator
-
+from .distance_engine import DistanceEngine
+from .persistent_cache import PersistentDistanceCache
+from .pair_statistics import INCREMENTAL_METRICS, PairStatistics
+from .distance_methods import Metric, PairWindows, get_metric, register_metric
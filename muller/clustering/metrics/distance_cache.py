@@ -1,93 +1,361 @@
-import itertools
+import csv
+import json
 from pathlib import Path
-from typing import Dict, Iterable, List, Tuple
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
+import numpy
 import pandas
 from scipy.spatial import distance
 
+try:
+	from muller.clustering.metrics import distance_engine
+except ModuleNotFoundError:
+	from . import distance_engine
+
 PairwiseArrayType = Dict[Tuple[str, str], float]
 
-# TODO: Refactor using UserDict
+
+def _sort_labels(labels: Iterable) -> List:
+	try:
+		return sorted(labels)
+	except TypeError:
+		# Mixed label types.
+		return sorted(labels, key = str)
+
+
 class DistanceCache:
 	"""
-		Calculates and holds the distances for all pairwise elements.
+		Holds the distances for all pairwise elements. The distances are stored as a single condensed vector
+		(the same layout used by `scipy.spatial.distance.squareform`) along with the sorted list of labels, so each
+		pair is only stored once. Pairs which have not been assigned a value are stored as NaN. The vector may be a
+		`numpy.memmap`, in which case the methods which scan every pair read the file in chunks.
 
 		Usage
 		-----
-		calculation = PairwiseCalculation()
-		# Update values
-		pair_array = calculation.update_values(timeseries, detection_cutoff, fixed_cutoff)
+		cache = DistanceCache(pair_array) # `pair_array` maps `(left, right)` to a distance.
+		cache = DistanceCache.from_condensed(labels, distances)
+		cache['A', 'B'] == cache['B', 'A']
+		cache.save_binary(filename) # Reload with `DistanceCache.read_binary(filename)`
+	Parameters
+	----------
+	pairwise_array: Dict[Tuple[str,str], float]
+		Maps each pair of labels to the distance between them. Only one orientation of each pair is required.
+	dtype: numpy.dtype
+		The type used to store the distances. `numpy.float32` halves the memory requirement.
 	"""
 
-	def __init__(self, pairwise_array: PairwiseArrayType = None):
-		if pairwise_array is None: pairwise_array = dict()
-		self.pairwise_values = dict()
+	def __init__(self, pairwise_array: PairwiseArrayType = None, dtype = numpy.float64):
+		self.dtype = numpy.dtype(dtype)
+		self.labels: List[str] = list()
+		self.index: Dict[str, int] = dict()
+		self._values: numpy.ndarray = numpy.empty(0, dtype = self.dtype)
+		# The parameters used to calculate the distances (metric, dlimit, flimit). Saved with `save_binary`.
+		self.parameters: Dict[str, Any] = dict()
+		# The pairs which could not be compared and were assigned the maximum distance, as packed bits.
+		# See `distance_engine.find_missing_distances`. `None` if every pair was compared or if this is not known.
+		self.missing: Optional[numpy.ndarray] = None
 
-		for (left, right), value in pairwise_array.items():
-			self.pairwise_values[left, right] = value
-			self.pairwise_values[right, left] = value
+		if pairwise_array:
+			self.update(pairwise_array)
 
 	def __bool__(self) -> bool:
-		return bool(self.pairwise_values)
+		for start, stop in distance_engine.iterate_chunks(len(self._values)):
+			if not numpy.isnan(self._values[start:stop]).all():
+				return True
+		return False
 
 	def __len__(self) -> int:
-		return len(self.pairwise_values)
+		""" The number of (ordered) pairs with a value. Matches the size of `self.pairwise_values`."""
+		total = 0
+		for start, stop in distance_engine.iterate_chunks(len(self._values)):
+			total += int((~numpy.isnan(self._values[start:stop])).sum())
+		return 2 * total
+
 	def __getitem__(self, item):
-		return self.pairwise_values[item]
+		left, right = item
+		result = self.get(left, right)
+		if result is None:
+			raise KeyError(item)
+		return result
+
+	def _set_labels(self, labels: List[str]):
+		self.labels = list(labels)
+		self.index = {label: position for position, label in enumerate(self.labels)}
+
+	def _get_position(self, left, right) -> Optional[int]:
+		i = self.index[left]
+		j = self.index[right]
+		if i == j:
+			return None
+		if i > j:
+			i, j = j, i
+		n = len(self.labels)
+		return i * n - (i * (i + 1)) // 2 + (j - i - 1)
+
+	def defined(self) -> numpy.ndarray:
+		""" Boolean mask of the positions in the condensed vector which have been assigned a value."""
+		return ~numpy.isnan(self._values)
+
+	def is_complete(self) -> bool:
+		""" Whether every pair has been assigned a value."""
+		for start, stop in distance_engine.iterate_chunks(len(self._values)):
+			if numpy.isnan(self._values[start:stop]).any():
+				return False
+		return True
+
+	@property
+	def is_memory_mapped(self) -> bool:
+		return isinstance(self._values, numpy.memmap)
+
+	@property
+	def filename(self) -> Optional[Path]:
+		""" The file backing the distances, if they are memory-mapped."""
+		return Path(self._values.filename) if self.is_memory_mapped else None
+
+	@property
+	def pairwise_values(self) -> PairwiseArrayType:
+		""" Both orientations of every pair with a value. Generated on request, so avoid using this for large datasets."""
+		left, right = distance_engine.condensed_index_to_pairs(numpy.arange(len(self._values)), len(self.labels))
+		pair_array = dict()
+		for l, r, value in zip(left.tolist(), right.tolist(), self._values.tolist()):
+			if value != value:  # NaN
+				continue
+			pair_array[self.labels[l], self.labels[r]] = value
+			pair_array[self.labels[r], self.labels[l]] = value
+		return pair_array
+
 	def asdict(self) -> PairwiseArrayType:
 		return self.pairwise_values
 
-	def squareform(self)->pandas.DataFrame:
-		""" Converts a dictionary with all pairwise values for a set of points into a square matrix representation.
-		"""
-		keys = sorted(set(itertools.chain.from_iterable(self.pairwise_values.keys())))
-		_square_map = dict()
-		for left in keys:
-			series = dict()
-			for right in keys:
-				value = self.get(left, right, 0)
-				series[right] = value
-			_square_map[left] = series
-		return pandas.DataFrame(_square_map)
-
-	def triangle(self):
-		""" Returns the condensed squareform of the pair array."""
+	def squareform(self, labels: Optional[Iterable[str]] = None) -> pandas.DataFrame:
+		"""
+			Converts the condensed vector into a square matrix. Pairs without a value are assigned 0.
+		Parameters
+		----------
+		labels: Optional[Iterable[str]]
+			Only include these labels in the matrix. Useful to avoid building the full matrix for large datasets.
+		"""
+		if labels is None:
+			values = self.triangle()
+			labels = self.labels
+		else:
+			positions = numpy.array(sorted(self.index[i] for i in labels), dtype = numpy.int64)
+			labels = [self.labels[i] for i in positions]
+			values = self._get_subset(positions)
+			values = numpy.where(numpy.isnan(values), 0, values)
 		# noinspection PyTypeChecker
-		return distance.squareform(self.squareform().values)
+		matrix = distance.squareform(values, checks = False)
+		return pandas.DataFrame(matrix, index = labels, columns = labels)
+
+	def triangle(self) -> numpy.ndarray:
+		""" Returns the condensed squareform of the pair array. This is the underlying array unless some pairs are missing."""
+		if self.is_complete():
+			return self._values
+		return numpy.where(self.defined(), self._values, 0)
+
+	def get_row(self, label: str) -> numpy.ndarray:
+		""" Returns the distance between `label` and every label in `self.labels`, in order. Pairs without a value are assigned 0."""
+		position = self.index[label]
+		total = len(self.labels)
+		row = numpy.zeros(total, dtype = self.dtype)
+		if position:
+			columns = numpy.arange(position)
+			row[:position] = self._values[distance_engine.pairs_to_condensed_index(columns, position, total)]
+		start = position * total - (position * (position + 1)) // 2
+		row[position + 1:] = self._values[start:start + total - position - 1]
+		row[numpy.isnan(row)] = 0
+		return row
+
+	def get_block(self, rows: numpy.ndarray, columns: numpy.ndarray) -> numpy.ndarray:
+		"""
+			Returns the block of the square distance matrix between the labels at positions `rows` and `columns`.
+			The distance between a label and itself is 0, as are pairs without a value.
+		Parameters
+		----------
+		rows, columns: numpy.ndarray
+			Positions within `self.labels`, in any order.
+		"""
+		rows = numpy.asarray(rows, dtype = numpy.int64)
+		columns = numpy.asarray(columns, dtype = numpy.int64)
+		if len(self._values) == 0:
+			return numpy.zeros((len(rows), len(columns)), dtype = self.dtype)
+		# The position of (i, j) is `offsets[i] - i - 1 + j` for i < j.
+		shifted = distance_engine.get_row_offsets(len(self.labels)) - numpy.arange(len(self.labels)) - 1
+		is_upper = rows[:, numpy.newaxis] < columns[numpy.newaxis, :]
+		indices = numpy.where(is_upper, shifted[rows][:, numpy.newaxis] + columns, shifted[columns] + rows[:, numpy.newaxis])
+		diagonal = rows[:, numpy.newaxis] == columns[numpy.newaxis, :]
+		# Diagonal positions are not valid pairs.
+		indices[diagonal] = 0
+		block = self._values[indices]
+		block[diagonal | numpy.isnan(block)] = 0
+		return block
+
+	def save_squareform(self, filename: Path, delimiter: str = '\t'):
+		"""
+			Writes the square distance matrix to a delimited table one row at a time. The table is identical to
+			`self.squareform().to_csv(filename, sep = delimiter)` but the square matrix is never held in memory.
+		"""
+		with open(filename, 'w', newline = '') as output:
+			writer = csv.writer(output, delimiter = delimiter, lineterminator = '\n')
+			writer.writerow([''] + list(self.labels))
+			for label in self.labels:
+				writer.writerow([label] + self.get_row(label).tolist())
 
 	def get(self, left, right, default = None) -> float:
 		try:
-			result = self.pairwise_values[left, right]
+			position = self._get_position(left, right)
 		except KeyError:
-			result = self.pairwise_values.get((right, left), default)
-		return result
+			return default
+		if position is None:
+			return 0.0
+		result = self._values[position]
+		if result != result:  # NaN
+			return default
+		return float(result)
 
 	def reduce(self, labels: Iterable[str]) -> 'DistanceCache':
 		"""
-			Removes all labels from `self.pairwise_values` that are not present in `labels`
+			Removes all labels that are not present in `labels`
 		"""
 		labels = set(labels)
-		pair_array = {
-			k: v for k, v in self.pairwise_values.items()
-			if (k[0] in labels and k[1] in labels)
-		}
-		self.pairwise_values = pair_array
+		if labels.issuperset(self.labels):
+			return self
+		positions = numpy.array([i for i, label in enumerate(self.labels) if label in labels], dtype = numpy.int64)
+		indices = self._get_subset_indices(positions)
+		self._values = self._values[indices]
+		if self.missing is not None:
+			self.missing = numpy.packbits(distance_engine.get_missing_distances(self.missing, indices))
+		self._set_labels([self.labels[i] for i in positions])
+		return self
+
+	def _get_subset_indices(self, positions: numpy.ndarray) -> numpy.ndarray:
+		""" The positions in the condensed vector of the pairs between the labels at `positions`, which must be in ascending order."""
+		total = len(positions)
+		if total < 2:
+			return numpy.empty(0, dtype = numpy.int64)
+		left, right = distance_engine.condensed_index_to_pairs(numpy.arange(total * (total - 1) // 2), total)
+		return distance_engine.pairs_to_condensed_index(positions[left], positions[right], len(self.labels))
+
+	def _get_subset(self, positions: numpy.ndarray) -> numpy.ndarray:
+		""" Returns the condensed vector for the labels at `positions`, which must be in ascending order."""
+		return self._values[self._get_subset_indices(positions)]
+
+	def _add_labels(self, labels: Iterable[str]):
+		""" Adds new labels to the cache. The existing values are moved to match the new (sorted) label order."""
+		new_labels = [i for i in set(labels) if i not in self.index]
+		if not new_labels:
+			return
+		labels = _sort_labels(self.labels + new_labels)
+		total = len(labels)
+		values = numpy.full(total * (total - 1) // 2, numpy.nan, dtype = self.dtype)
+		missing = numpy.zeros(len(values), dtype = bool) if self.missing is not None else None
+		if len(self._values):
+			new_index = {label: position for position, label in enumerate(labels)}
+			positions = numpy.array([new_index[i] for i in self.labels], dtype = numpy.int64)
+			left, right = distance_engine.condensed_index_to_pairs(numpy.arange(len(self._values)), len(self.labels))
+			indices = distance_engine.pairs_to_condensed_index(positions[left], positions[right], total)
+			values[indices] = self._values
+			if missing is not None:
+				missing[indices] = distance_engine.get_missing_distances(self.missing, numpy.arange(len(self._values)))
+		self._values = values
+		if missing is not None:
+			self.missing = numpy.packbits(missing)
+		self._set_labels(labels)
+
+	def add_labels(self, labels: Iterable[str]) -> numpy.ndarray:
+		"""
+			Adds `labels` to the cache without any values. Use `set_pairs` to assign the distances of the new pairs.
+		Returns
+		-------
+		numpy.ndarray
+			The positions of the added labels in `self.labels`.
+		"""
+		labels = [i for i in dict.fromkeys(labels) if i not in self.index]
+		self._add_labels(labels)
+		return numpy.array(sorted(self.index[i] for i in labels), dtype = numpy.int64)
+
+	def set_pairs(self, left: numpy.ndarray, right: numpy.ndarray, values: numpy.ndarray) -> 'DistanceCache':
+		""" Assigns the distance between the labels at positions `left` and `right` of `self.labels`. Either orientation can be used."""
+		left = numpy.asarray(left, dtype = numpy.int64)
+		right = numpy.asarray(right, dtype = numpy.int64)
+		indices = distance_engine.pairs_to_condensed_index(left, right, len(self.labels))
+		self._values[indices] = values
+		self._clear_missing(indices)
+		return self
+
+	def _clear_missing(self, indices: numpy.ndarray):
+		""" Removes the pairs at `indices` from `self.missing` after they are assigned a value."""
+		if self.missing is not None and len(indices):
+			indices = numpy.asarray(indices, dtype = numpy.int64)
+			masks = ~numpy.left_shift(1, 7 - (indices & 7)).astype(numpy.uint8)
+			numpy.bitwise_and.at(self.missing, indices >> 3, masks)
+
+	def restore_missing(self) -> 'DistanceCache':
+		""" Removes the maximum distance assigned to the pairs in `self.missing`, so they are treated as pairs without a value."""
+		if self.missing is not None:
+			for start, stop in distance_engine.iterate_chunks(len(self._values)):
+				chunk = self._values[start:stop]
+				chunk[distance_engine.get_missing_distances(self.missing, numpy.arange(start, stop))] = numpy.nan
+		return self
+
+	def replace_missing(self) -> 'DistanceCache':
+		"""
+			Assigns the maximum distance to every pair without a value, including the pairs in `self.missing` which were
+			assigned the maximum distance of a previous set of pairs. See `distance_engine.replace_missing_distances`.
+		"""
+		self.restore_missing()
+		self.missing = distance_engine.find_missing_distances(self._values)
+		distance_engine.replace_missing_distances(self._values)
 		return self
 
 	def update(self, pair_array: PairwiseArrayType) -> 'DistanceCache':
+		self._add_labels(label for pair in pair_array.keys() for label in pair)
 		for (left, right), value in pair_array.items():
-			self.pairwise_values[left, right] = value
-			self.pairwise_values[right, left] = value
+			position = self._get_position(left, right)
+			if position is not None:
+				self._values[position] = value
+				self._clear_missing([position])
 		return self
 
+	def set_group(self, labels: Iterable[str], value: float = 0) -> List[str]:
+		"""
+			Sets the distance between every pair of `labels` to `value` directly in the condensed vector.
+			Labels which are not in the cache are ignored.
+		Returns
+		-------
+		List[str]
+			The labels which were not found.
+		"""
+		labels = list(labels)
+		missing = [i for i in labels if i not in self.index]
+		positions = numpy.array(sorted({self.index[i] for i in labels if i in self.index}), dtype = numpy.int64)
+		if len(positions) > 1:
+			left, right = distance_engine.condensed_index_to_pairs(numpy.arange(len(positions) * (len(positions) - 1) // 2), len(positions))
+			indices = distance_engine.pairs_to_condensed_index(positions[left], positions[right], len(self.labels))
+			self._values[indices] = value
+			self._clear_missing(indices)
+		return missing
+
+	def copy(self, filename: Optional[Path] = None) -> 'DistanceCache':
+		""" Returns a copy of the cache, with the distances written to a memory-mapped file at `filename` if given."""
+		cache = self.__class__(dtype = self.dtype)
+		if filename is None:
+			cache._values = self._values.copy()
+		else:
+			cache._values = numpy.lib.format.open_memmap(str(filename), mode = 'w+', dtype = self.dtype, shape = self._values.shape)
+			for start, stop in distance_engine.iterate_chunks(len(self._values)):
+				cache._values[start:stop] = self._values[start:stop]
+		cache._set_labels(list(self.labels))
+		cache.parameters = dict(self.parameters)
+		cache.missing = None if self.missing is None else self.missing.copy()
+		return cache
+
 	def unique(self) -> List[Tuple[str, str]]:
-		seen = set()
-		for key in sorted(self.pairwise_values.keys()):
-			if key in seen or key[::-1] in seen:
-				continue
-			else:
-				seen.add(key)
-				yield key
+		for start, stop in distance_engine.iterate_chunks(len(self._values)):
+			indices = start + numpy.flatnonzero(~numpy.isnan(self._values[start:stop]))
+			left, right = distance_engine.condensed_index_to_pairs(indices, len(self.labels))
+			for l, r in zip(left.tolist(), right.tolist()):
+				yield self.labels[l], self.labels[r]
 
 	def save(self, filename: Path):
 		with filename.open('w') as output:
@@ -97,27 +365,116 @@ class DistanceCache:
 				output.write(line)
 
 	@property
-	def values(self)->List[float]:
-		return list(self.pairwise_values.values())
+	def values(self) -> List[float]:
+		""" The distance for both orientations of every pair, as in the original dict-based implementation."""
+		values = self._values[self.defined()].tolist()
+		return values + values
+
+	def save_binary(self, filename: Path):
+		"""
+			Saves the labels, the condensed distance vector, `self.parameters` and `self.missing` as a `.npz` file. This is
+			much faster to read than the text-based tables.
+		"""
+		arrays = dict()
+		if self.missing is not None:
+			arrays['missing'] = self.missing
+		with open(filename, 'wb') as output:
+			numpy.savez(
+				output,
+				labels = numpy.array([str(i) for i in self.labels]),
+				values = self._values,
+				parameters = numpy.array(json.dumps(self.parameters, sort_keys = True)),
+				**arrays
+			)
+
+	@classmethod
+	def read_binary(cls, filename: Path, parameters: Optional[Dict[str, Any]] = None) -> 'DistanceCache':
+		"""
+			Reads a file generated by `save_binary`.
+		Parameters
+		----------
+		filename: Path
+		parameters: Optional[Dict[str,Any]]
+			The parameters expected for the current analysis. A `ValueError` is raised if any of these do not match the
+			parameters saved with the distances.
+		"""
+		with numpy.load(filename, allow_pickle = False) as data:
+			saved_parameters = json.loads(str(data['parameters']))
+			if parameters:
+				mismatched = [key for key, value in parameters.items() if saved_parameters.get(key) != value]
+				if mismatched:
+					message = ", ".join(f"{key} ({saved_parameters.get(key)} != {parameters[key]})" for key in mismatched)
+					message = f"The pairwise distances in '{filename}' were calculated using different parameters: {message}"
+					raise ValueError(message)
+			missing = data['missing'] if 'missing' in data.files else None
+			cache = cls.from_condensed(data['labels'].tolist(), data['values'], missing = missing)
+		cache.parameters = saved_parameters
+		return cache
 
 	@classmethod
 	def read(cls, filename: Path) -> 'DistanceCache':
-		contents = filename.read_text().split('\n')
-		contents = [i.split('\t') for i in contents]
-		data = dict()
-		for line in contents:
-			left, right, value = line
-			value = float(value)
-			data[left, right] = value
-			data[right, left] = value
-		return DistanceCache(data)
+		table = pandas.read_csv(filename, sep = '\t', header = None, names = ['left', 'right', 'value'], dtype = str, na_filter = False)
+		return cls.from_pairs(table['left'].tolist(), table['right'].tolist(), table['value'].astype(float).values)
+
+	@classmethod
+	def from_pairs(cls, left: List[str], right: List[str], values: numpy.ndarray, dtype = numpy.float64) -> 'DistanceCache':
+		""" Builds the cache from parallel sequences of labels and values. Only one orientation of each pair is required."""
+		cache = cls(dtype = dtype)
+		labels = _sort_labels(set(left) | set(right))
+		cache._set_labels(labels)
+		total = len(labels)
+		cache._values = numpy.full(total * (total - 1) // 2, numpy.nan, dtype = cache.dtype)
+
+		left = numpy.array([cache.index[i] for i in left], dtype = numpy.int64)
+		right = numpy.array([cache.index[i] for i in right], dtype = numpy.int64)
+		values = numpy.asarray(values)
+		use = left != right
+		cache._values[distance_engine.pairs_to_condensed_index(left[use], right[use], total)] = values[use]
+		return cache
+
+	@classmethod
+	def from_condensed(cls, labels: List[str], values: numpy.ndarray, dtype = numpy.float64,
+			missing: Optional[numpy.ndarray] = None) -> 'DistanceCache':
+		"""
+			Builds the cache from an existing condensed distance vector, such as the output of `DistanceEngine.run`.
+			The vector is used directly when the labels are already sorted.
+		Parameters
+		----------
+		labels: List[str]
+			The label for each row of the square matrix represented by `values`.
+		values: numpy.ndarray
+			The condensed distance vector.
+		dtype: numpy.dtype
+		missing: Optional[numpy.ndarray]
+			The pairs of `values` which were assigned the maximum distance. See `DistanceCache.missing`.
+		"""
+		cache = cls(dtype = dtype)
+		labels = list(labels)
+		values = numpy.asanyarray(values)
+		if values.dtype != cache.dtype:
+			values = values.astype(cache.dtype)
+		if len(values) != len(labels) * (len(labels) - 1) // 2:
+			message = f"Expected {len(labels) * (len(labels) - 1) // 2} values for {len(labels)} labels, got {len(values)}"
+			raise ValueError(message)
+
+		sorted_labels = _sort_labels(labels)
+		cache._set_labels(labels)
+		cache._values = values
+		cache.missing = missing
+		if sorted_labels != labels:
+			# Reorder the values so the labels are sorted, the same order used by the dict-based constructor.
+			positions = numpy.array([cache.index[i] for i in sorted_labels], dtype = numpy.int64)
+			total = len(labels)
+			left, right = distance_engine.condensed_index_to_pairs(numpy.arange(len(values)), total)
+			indices = distance_engine.pairs_to_condensed_index(positions[left], positions[right], total)
+			cache._values = values[indices]
+			if missing is not None:
+				cache.missing = numpy.packbits(distance_engine.get_missing_distances(missing, indices))
+			cache._set_labels(sorted_labels)
+		return cache
 
 	@classmethod
-	def from_squareform(cls, square:pandas.DataFrame)->'DistanceCache':
-		data = dict()
-
-		for left, row in square.iterrows():
-			for right, value in row.items():
-				data[left,right] = value
-				data[right,left] = value
-		return DistanceCache(data)
+	def from_squareform(cls, square: pandas.DataFrame) -> 'DistanceCache':
+		# noinspection PyTypeChecker
+		values = distance.squareform(square.values, checks = False)
+		return cls.from_condensed(list(square.index), values)
@@ -1,6 +1,5 @@
 import itertools
 import math
-import multiprocessing
 from typing import Dict, Generator, List, Optional, Tuple
 
 import pandas
@@ -8,10 +7,12 @@ from loguru import logger
 from tqdm import tqdm
 
 try:
-	from muller.clustering.metrics import distance_methods
+	from muller.clustering.metrics import distance_engine, distance_methods
+	from muller.clustering.metrics.trajectory_features import TrajectoryFeatures
 	from muller import widgets
 except ModuleNotFoundError:
-	from . import distance_methods
+	from . import distance_engine, distance_methods
+	from .trajectory_features import TrajectoryFeatures
 	from ... import widgets
 
 FilterType = Tuple[Optional[pandas.Series], Optional[pandas.Series]]
@@ -24,26 +25,25 @@ class DistanceCalculator:
 		self.detection_limit = detection_limit
 		self.fixed_limit = fixed_limit
 		self.metric = metric
+		# Looked up once so each pair does not have to dispatch on the metric name.
+		self.distance_metric = distance_methods.get_metric(metric)
 		self.threads = threads
 		# Basically used as a cache. Should save memory compared to loading each pair of trajectories directly into `pair_combinations`.
 		self.trajectories: Optional[pandas.DataFrame] = None
+		# Precomputed features of each trajectory used to categorize each pair. Generated in `self.run`.
+		self.features: Optional[TrajectoryFeatures] = None
 
 		self.progress_bar_minimum_points = 10000  # The value to activate the scale bar at.
 
-	def calculate_pairwise_distances_threaded(self, pair_combinations: Generator, total: Optional[int] = None) -> Dict[
-		Tuple[str, str], float]:
-		""" Threaded version of the pairwise distance calculator"""
-		pair_array: Dict[Tuple[str, str], float] = dict()
-		progress_bar = tqdm(total = total)
-		pool = multiprocessing.Pool(processes = self.threads)
-		for i in tqdm(
-				[pool.apply_async(calculate_distance, args = (self, e, self.trajectories)) for e in pair_combinations]):
-			key, value = i.get()  # retrieve the calculated value
-			pair_array[key] = value
-			pair_array[key[::-1]] = value
-			progress_bar.update(1)
-
-		return pair_array
+	def calculate_pairwise_distances_threaded(self, labels: List[str]) -> Dict[Tuple[str, str], float]:
+		"""
+			Threaded version of the pairwise distance calculator. The pairs are split into contiguous blocks which are
+			computed by `DistanceEngine` in a process pool rather than submitting each pair as a separate task.
+		"""
+		engine = distance_engine.DistanceEngine(self.detection_limit, self.fixed_limit, self.metric, threads = self.threads)
+		engine.load(self.trajectories.loc[labels])
+		distances = engine.calculate_condensed()
+		return distance_engine.to_pair_array(engine.labels, distances)
 
 	def calculate_pairwise_distances_serial(self, pair_combinations: Generator, total: Optional[int] = None):
 		""" Nonthreaded version of the pairwise distance calculator"""
@@ -86,7 +86,7 @@ class DistanceCalculator:
 
 		if self.threads and self.threads > 1:  # One process is slower than using the serial method.
 			logger.debug(f"Using multithreading...")
-			pair_array = self.calculate_pairwise_distances_threaded(pair_combinations, total_combinations)
+			pair_array = self.calculate_pairwise_distances_threaded(labels)
 		else:
 			logger.debug(f"Using a single thread...")
 			pair_array = self.calculate_pairwise_distances_serial(pair_combinations, total_combinations)
@@ -123,6 +123,7 @@ class DistanceCalculator:
 		logger.debug(f"\t threads: {self.threads}")
 
 		self.trajectories = trajectories
+		self.features = TrajectoryFeatures(self.detection_limit, self.fixed_limit).load(trajectories)
 
 		pairwise_distances = self.calculate_pairwise_distances(trajectories.index)
 
@@ -279,15 +280,24 @@ def calculate_distance(process: DistanceCalculator, element: Tuple[str, str], tr
 	# For now, lets require that both timepoints are detected and not yet fixed.
 	# There is an issue related to comparing fixed genotypes against non-fixed genotypes.
 
-	left_reduced, right_reduced = filter_timepoints(
-		left_trajectory, right_trajectory, process.detection_limit, process.fixed_limit
-	)
+	if process.features is not None:
+		window = process.features.get_pair_window(left, right)
+		if window is None:
+			left_reduced = right_reduced = None
+		else:
+			start, stop = window
+			left_reduced = left_trajectory.iloc[start:stop]
+			right_reduced = right_trajectory.iloc[start:stop]
+	else:
+		left_reduced, right_reduced = filter_timepoints(
+			left_trajectory, right_trajectory, process.detection_limit, process.fixed_limit
+		)
 
 	if left_reduced is None or right_reduced is None:
 		# Treat both trajectories as fixed immediately.
 		distance_between_series = fixed_overlap(left_trajectory, right_trajectory, process.fixed_limit)
 	else:
-		distance_between_series = distance_methods.calculate_distance(left_reduced, right_reduced, process.metric)
+		distance_between_series = process.distance_metric.scalar(left_reduced, right_reduced)
 
 	return element, distance_between_series
 
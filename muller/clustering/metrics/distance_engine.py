@@ -0,0 +1,472 @@
+"""
+	Array-based implementation of the pairwise distance calculations.
+	The trajectory table is loaded once as a 2-D float array and the distances are computed for blocks of pairs at a time,
+	so the per-pair pandas overhead of `DistanceCalculator` is avoided. Pairs are addressed by their position in the condensed
+	distance vector (the same ordering as `itertools.combinations(labels, 2)` and `scipy.spatial.distance.squareform`).
+"""
+import math
+import multiprocessing
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+
+import numpy
+import pandas
+from loguru import logger
+from tqdm import tqdm
+
+try:
+	from multiprocessing import shared_memory
+except ImportError:
+	# Python < 3.8. Each worker receives a copy of the trajectory array instead.
+	shared_memory = None
+
+try:
+	from muller.clustering.metrics import distance_methods
+	from muller.clustering.metrics.pair_signatures import PRUNABLE_METRICS, PairSignatures
+	from muller.clustering.metrics.trajectory_features import (CATEGORY_BOTH_FIXED, CATEGORY_NOT_FIXED, CATEGORY_ONE_FIXED,
+		CATEGORY_ONLY_FIXED, CATEGORY_PARTIALLY_FIXED, TrajectoryFeatures)
+except ModuleNotFoundError:
+	from . import distance_methods
+	from .pair_signatures import PRUNABLE_METRICS, PairSignatures
+	from .trajectory_features import (CATEGORY_BOTH_FIXED, CATEGORY_NOT_FIXED, CATEGORY_ONE_FIXED, CATEGORY_ONLY_FIXED,
+		CATEGORY_PARTIALLY_FIXED, TrajectoryFeatures)
+
+# The number of elements processed at once when scanning the full condensed vector.
+CHUNK_SIZE = 2 ** 22
+# Assigned to the pairs which are guaranteed to be farther apart than `DistanceEngine.prune_bound`.
+PRUNED_DISTANCE = math.inf
+
+
+def get_row_offsets(n: int) -> numpy.ndarray:
+	""" Returns the position in the condensed vector of the first pair of each row."""
+	rows = numpy.arange(n, dtype = numpy.int64)
+	return rows * n - (rows * (rows + 1)) // 2
+
+
+def condensed_index_to_pairs(indices: numpy.ndarray, n: int, offsets: Optional[numpy.ndarray] = None) -> Tuple[numpy.ndarray, numpy.ndarray]:
+	"""
+		Converts positions in a condensed distance vector into the row and column indices of the pairs they represent.
+	Parameters
+	----------
+	indices: numpy.ndarray
+		Positions within the condensed vector.
+	n: int
+		The number of observations.
+	offsets: Optional[numpy.ndarray]
+		Precomputed output of `get_row_offsets(n)`.
+	"""
+	if offsets is None:
+		offsets = get_row_offsets(n)
+	indices = numpy.asarray(indices, dtype = numpy.int64)
+	left = numpy.searchsorted(offsets, indices, side = 'right') - 1
+	right = indices - offsets[left] + left + 1
+	return left, right
+
+
+def pairs_to_condensed_index(left: numpy.ndarray, right: numpy.ndarray, n: int) -> numpy.ndarray:
+	""" Converts row/column indices into positions in the condensed vector. The order of each pair does not matter."""
+	left = numpy.asarray(left, dtype = numpy.int64)
+	right = numpy.asarray(right, dtype = numpy.int64)
+	low = numpy.minimum(left, right)
+	high = numpy.maximum(left, right)
+	return low * n - (low * (low + 1)) // 2 + (high - low - 1)
+
+
+def iterate_chunks(total: int, chunk_size: int = CHUNK_SIZE):
+	""" Yields the [`start`, `stop`) bounds of consecutive chunks of an array with `total` elements."""
+	for start in range(0, total, chunk_size):
+		yield start, min(start + chunk_size, total)
+
+
+def find_missing_distances(values: numpy.ndarray) -> numpy.ndarray:
+	"""
+		Records which pairs are NaN as a packed bit array (see `numpy.packbits`), so the pairs assigned the maximum distance
+		by `replace_missing_distances` can be restored later. Uses 1/64th of the memory of the distances.
+	"""
+	# `CHUNK_SIZE` is a multiple of 8, so the packed chunks line up.
+	return numpy.concatenate([numpy.packbits(numpy.isnan(values[start:stop])) for start, stop in iterate_chunks(len(values))] or [numpy.empty(0, dtype = numpy.uint8)])
+
+
+def get_missing_distances(missing: numpy.ndarray, indices: numpy.ndarray) -> numpy.ndarray:
+	""" Whether the pairs at `indices` of the condensed vector are marked in the output of `find_missing_distances`."""
+	indices = numpy.asarray(indices, dtype = numpy.int64)
+	return ((missing[indices >> 3] >> (7 - (indices & 7))) & 1).astype(bool)
+
+
+def replace_missing_distances(values: numpy.ndarray) -> numpy.ndarray:
+	"""
+		Assumes that any pair with NAN values are the maximum possible distance from each other. Modifies `values` in place.
+		The array is processed in chunks so that memory-mapped arrays are never loaded into memory all at once.
+	"""
+	maximum = None
+	missing = False
+	for start, stop in iterate_chunks(len(values)):
+		chunk = values[start:stop]
+		chunk_missing = numpy.isnan(chunk)
+		if chunk_missing.all():
+			missing = True
+			continue
+		missing |= bool(chunk_missing.any())
+		chunk_maximum = numpy.nanmax(chunk)
+		maximum = chunk_maximum if maximum is None else max(maximum, chunk_maximum)
+
+	if maximum is None:
+		message = f"Could not calculate the pairwise distances due to invalid series (usually because all measurements are below the detectionlimit"
+		raise ValueError(message)
+	if missing:
+		for start, stop in iterate_chunks(len(values)):
+			chunk = values[start:stop]
+			chunk[numpy.isnan(chunk)] = maximum
+	return values
+
+
+def to_pair_array(labels: List[str], values: numpy.ndarray) -> dict:
+	""" Converts a condensed distance vector into the `{(left, right): value}` mapping used by `DistanceCalculator`."""
+	n = len(labels)
+	left, right = condensed_index_to_pairs(numpy.arange(len(values)), n)
+	pair_array = dict()
+	for l, r, value in zip(left.tolist(), right.tolist(), values.tolist()):
+		pair_array[labels[l], labels[r]] = value
+		pair_array[labels[r], labels[l]] = value
+	return pair_array
+
+
+class DistanceEngine:
+	"""
+		Computes the pairwise distances between all trajectories using array operations. The results should be identical
+		(within floating-point tolerance) to `DistanceCalculator.run`.
+
+		Usage
+		-----
+		engine = DistanceEngine(0.03, 0.97, 'binomial')
+		labels, distances = engine.run(trajectories) # `distances` is a condensed vector.
+	Parameters
+	----------
+	detection_limit, fixed_limit: float
+	metric: str
+		Any metric registered with `distance_methods.register_metric`. Metrics without a batch kernel are computed
+		pair-by-pair on the same timepoint windows.
+	block_size: Optional[int]
+		The number of pairs to compute at once. Defaults to a value which keeps each intermediate array at ~1M elements.
+	threads: Optional[int]
+		The number of processes to use. The condensed vector is split into contiguous blocks of pairs which are
+		distributed to a process pool. Each worker reads the trajectory array from shared memory and the blocks are
+		written back in order, so the result does not depend on the number of processes.
+	area_backend: str
+		Used by the 'jaccard' metric. 'numeric' integrates each pair with `area_engine`, while 'shapely' uses the
+		polygon-based `distance_methods.jaccard_distance` for each pair.
+	prune_bound: Optional[float]
+		If given, the pairs whose signatures (see `PairSignatures`) guarantee a distance above this bound are not
+		calculated and are assigned `PRUNED_DISTANCE` instead. `run` replaces them with the maximum distance.
+	verify_pruning: bool
+		Also calculates the pruned pairs and checks that each is farther apart than `prune_bound`. Any pair which is not
+		is logged and assigned its actual distance.
+	"""
+	def __init__(self, detection_limit: float, fixed_limit: float, metric: str, block_size: Optional[int] = None,
+			threads: Optional[int] = None, area_backend: str = 'numeric', prune_bound: Optional[float] = None,
+			verify_pruning: bool = False):
+		self.detection_limit = detection_limit
+		self.fixed_limit = fixed_limit
+		self.metric = metric
+		# The metric is looked up once rather than for every block of pairs.
+		self.distance_metric = distance_methods.get_metric(metric)
+		self.block_size = block_size
+		self.threads = threads
+		self.area_backend = area_backend
+		self.progress_bar_minimum_points = 10000
+
+		self.labels: List[str] = list()
+		self.columns: List = list()
+		self.values: Optional[numpy.ndarray] = None
+		self.offsets: Optional[numpy.ndarray] = None
+		# Used to categorize each pair and select the timepoints to compare.
+		self.features = TrajectoryFeatures(detection_limit, fixed_limit)
+
+		self.prune_bound = prune_bound
+		self.verify_pruning = verify_pruning
+		self.signatures: Optional[PairSignatures] = None
+		if prune_bound is not None and metric not in PRUNABLE_METRICS:
+			logger.warning(f"Pairs cannot be pruned with the '{metric}' metric. Every pair will be calculated.")
+		# The number of pairs pruned and the number of pruned pairs which failed verification during the last calculation.
+		self.statistics = {'pruned': 0, 'violations': 0}
+		# The pairs which were assigned the maximum distance by `run`. See `find_missing_distances`.
+		self.missing: Optional[numpy.ndarray] = None
+
+	def __len__(self) -> int:
+		return len(self.labels)
+
+	@property
+	def total_pairs(self) -> int:
+		n = len(self.labels)
+		return n * (n - 1) // 2
+
+	@property
+	def is_pruning(self) -> bool:
+		""" Whether pairs farther apart than `prune_bound` are skipped and assigned the maximum distance."""
+		return self.prune_bound is not None and self.metric in PRUNABLE_METRICS
+
+	def load(self, trajectories: pandas.DataFrame) -> 'DistanceEngine':
+		""" Converts the trajectory table into the arrays used for every block of pairs."""
+		values = numpy.ascontiguousarray(trajectories.values, dtype = float)
+		return self.load_array(list(trajectories.index), list(trajectories.columns), values)
+
+	def load_array(self, labels: List[str], columns: List, values: numpy.ndarray) -> 'DistanceEngine':
+		"""
+			Same as `load`, but uses an existing 2-D float array of trajectory values directly. Used by the worker processes
+			to avoid copying the array held in shared memory.
+		"""
+		self.labels = list(labels)
+		self.columns = list(columns)
+		self.values = values
+		self.offsets = get_row_offsets(len(self.labels))
+
+		self.features.load_array(self.labels, self.columns, values)
+		if self.is_pruning:
+			self.signatures = PairSignatures(self.metric).load(self.features, values)
+
+		return self
+
+	def get_block_size(self) -> int:
+		if self.block_size:
+			return self.block_size
+		return max(1, 2 ** 20 // max(1, len(self.columns)))
+
+	def categorize(self, left: numpy.ndarray, right: numpy.ndarray) -> numpy.ndarray:
+		""" Array version of `distance_calculator.get_pair_category`."""
+		return self.features.categorize(left, right)
+
+	def get_windows(self, left: numpy.ndarray, right: numpy.ndarray, category: numpy.ndarray) -> numpy.ndarray:
+		"""
+			Array version of `distance_calculator.filter_timepoints`. Returns a boolean mask of the timepoints
+			each pair of trajectories should be compared over.
+		"""
+		return self.features.get_windows(left, right, category)
+
+	def calculate_fixed_overlap(self, left: numpy.ndarray, right: numpy.ndarray) -> numpy.ndarray:
+		""" Array version of `distance_calculator.fixed_overlap`."""
+		fixed_left = self.features.mask_fixed[left]
+		fixed_right = self.features.mask_fixed[right]
+		overlap = fixed_left.any(axis = 1) & fixed_right.any(axis = 1) & (fixed_left == fixed_right).all(axis = 1)
+		return numpy.where(overlap, 0.0, math.nan)
+
+	def calculate_window_distances(self, left: numpy.ndarray, right: numpy.ndarray, window: numpy.ndarray) -> numpy.ndarray:
+		""" Computes the selected metric for each pair using only the timepoints within `window`."""
+		windows = distance_methods.PairWindows(self.values[left], self.values[right], window, self.columns)
+		if self.metric == 'jaccard' and self.area_backend != 'numeric':
+			return self.distance_metric.calculate_scalar(windows)
+		return self.distance_metric.calculate(windows)
+
+	def calculate_pairs(self, left: numpy.ndarray, right: numpy.ndarray, prune: bool = True) -> numpy.ndarray:
+		"""
+			Calculates the distance between the trajectories at the given row indices. Pairs which cannot be compared are
+			returned as NaN and are not replaced by the maximum distance. Pairs which were pruned are `PRUNED_DISTANCE`.
+		"""
+		left = numpy.asarray(left, dtype = numpy.int64)
+		right = numpy.asarray(right, dtype = numpy.int64)
+		category = self.categorize(left, right)
+		result = numpy.empty(len(left))
+
+		only_fixed = category == CATEGORY_ONLY_FIXED
+		if only_fixed.any():
+			result[only_fixed] = self.calculate_fixed_overlap(left[only_fixed], right[only_fixed])
+
+		compared = ~only_fixed
+		if prune and self.signatures is not None and compared.any():
+			pruned = numpy.zeros(len(left), dtype = bool)
+			pruned[compared] = self.signatures.calculate_lower_bounds(left[compared], right[compared], category[compared]) > self.prune_bound
+			result[pruned] = PRUNED_DISTANCE
+			compared &= ~pruned
+		if compared.any():
+			left_compared = left[compared]
+			right_compared = right[compared]
+			window = self.get_windows(left_compared, right_compared, category[compared])
+			with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+				result[compared] = self.calculate_window_distances(left_compared, right_compared, window)
+		return result
+
+	def calculate_block(self, start: int, stop: int) -> numpy.ndarray:
+		""" Calculates the distances for the pairs at positions [`start`, `stop`) of the condensed vector."""
+		left, right = condensed_index_to_pairs(numpy.arange(start, stop), len(self.labels), self.offsets)
+		return self.calculate_pairs(left, right)
+
+	def iterate_rows(self, rows: numpy.ndarray) -> Iterator[Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]]:
+		"""
+			Calculates the distance between each trajectory at `rows` and every other trajectory, one block of pairs at
+			a time. Each pair is only calculated once. Yields the row indices of each pair and their distances.
+		"""
+		rows = numpy.unique(numpy.asarray(rows, dtype = numpy.int64))
+		selected = numpy.zeros(len(self.labels), dtype = bool)
+		selected[rows] = True
+		block_size = self.get_block_size()
+		left = list()
+		right = list()
+		total = 0
+		for row in rows:
+			# Pairs between two selected rows are only used once, by the lower row.
+			others = numpy.flatnonzero(~selected | (numpy.arange(len(self.labels)) > row))
+			left.append(numpy.full(len(others), row, dtype = numpy.int64))
+			right.append(others)
+			total += len(others)
+			if total >= block_size or row == rows[-1]:
+				left = numpy.concatenate(left)
+				right = numpy.concatenate(right)
+				yield left, right, self.calculate_pairs(left, right)
+				left, right, total = list(), list(), 0
+
+	def get_blocks(self) -> List[Tuple[int, int]]:
+		""" Splits the condensed vector into contiguous [`start`, `stop`) blocks of pairs."""
+		total = self.total_pairs
+		block_size = self.get_block_size()
+		if self.threads and self.threads > 1:
+			# Make sure every process has several blocks to work on so the load stays balanced.
+			block_size = max(1, min(block_size, math.ceil(total / (4 * self.threads))))
+		return [(start, min(start + block_size, total)) for start in range(0, total, block_size)]
+
+	def verify_block(self, start: int, block: numpy.ndarray) -> numpy.ndarray:
+		""" Calculates the pruned pairs in `block` and replaces any which are within `prune_bound`. Modifies `block` in place."""
+		pruned = numpy.flatnonzero(block == PRUNED_DISTANCE)
+		if len(pruned) == 0:
+			return block
+		left, right = condensed_index_to_pairs(start + pruned, len(self.labels), self.offsets)
+		values = self.calculate_pairs(left, right, prune = False)
+		# Pairs which cannot be compared are assigned the maximum distance, so pruning them is lossless.
+		violations = values <= self.prune_bound
+		if violations.any():
+			self.statistics['violations'] += int(violations.sum())
+			for l, r, value in zip(left[violations], right[violations], values[violations]):
+				logger.error(f"The pair ({self.labels[l]}, {self.labels[r]}) was pruned but has a distance of {value}")
+			block[pruned[violations]] = values[violations]
+		return block
+
+	def iterate_blocks(self) -> Iterator[Tuple[int, int, numpy.ndarray]]:
+		"""
+			Calculates the distances one block of pairs at a time. Yields the [`start`, `stop`) position of each block
+			in the condensed vector and its distances, in order. Pairs which could not be compared are NaN.
+		"""
+		self.statistics = {'pruned': 0, 'violations': 0}
+		for start, stop, block in self._iterate_blocks():
+			if self.signatures is not None:
+				if self.verify_pruning:
+					self.verify_block(start, block)
+				self.statistics['pruned'] += int((block == PRUNED_DISTANCE).sum())
+			yield start, stop, block
+
+		if self.signatures is not None:
+			logger.info(f"Pruned {self.statistics['pruned']} of {self.total_pairs} pairs farther apart than {self.prune_bound}")
+			if self.verify_pruning:
+				logger.info(f"Pruning verification found {self.statistics['violations']} pairs within {self.prune_bound}")
+
+	def _iterate_blocks(self) -> Iterator[Tuple[int, int, numpy.ndarray]]:
+		blocks = self.get_blocks()
+
+		if self.threads and self.threads > 1 and len(blocks) > 1:
+			logger.debug(f"Using {self.threads} processes...")
+			yield from self._iterate_blocks_parallel(blocks)
+			return
+
+		if self.total_pairs >= self.progress_bar_minimum_points:
+			blocks = tqdm(blocks)
+		for start, stop in blocks:
+			yield start, stop, self.calculate_block(start, stop)
+
+	def _iterate_blocks_parallel(self, blocks: List[Tuple[int, int]]) -> Iterator[Tuple[int, int, numpy.ndarray]]:
+		""" Distributes the blocks of pairs to a process pool. `imap` yields the blocks in order, so the output is deterministic."""
+		parameters = (self.detection_limit, self.fixed_limit, self.metric, self.area_backend, self.prune_bound, self.labels, self.columns)
+		memory = None
+		if shared_memory is not None:
+			memory = shared_memory.SharedMemory(create = True, size = max(1, self.values.nbytes))
+			shared_values = numpy.ndarray(self.values.shape, dtype = self.values.dtype, buffer = memory.buf)
+			shared_values[:] = self.values
+			initargs = (parameters, (memory.name, self.values.shape, self.values.dtype.str))
+		else:
+			initargs = (parameters, self.values)
+
+		try:
+			with multiprocessing.Pool(processes = self.threads, initializer = _initialize_worker, initargs = initargs) as pool:
+				results = pool.imap(_calculate_worker_block, blocks)
+				if self.total_pairs >= self.progress_bar_minimum_points:
+					results = tqdm(results, total = len(blocks))
+				for (start, stop), block in zip(blocks, results):
+					yield start, stop, block
+		finally:
+			if memory is not None:
+				memory.close()
+				memory.unlink()
+
+	def calculate_condensed(self, output: Optional[numpy.ndarray] = None) -> numpy.ndarray:
+		""" Calculates the distance for every pair of trajectories. Pairs which could not be compared are left as NaN."""
+		if output is None:
+			output = numpy.empty(self.total_pairs)
+		for start, stop, block in self.iterate_blocks():
+			output[start:stop] = block
+		return output
+
+	def run(self, trajectories: pandas.DataFrame, filename: Optional[Path] = None, cache = None) -> Tuple[List[str], numpy.ndarray]:
+		"""
+			Calculates the distance between every pair of trajectories.
+		Parameters
+		----------
+		trajectories: pandas.DataFrame
+		filename: Optional[Path]
+			If given, the condensed vector is written directly to a memory-mapped `.npy` file at this location
+			rather than being held in memory. The returned array is the memory-mapped file.
+		cache: Optional[PersistentDistanceCache]
+			Reuses any pairs calculated in previous runs and saves the newly-calculated pairs.
+		Returns
+		-------
+		labels: List[str]
+			The trajectory labels, in the same order as the rows of the condensed vector.
+		distances: numpy.ndarray
+			The condensed distance vector. Pairs which could not be compared are assigned the maximum distance.
+		"""
+		logger.debug("Calculating the pairwise values...")
+		logger.debug(f"\t detection limit: {self.detection_limit}")
+		logger.debug(f"\t fixed limit: {self.fixed_limit}")
+		logger.debug(f"\t metric: {self.metric}")
+		self.load(trajectories)
+		logger.debug(f"Generating pairwise combinations with {len(self)} items resulting in {self.total_pairs} combinations...")
+		if filename and self.total_pairs:
+			logger.debug(f"Writing the pairwise distances to '{filename}'")
+			output = numpy.lib.format.open_memmap(str(filename), mode = 'w+', dtype = numpy.float64, shape = (self.total_pairs,))
+		else:
+			output = None
+		if cache is not None and self.signatures is not None:
+			logger.warning("The distance cache is not used when pruning pairs.")
+			cache = None
+		if cache is not None:
+			distances = cache.calculate(self, trajectories, output)
+		else:
+			distances = self.calculate_condensed(output)
+		if self.signatures is not None:
+			# The pruned pairs are assigned the maximum distance, the same as the pairs which could not be compared.
+			for start, stop in iterate_chunks(len(distances)):
+				chunk = distances[start:stop]
+				chunk[chunk == PRUNED_DISTANCE] = math.nan
+		self.missing = find_missing_distances(distances)
+		replace_missing_distances(distances)
+		if isinstance(distances, numpy.memmap):
+			distances.flush()
+		return self.labels, distances
+
+
+# The engine used by each worker process. Set by `_initialize_worker`.
+_worker_engine: Optional[DistanceEngine] = None
+_worker_memory = None
+
+
+def _initialize_worker(parameters: Tuple, values) -> None:
+	""" Attaches a worker process to the shared trajectory array. `values` is either the shared memory description or the array itself."""
+	global _worker_engine, _worker_memory
+	detection_limit, fixed_limit, metric, area_backend, prune_bound, labels, columns = parameters
+	if isinstance(values, tuple):
+		name, shape, dtype = values
+		_worker_memory = shared_memory.SharedMemory(name = name)
+		values = numpy.ndarray(shape, dtype = numpy.dtype(dtype), buffer = _worker_memory.buf)
+	_worker_engine = DistanceEngine(detection_limit, fixed_limit, metric, area_backend = area_backend, prune_bound = prune_bound)
+	_worker_engine.load_array(labels, columns, values)
+
+
+# Keep this as a separate function. Class methods are finicky when used with multiprocessing.
+def _calculate_worker_block(block: Tuple[int, int]) -> numpy.ndarray:
+	start, stop = block
+	return _worker_engine.calculate_block(start, stop)
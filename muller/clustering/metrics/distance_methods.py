@@ -1,13 +1,20 @@
 import math
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 
+import numpy
 import pandas
 from loguru import logger
+from scipy import special
 try:
+	from muller.inheritance import area_engine
 	from muller.inheritance.areascore import area_of_series, calculate_common_area
 except ModuleNotFoundError:
 	try:
+		from ...inheritance import area_engine
 		from ...inheritance.areascore import area_of_series, calculate_common_area
 	except ValueError:
+		from muller.inheritance import area_engine
 		from muller.inheritance.areascore import area_of_series, calculate_common_area
 
 
@@ -99,27 +106,190 @@ def jaccard_distance(left: pandas.Series, right: pandas.Series) -> float:
 	area_left = area_of_series(left)
 	area_right = area_of_series(right)
 	area_shared = calculate_common_area(left, right)
-	j = area_shared / (area_left + area_right - area_shared)
+	area_union = area_left + area_right - area_shared
+	if area_union == 0:
+		# Neither series has any area within the compared timepoints.
+		return math.nan
+	j = area_shared / area_union
 	return 1 - j
 
 
-def calculate_distance(left: pandas.Series, right: pandas.Series, metric: str) -> float:
-	if metric == 'binomial':
-		# default option so placed first to minimize equality calculations.
-		distance_between_series = binomial_distance(left, right)
-	elif metric == 'pearson':
-		distance_between_series = pearson_correlation_distance(left, right)
-	elif metric == 'minkowski':
-		distance_between_series = minkowski_distance(left, right)
-	elif metric == 'similarity' or metric == 'binomialp':
-		distance_between_series = binomial_probability(left, right)
-	elif metric == 'jaccard':
-		distance_between_series = jaccard_distance(left, right)
-	elif metric == "combined":
-		distance_between_series_pearson = pearson_correlation_distance(left, right)
-		distance_between_series_minkowski = minkowski_distance(left, right, 2)
-		distance_between_series = (2 * distance_between_series_pearson) + distance_between_series_minkowski
-	else:
-		message = f"'{metric}' is not an available metric."
+def combined_distance(left: pandas.Series, right: pandas.Series) -> float:
+	return (2 * pearson_correlation_distance(left, right)) + minkowski_distance(left, right, 2)
+
+
+class PairWindows:
+	"""
+		A block of pairs of trajectories and the timepoints each pair is compared over. Each row of `left` and `right` is
+		a separate pair and `window` is a boolean mask of the timepoints to use. The intermediates used by several metrics
+		and the distances calculated by `calculate` are saved, so a metric built from other metrics (such as 'combined')
+		reuses them rather than calculating them again.
+	Parameters
+	----------
+	left, right: numpy.ndarray
+		2-D arrays of the trajectory values of each pair.
+	window: numpy.ndarray
+		Boolean array with the same shape as `left`.
+	columns: Optional[List[Any]]
+		The timepoint of each column. Used as the index of the series passed to the scalar metrics.
+	"""
+
+	def __init__(self, left: numpy.ndarray, right: numpy.ndarray, window: numpy.ndarray, columns: Optional[List[Any]] = None):
+		self.left = left
+		self.right = right
+		self.window = window
+		self.columns = list(columns) if columns is not None else list(range(window.shape[1]))
+		self._cache: Dict[str, numpy.ndarray] = dict()
+
+	def __len__(self) -> int:
+		return len(self.window)
+
+	def _get(self, key: str, function: Callable[[], numpy.ndarray]) -> numpy.ndarray:
+		if key not in self._cache:
+			self._cache[key] = function()
+		return self._cache[key]
+
+	def sum(self, values: numpy.ndarray) -> numpy.ndarray:
+		""" Sums each row of `values` over the timepoints in the window."""
+		return numpy.where(self.window, values, 0).sum(axis = 1)
+
+	@property
+	def size(self) -> numpy.ndarray:
+		""" The number of timepoints each pair is compared over."""
+		return self._get('size', lambda: self.window.sum(axis = 1))
+
+	@property
+	def absolute_difference(self) -> numpy.ndarray:
+		""" |right - left| at each timepoint in the window and 0 elsewhere."""
+		return self._get('absolute_difference', lambda: numpy.where(self.window, numpy.abs(self.right - self.left), 0))
+
+	def calculate(self, metric: str) -> numpy.ndarray:
+		""" Calculates `metric` for every pair. The result is saved so each metric is only calculated once per block."""
+		return self._get(f"metric:{metric}", lambda: get_metric(metric).calculate(self))
+
+	def iterate_series(self) -> Iterator[Tuple[pandas.Series, pandas.Series]]:
+		""" Yields each pair as two series limited to the timepoints in its window."""
+		for left, right, window in zip(self.left, self.right, self.window):
+			columns = [c for c, use in zip(self.columns, window) if use]
+			yield pandas.Series(left[window], index = columns), pandas.Series(right[window], index = columns)
+
+
+@dataclass
+class Metric:
+	"""
+		A distance metric between two trajectories.
+	Parameters
+	----------
+	name: str
+	scalar: Callable[[pandas.Series, pandas.Series], float]
+		Calculates the distance between a single pair of series which were already limited to the compared timepoints.
+	kernel: Optional[Callable[[PairWindows], numpy.ndarray]]
+		Calculates the distance between every pair in a block at once. `scalar` is used for each pair if not given.
+	"""
+	name: str
+	scalar: Callable[[pandas.Series, pandas.Series], float]
+	kernel: Optional[Callable[[PairWindows], numpy.ndarray]] = None
+
+	def calculate(self, windows: PairWindows) -> numpy.ndarray:
+		if self.kernel is not None:
+			return self.kernel(windows)
+		return self.calculate_scalar(windows)
+
+	def calculate_scalar(self, windows: PairWindows) -> numpy.ndarray:
+		""" Applies `scalar` to each pair in the block."""
+		result = numpy.empty(len(windows))
+		for index, (left, right) in enumerate(windows.iterate_series()):
+			result[index] = self.scalar(left, right)
+		return result
+
+
+# Every available metric, keyed by name. Add metrics with `register_metric`.
+METRICS: Dict[str, Metric] = dict()
+
+
+def register_metric(name: str, scalar: Callable[[pandas.Series, pandas.Series], float],
+		kernel: Optional[Callable[[PairWindows], numpy.ndarray]] = None, replace: bool = False) -> Metric:
+	"""
+		Makes a metric available to `DistanceCalculator`, `DistanceEngine` and `calculate_distance` under `name`.
+		Metrics should be registered before any worker processes are started so the workers can find them.
+	Parameters
+	----------
+	name: str
+	scalar: Callable[[pandas.Series, pandas.Series], float]
+	kernel: Optional[Callable[[PairWindows], numpy.ndarray]]
+		See `Metric`.
+	replace: bool
+		Whether to replace a metric which is already registered with the same name.
+	"""
+	if name in METRICS and not replace:
+		message = f"The '{name}' metric is already registered."
+		raise ValueError(message)
+	METRICS[name] = Metric(name, scalar, kernel)
+	return METRICS[name]
+
+
+def get_metric(name: str) -> Metric:
+	try:
+		return METRICS[name]
+	except KeyError:
+		message = f"'{name}' is not an available metric. Expected one of {sorted(METRICS)}"
 		raise ValueError(message)
-	return distance_between_series
+
+
+def binomial_kernel(windows: PairWindows) -> numpy.ndarray:
+	""" Array version of `binomial_distance`."""
+	n = windows.size
+	mean = (windows.left + windows.right) / 2
+	sigma_pair = windows.sum(mean * (1 - mean)) / n ** 2
+	difference_mean = windows.absolute_difference.sum(axis = 1) / n
+	return difference_mean / numpy.sqrt(2 * sigma_pair)
+
+
+def binomial_probability_kernel(windows: PairWindows) -> numpy.ndarray:
+	""" Array version of `binomial_probability`."""
+	return 1 - (1 - special.erf(windows.calculate('binomial')))
+
+
+def minkowski_kernel(windows: PairWindows, p: int = 2) -> numpy.ndarray:
+	""" Array version of `minkowski_distance`."""
+	total = (windows.absolute_difference ** p).sum(axis = 1)
+	return total ** (1 / p)
+
+
+def pearson_correlation_kernel(windows: PairWindows, adjusted: bool = True) -> numpy.ndarray:
+	""" Array version of `pearson_correlation_distance`."""
+	n = windows.size
+	mean_left = windows.sum(windows.left) / n
+	mean_right = windows.sum(windows.right) / n
+	deviation_left = numpy.where(windows.window, windows.left - mean_left[:, numpy.newaxis], 0)
+	deviation_right = numpy.where(windows.window, windows.right - mean_right[:, numpy.newaxis], 0)
+	covariance = (deviation_left * deviation_right).sum(axis = 1)
+	variance = (deviation_left ** 2).sum(axis = 1) * (deviation_right ** 2).sum(axis = 1)
+	pcc = numpy.clip(covariance / numpy.sqrt(variance), -1, 1)
+	pcc[n < 2] = math.nan
+	if adjusted:
+		pcc = adjust_correlation_coefficient(pcc, n)
+	return 1 - pcc
+
+
+def combined_kernel(windows: PairWindows) -> numpy.ndarray:
+	""" Array version of `combined_distance`."""
+	return 2 * windows.calculate('pearson') + windows.calculate('minkowski')
+
+
+def jaccard_kernel(windows: PairWindows) -> numpy.ndarray:
+	""" Array version of `jaccard_distance`. See `area_engine.jaccard_distance`."""
+	return area_engine.jaccard_distance(windows.left, windows.right, windows.window)
+
+
+register_metric('binomial', binomial_distance, binomial_kernel)
+register_metric('pearson', pearson_correlation_distance, pearson_correlation_kernel)
+register_metric('minkowski', minkowski_distance, minkowski_kernel)
+register_metric('similarity', binomial_probability, binomial_probability_kernel)
+register_metric('binomialp', binomial_probability, binomial_probability_kernel)
+register_metric('jaccard', jaccard_distance, jaccard_kernel)
+register_metric('combined', combined_distance, combined_kernel)
+
+
+def calculate_distance(left: pandas.Series, right: pandas.Series, metric: str) -> float:
+	return get_metric(metric).scalar(left, right)
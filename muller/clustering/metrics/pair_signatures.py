@@ -0,0 +1,95 @@
+"""
+	Cheap lower bounds on the distance between two trajectories, used to skip pairs which are guaranteed to be farther
+	apart than a distance bound. Each trajectory is summarized by a signature of packed timepoint bitmasks, so bounding a
+	pair only requires a few byte operations rather than the full metric.
+
+	At each timepoint where one trajectory is fixed (>= `fixed_limit`) and the other is undetected (<= `detection_limit`),
+	the two frequencies differ by at least `fixed_limit - detection_limit`. Counting these timepoints within the window
+	the pair is compared over bounds the metrics which grow with the absolute difference between the series.
+"""
+from typing import Optional, Tuple
+
+import numpy
+from scipy import special
+
+try:
+	from muller.clustering.metrics.trajectory_features import CATEGORY_ONLY_FIXED, TrajectoryFeatures
+except ModuleNotFoundError:
+	from .trajectory_features import CATEGORY_ONLY_FIXED, TrajectoryFeatures
+
+# The metrics with a lower bound. The correlation-based metrics are unaffected by the scale of the series.
+PRUNABLE_METRICS = ['binomial', 'similarity', 'binomialp', 'minkowski']
+# The lower bounds are reduced by this fraction so rounding errors never prune a pair at exactly the bound.
+LOWER_BOUND_TOLERANCE = 1E-9
+
+# The number of set bits in each byte.
+POPCOUNT = numpy.array([bin(i).count('1') for i in range(256)], dtype = numpy.int64)
+
+
+class PairSignatures:
+	"""
+		Holds the signature of each trajectory: the first and last detected timepoints (via `TrajectoryFeatures`) and
+		packed bitmasks of the fixed and undetected timepoints.
+
+		Usage
+		-----
+		signatures = PairSignatures('binomial').load(features, values)
+		pruned = signatures.calculate_lower_bounds(left, right, category) > bound
+	Parameters
+	----------
+	metric: str
+		One of `PRUNABLE_METRICS`.
+	"""
+
+	def __init__(self, metric: str):
+		if metric not in PRUNABLE_METRICS:
+			message = f"Cannot bound the '{metric}' metric. Expected one of {PRUNABLE_METRICS}"
+			raise ValueError(message)
+		self.metric = metric
+		self.features: Optional[TrajectoryFeatures] = None
+		self.difference = 0.0
+
+		self.fixed: Optional[numpy.ndarray] = None
+		self.undetected: Optional[numpy.ndarray] = None
+		# Row `i` is the packed bitmask of the first `i` column positions.
+		self.prefix: Optional[numpy.ndarray] = None
+
+	def load(self, features: TrajectoryFeatures, values: numpy.ndarray) -> 'PairSignatures':
+		""" `features` should already be loaded with `values`."""
+		self.features = features
+		self.difference = max(0.0, features.fixed_limit - features.detection_limit)
+		# NaN is neither fixed nor undetected.
+		self.fixed = numpy.packbits(values >= features.fixed_limit, axis = 1)
+		self.undetected = numpy.packbits(values <= features.detection_limit, axis = 1)
+		positions = numpy.arange(values.shape[1])
+		self.prefix = numpy.packbits(positions < numpy.arange(values.shape[1] + 1)[:, numpy.newaxis], axis = 1)
+		return self
+
+	def count_separated(self, left: numpy.ndarray, right: numpy.ndarray, category: numpy.ndarray) -> Tuple[numpy.ndarray, numpy.ndarray]:
+		"""
+			Counts the timepoints within the window of each pair where one trajectory is fixed and the other is undetected.
+			Returns the count and the number of timepoints in the window.
+		"""
+		start, stop = self.features.get_window_bounds(left, right, category)
+		window = self.prefix[stop] & ~self.prefix[start]
+		separated = ((self.fixed[left] & self.undetected[right]) | (self.fixed[right] & self.undetected[left])) & window
+		return POPCOUNT[separated].sum(axis = 1), stop - start
+
+	def calculate_lower_bounds(self, left: numpy.ndarray, right: numpy.ndarray, category: numpy.ndarray) -> numpy.ndarray:
+		"""
+			Returns a lower bound on the distance between each pair. Pairs which are only fixed are compared without a
+			window and are bounded by 0.
+		"""
+		count, size = self.count_separated(left, right, category)
+		total = count * self.difference
+		if self.metric == 'minkowski':
+			bounds = numpy.sqrt(count) * self.difference
+		else:
+			# `binomial_distance` is sum(|left - right|) / sqrt(2 * sum(mean * (1 - mean))) and mean * (1 - mean) <= 1/4.
+			with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+				bounds = numpy.where(count > 0, total / numpy.sqrt(size / 2), 0)
+			if self.metric != 'binomial':
+				bounds = special.erf(bounds)
+		bounds = bounds * (1 - LOWER_BOUND_TOLERANCE)
+		bounds[category == CATEGORY_ONLY_FIXED] = 0
+		return bounds
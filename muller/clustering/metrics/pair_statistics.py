@@ -0,0 +1,232 @@
+"""
+	Incremental binomial distances for experiments which add new timepoints between runs. Both terms of the binomial
+	distance (the sum of the absolute differences and the sum of p(1 - p)) are sums over the timepoints each pair is
+	compared over, so they are saved for every pair and the distances are updated by adding the new timepoints.
+"""
+import json
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import numpy
+from loguru import logger
+from scipy import special
+
+try:
+	from muller.clustering.metrics import distance_engine
+	from muller.clustering.metrics.trajectory_features import CATEGORY_ONLY_FIXED, get_timepoint_rank
+except ModuleNotFoundError:
+	from . import distance_engine
+	from .trajectory_features import CATEGORY_ONLY_FIXED, get_timepoint_rank
+
+# The metrics which are calculated from the binomial sums.
+INCREMENTAL_METRICS = ['binomial', 'similarity', 'binomialp']
+
+
+def calculate_sums(left: numpy.ndarray, right: numpy.ndarray, window: numpy.ndarray):
+	""" The two sums used by `distance_methods.binomial_kernel` for each row of `left` and `right`."""
+	mean = (left + right) / 2
+	sum_difference = numpy.where(window, numpy.abs(right - left), 0).sum(axis = 1)
+	sum_variance = numpy.where(window, mean * (1 - mean), 0).sum(axis = 1)
+	return sum_difference, sum_variance
+
+
+def calculate_distances(sum_difference: numpy.ndarray, sum_variance: numpy.ndarray, size: numpy.ndarray, metric: str) -> numpy.ndarray:
+	""" Same steps as `distance_methods.binomial_kernel`, so the distances are identical to those calculated directly."""
+	with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+		sigma_pair = sum_variance / size ** 2
+		difference_mean = sum_difference / size
+		result = difference_mean / numpy.sqrt(2 * sigma_pair)
+	if metric != 'binomial':
+		result = 1 - (1 - special.erf(result))
+	return result
+
+
+class PairStatistics:
+	"""
+		Saves the binomial sums, the pair category and the window of timepoints each pair was compared over, along with
+		the trajectory table they were calculated from. When the same trajectories are loaded with additional timepoints,
+		`update` only recalculates the pairs which need it:
+			- Pairs whose category and window are unchanged keep their distance.
+			- Pairs whose window reached the last previous timepoint and now extends into the new timepoints add the sums
+			  over the new timepoints.
+			- Every other pair, such as pairs whose window changed or which are only fixed, is recalculated.
+
+		Usage
+		-----
+		engine = DistanceEngine(0.03, 0.97, 'binomial').load(trajectories)
+		statistics = PairStatistics.calculate(engine)
+		statistics.save(filename)
+		statistics = PairStatistics.read(filename).update(engine.load(trajectories_with_new_timepoints))
+	"""
+
+	def __init__(self, labels: List[str], columns: List[Any], values: numpy.ndarray, parameters: Dict[str, Any]):
+		self.labels = list(labels)
+		self.columns = list(columns)
+		self.values = values
+		self.parameters = parameters
+
+		total = len(self.labels) * (len(self.labels) - 1) // 2
+		self.category = numpy.empty(total, dtype = numpy.int8)
+		self.start = numpy.empty(total, dtype = numpy.int32)
+		self.stop = numpy.empty(total, dtype = numpy.int32)
+		self.sum_difference = numpy.empty(total)
+		self.sum_variance = numpy.empty(total)
+		# Pairs which could not be compared are NaN.
+		self.distances = numpy.empty(total)
+
+		# The number of pairs which were kept, updated with the new timepoints and recalculated.
+		self.statistics = {'reused': 0, 'updated': 0, 'recalculated': 0}
+
+	@staticmethod
+	def get_parameters(engine: 'distance_engine.DistanceEngine') -> Dict[str, Any]:
+		return {'metric': engine.metric, 'dlimit': engine.detection_limit, 'flimit': engine.fixed_limit}
+
+	@classmethod
+	def _empty(cls, engine: 'distance_engine.DistanceEngine') -> 'PairStatistics':
+		return cls(engine.labels, engine.columns, engine.values, cls.get_parameters(engine))
+
+	def _calculate_pairs(self, engine: 'distance_engine.DistanceEngine', positions: numpy.ndarray, left: numpy.ndarray,
+			right: numpy.ndarray, category: numpy.ndarray, start: numpy.ndarray, stop: numpy.ndarray):
+		""" Calculates the pairs at `positions` of the condensed vector from every timepoint in their window."""
+		self.category[positions] = category
+		self.start[positions] = start
+		self.stop[positions] = stop
+
+		timepoints = numpy.arange(len(self.columns))
+		window = (timepoints >= start[:, numpy.newaxis]) & (timepoints < stop[:, numpy.newaxis])
+		sum_difference, sum_variance = calculate_sums(engine.values[left], engine.values[right], window)
+		self.sum_difference[positions] = sum_difference
+		self.sum_variance[positions] = sum_variance
+		distances = calculate_distances(sum_difference, sum_variance, stop - start, engine.metric)
+
+		only_fixed = category == CATEGORY_ONLY_FIXED
+		if only_fixed.any():
+			distances[only_fixed] = engine.calculate_fixed_overlap(left[only_fixed], right[only_fixed])
+		self.distances[positions] = distances
+
+	@classmethod
+	def calculate(cls, engine: 'distance_engine.DistanceEngine') -> 'PairStatistics':
+		""" Calculates the statistics for every pair. `engine` should already be loaded with the trajectories."""
+		if engine.metric not in INCREMENTAL_METRICS:
+			message = f"The '{engine.metric}' metric cannot be updated incrementally. Expected one of {INCREMENTAL_METRICS}"
+			raise ValueError(message)
+		result = cls._empty(engine)
+		for start, stop in engine.get_blocks():
+			positions = numpy.arange(start, stop)
+			left, right = distance_engine.condensed_index_to_pairs(positions, len(engine), engine.offsets)
+			category = engine.categorize(left, right)
+			window_start, window_stop = engine.features.get_window_bounds(left, right, category)
+			result._calculate_pairs(engine, positions, left, right, category, window_start, window_stop)
+		result.statistics['recalculated'] = len(result.distances)
+		return result
+
+	def is_compatible(self, engine: 'distance_engine.DistanceEngine') -> bool:
+		"""
+			Whether `engine` was loaded with the same trajectories and parameters, with any new timepoints after the
+			previous timepoints.
+		"""
+		if self.get_parameters(engine) != self.parameters:
+			logger.warning(f"The saved pair statistics were calculated with different parameters: {self.parameters}")
+			return False
+		if [str(i) for i in engine.labels] != [str(i) for i in self.labels]:
+			logger.warning("The saved pair statistics were calculated for a different set of trajectories.")
+			return False
+		previous = len(self.columns)
+		columns = [str(i) for i in engine.columns]
+		rank = get_timepoint_rank(engine.columns)
+		if columns[:previous] != [str(i) for i in self.columns] or (rank[:previous] != numpy.arange(previous)).any():
+			logger.warning("The saved pair statistics were calculated from timepoints which are not the first timepoints of the table.")
+			return False
+		return True
+
+	def update(self, engine: 'distance_engine.DistanceEngine') -> 'PairStatistics':
+		"""
+			Returns the statistics for the trajectories loaded into `engine`, reusing the saved statistics where possible.
+			Everything is recalculated if the trajectories, parameters or previous timepoints differ.
+		"""
+		if not self.is_compatible(engine):
+			return self.calculate(engine)
+
+		previous = len(self.columns)
+		result = self._empty(engine)
+		# Pairs with a trajectory which was modified at any of the previous timepoints are recalculated.
+		old_values = engine.values[:, :previous]
+		changed = ~((old_values == self.values) | (numpy.isnan(old_values) & numpy.isnan(self.values))).all(axis = 1)
+		timepoints = numpy.arange(len(engine.columns))
+
+		for start, stop in engine.get_blocks():
+			positions = numpy.arange(start, stop)
+			left, right = distance_engine.condensed_index_to_pairs(positions, len(engine), engine.offsets)
+			category = engine.categorize(left, right)
+			window_start, window_stop = engine.features.get_window_bounds(left, right, category)
+
+			same = (category == self.category[positions]) & (window_start == self.start[positions])
+			same &= (category != CATEGORY_ONLY_FIXED) & ~changed[left] & ~changed[right]
+			reused = same & (window_stop == self.stop[positions])
+			updated = same & ~reused & (self.stop[positions] == previous) & (window_stop > previous)
+			recalculated = ~(reused | updated)
+
+			kept = positions[reused | updated]
+			result.category[kept] = self.category[kept]
+			result.start[kept] = self.start[kept]
+			result.stop[kept] = window_stop[reused | updated]
+			result.sum_difference[kept] = self.sum_difference[kept]
+			result.sum_variance[kept] = self.sum_variance[kept]
+			result.distances[kept] = self.distances[kept]
+
+			if updated.any():
+				indices = positions[updated]
+				window = (timepoints >= previous) & (timepoints < window_stop[updated][:, numpy.newaxis])
+				sum_difference, sum_variance = calculate_sums(engine.values[left[updated]], engine.values[right[updated]], window)
+				result.sum_difference[indices] += sum_difference
+				result.sum_variance[indices] += sum_variance
+				result.distances[indices] = calculate_distances(
+					result.sum_difference[indices], result.sum_variance[indices], window_stop[updated] - window_start[updated], engine.metric
+				)
+			if recalculated.any():
+				result._calculate_pairs(
+					engine, positions[recalculated], left[recalculated], right[recalculated], category[recalculated],
+					window_start[recalculated], window_stop[recalculated]
+				)
+			result.statistics['reused'] += int(reused.sum())
+			result.statistics['updated'] += int(updated.sum())
+			result.statistics['recalculated'] += int(recalculated.sum())
+
+		logger.info(
+			f"Reused {result.statistics['reused']}, updated {result.statistics['updated']} and recalculated "
+			f"{result.statistics['recalculated']} of {len(result.distances)} pairwise distances."
+		)
+		return result
+
+	def save(self, filename: Path):
+		with open(filename, 'wb') as output:
+			numpy.savez(
+				output,
+				labels = numpy.array([str(i) for i in self.labels]),
+				columns = numpy.array([str(i) for i in self.columns]),
+				values = self.values,
+				parameters = numpy.array(json.dumps(self.parameters, sort_keys = True)),
+				category = self.category,
+				start = self.start,
+				stop = self.stop,
+				sum_difference = self.sum_difference,
+				sum_variance = self.sum_variance,
+				distances = self.distances
+			)
+
+	@classmethod
+	def read(cls, filename: Path) -> 'PairStatistics':
+		""" Reads a file generated by `save`. The labels and columns are read as strings."""
+		with numpy.load(filename, allow_pickle = False) as data:
+			result = cls(data['labels'].tolist(), data['columns'].tolist(), data['values'], json.loads(str(data['parameters'])))
+			for key in ['category', 'start', 'stop', 'sum_difference', 'sum_variance', 'distances']:
+				setattr(result, key, data[key])
+		return result
+
+	@classmethod
+	def load_or_calculate(cls, engine: 'distance_engine.DistanceEngine', filename: Optional[Path]) -> 'PairStatistics':
+		""" Updates the statistics saved at `filename` if it exists, otherwise calculates them from scratch."""
+		if filename is not None and Path(filename).exists():
+			logger.info(f"Updating the pair statistics saved in '{filename}'")
+			return cls.read(filename).update(engine)
+		return cls.calculate(engine)
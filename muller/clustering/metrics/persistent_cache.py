@@ -0,0 +1,181 @@
+"""
+	A persistent, content-addressed cache of pairwise distances which can be shared between runs.
+	Each pair is keyed by a hash of both trajectory vectors (including the timepoints they were sampled at) and the
+	parameters used to calculate the distance, so any run which shares trajectories with a previous run only needs
+	to calculate the missing pairs.
+"""
+import hashlib
+import json
+import sqlite3
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy
+import pandas
+from loguru import logger
+
+try:
+	from muller.clustering.metrics import distance_engine
+except ModuleNotFoundError:
+	from . import distance_engine
+
+DIGEST_SIZE = 16
+
+
+def get_trajectory_digests(trajectories: pandas.DataFrame) -> numpy.ndarray:
+	""" Returns an (n, DIGEST_SIZE) uint8 array with a hash of each trajectory and the timepoints it was sampled at."""
+	columns = "\t".join(str(i) for i in trajectories.columns).encode()
+	values = numpy.ascontiguousarray(trajectories.values, dtype = numpy.float64)
+	digests = numpy.empty((len(values), DIGEST_SIZE), dtype = numpy.uint8)
+	for index, row in enumerate(values):
+		digest = hashlib.blake2b(columns, digest_size = DIGEST_SIZE)
+		digest.update(row.tobytes())
+		digests[index] = numpy.frombuffer(digest.digest(), dtype = numpy.uint8)
+	return digests
+
+
+def get_parameter_digest(parameters: Dict[str, Any]) -> bytes:
+	return hashlib.blake2b(json.dumps(parameters, sort_keys = True).encode(), digest_size = 8).digest()
+
+
+class PersistentDistanceCache:
+	"""
+		Stores the raw (before missing values are replaced) pairwise distances in an sqlite database within `folder`.
+		The least-recently used pairs are removed once the database holds more than `maximum_size` pairs.
+
+		Usage
+		-----
+		cache = PersistentDistanceCache(folder)
+		labels, distances = engine.run(trajectories, cache = cache)
+		cache.save_statistics(filename)
+	Parameters
+	----------
+	folder: Path
+		The folder to keep the database in. Created if it does not exist.
+	maximum_size: int
+		The maximum number of pairs to keep in the cache.
+	chunk_size: int
+		The number of pairs to look up at once.
+	"""
+	filename_database = "distances.sqlite"
+
+	def __init__(self, folder: Path, maximum_size: int = 10_000_000, chunk_size: int = 2 ** 18):
+		self.folder = Path(folder)
+		self.maximum_size = maximum_size
+		self.chunk_size = chunk_size
+
+		self.statistics = {'hits': 0, 'misses': 0, 'evicted': 0}
+
+		if not self.folder.exists():
+			self.folder.mkdir(parents = True)
+		self.connection = sqlite3.connect(str(self.folder / self.filename_database))
+		self.connection.execute("CREATE TABLE IF NOT EXISTS distances (key BLOB PRIMARY KEY, value REAL, accessed REAL) WITHOUT ROWID")
+		self.connection.execute("CREATE INDEX IF NOT EXISTS distances_accessed ON distances (accessed)")
+		self.connection.commit()
+
+	def __len__(self) -> int:
+		return self.connection.execute("SELECT COUNT(*) FROM distances").fetchone()[0]
+
+	@staticmethod
+	def get_pair_keys(prefix: bytes, digests: numpy.ndarray, order: numpy.ndarray, left: numpy.ndarray, right: numpy.ndarray) -> List[bytes]:
+		"""
+			Generates the key for each pair. The trajectory with the lower-ranked digest always comes first so the key
+			does not depend on the order of the trajectories in the table.
+		"""
+		swap = order[left] > order[right]
+		low = numpy.where(swap, right, left)
+		high = numpy.where(swap, left, right)
+		keys = numpy.concatenate([digests[low], digests[high]], axis = 1)
+		return [prefix + key.tobytes() for key in keys]
+
+	def lookup(self, keys: List[bytes]) -> Tuple[numpy.ndarray, numpy.ndarray]:
+		"""
+			Retrieves the distances for each key.
+		Returns
+		-------
+		values: numpy.ndarray
+		found: numpy.ndarray
+			Boolean array indicating which keys were present in the cache.
+		"""
+		values = numpy.full(len(keys), numpy.nan)
+		found = numpy.zeros(len(keys), dtype = bool)
+		cursor = self.connection.cursor()
+		cursor.execute("CREATE TEMP TABLE IF NOT EXISTS request (position INTEGER PRIMARY KEY, key BLOB)")
+		cursor.execute("DELETE FROM request")
+		cursor.executemany("INSERT INTO request VALUES (?, ?)", enumerate(keys))
+		rows = cursor.execute("SELECT request.position, distances.value FROM request JOIN distances ON distances.key = request.key").fetchall()
+		if rows:
+			positions, stored = zip(*rows)
+			positions = numpy.array(positions, dtype = numpy.int64)
+			found[positions] = True
+			values[positions] = numpy.array([numpy.nan if i is None else i for i in stored], dtype = float)
+			cursor.execute("UPDATE distances SET accessed = ? WHERE key IN (SELECT key FROM request)", (time.time(),))
+		self.connection.commit()
+		return values, found
+
+	def store(self, keys: List[bytes], values: numpy.ndarray):
+		accessed = time.time()
+		values = [None if value != value else value for value in values.tolist()]
+		self.connection.executemany(
+			"INSERT OR REPLACE INTO distances VALUES (?, ?, ?)",
+			((key, value, accessed) for key, value in zip(keys, values))
+		)
+		self.connection.commit()
+
+	def evict(self) -> int:
+		""" Removes the least-recently used pairs until the cache holds at most `self.maximum_size` pairs."""
+		excess = len(self) - self.maximum_size
+		if excess <= 0:
+			return 0
+		self.connection.execute(
+			"DELETE FROM distances WHERE key IN (SELECT key FROM distances ORDER BY accessed LIMIT ?)", (excess,)
+		)
+		self.connection.commit()
+		self.statistics['evicted'] += excess
+		return excess
+
+	def calculate(self, engine: 'distance_engine.DistanceEngine', trajectories: pandas.DataFrame, output: Optional[numpy.ndarray] = None) -> numpy.ndarray:
+		"""
+			Same as `engine.calculate_condensed`, but pairs which are already in the cache are not recalculated.
+			Pairs which could not be compared are left as NaN. `engine` should already be loaded with `trajectories`.
+		"""
+		parameters = {'metric': engine.metric, 'dlimit': engine.detection_limit, 'flimit': engine.fixed_limit}
+		prefix = get_parameter_digest(parameters)
+		digests = get_trajectory_digests(trajectories)
+		# Used to decide the orientation of each pair key.
+		order = numpy.empty(len(digests), dtype = numpy.int64)
+		order[sorted(range(len(digests)), key = lambda i: digests[i].tobytes())] = numpy.arange(len(digests))
+
+		total = engine.total_pairs
+		if output is None:
+			output = numpy.empty(total)
+		for start, stop in distance_engine.iterate_chunks(total, self.chunk_size):
+			left, right = distance_engine.condensed_index_to_pairs(numpy.arange(start, stop), len(engine), engine.offsets)
+			keys = self.get_pair_keys(prefix, digests, order, left, right)
+			values, found = self.lookup(keys)
+			missing = numpy.flatnonzero(~found)
+			block_size = engine.get_block_size()
+			for index in range(0, len(missing), block_size):
+				block = missing[index:index + block_size]
+				values[block] = engine.calculate_pairs(left[block], right[block])
+			if len(missing):
+				self.store([keys[i] for i in missing], values[missing])
+			output[start:stop] = values
+
+			self.statistics['hits'] += int(found.sum())
+			self.statistics['misses'] += len(missing)
+
+		self.evict()
+		logger.info(f"Reused {self.statistics['hits']} of {total} pairwise distances from '{self.folder}'")
+		return output
+
+	def save_statistics(self, filename: Path):
+		""" Saves the hit/miss statistics for the current run."""
+		total = self.statistics['hits'] + self.statistics['misses']
+		statistics = dict(self.statistics)
+		statistics['hitRate'] = self.statistics['hits'] / total if total else 0
+		statistics['size'] = len(self)
+		statistics['maximumSize'] = self.maximum_size
+		statistics['folder'] = str(self.folder)
+		filename.write_text(json.dumps(statistics, indent = 4, sort_keys = True))
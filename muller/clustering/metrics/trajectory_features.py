@@ -0,0 +1,173 @@
+"""
+	Per-trajectory features used to categorize each pair of trajectories and to select the timepoints they are compared over.
+	Each trajectory is analysed once, so categorizing a pair only requires a few array lookups rather than re-analysing
+	both series as `distance_calculator.get_pair_category` and `distance_calculator.filter_timepoints` do.
+"""
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy
+import pandas
+
+# Integer codes for the pair categories defined in `distance_calculator.get_pair_category`.
+CATEGORY_ONLY_FIXED = 0
+CATEGORY_PARTIALLY_FIXED = 1
+CATEGORY_BOTH_FIXED = 2
+CATEGORY_ONE_FIXED = 3
+CATEGORY_NOT_FIXED = 4
+
+CATEGORY_NAMES = {
+	CATEGORY_ONLY_FIXED:      'onlyFixed',
+	CATEGORY_PARTIALLY_FIXED: 'partiallyFixed',
+	CATEGORY_BOTH_FIXED:      'bothFixed',
+	CATEGORY_ONE_FIXED:       'oneFixed',
+	CATEGORY_NOT_FIXED:       'notFixed'
+}
+
+# `widgets.get_valid_points` masks every value above this frequency, regardless of the fixed limit.
+VALID_POINTS_MASK = 0.97
+
+
+def get_timepoint_rank(columns: List[Any]) -> numpy.ndarray:
+	"""
+		Returns the order of each column when sorted by timepoint. `widgets.get_valid_points` selects the first and last
+		detected timepoints based on the timepoint values rather than the column positions.
+	"""
+	try:
+		keys = [float(i) for i in columns]
+	except (TypeError, ValueError):
+		# The columns are not numeric. Assume they are already sorted.
+		keys = list(range(len(columns)))
+	return numpy.argsort(numpy.argsort(keys, kind = 'stable'), kind = 'stable')
+
+
+class TrajectoryFeatures:
+	"""
+		Precomputes the features of every trajectory needed to categorize a pair of trajectories.
+
+		Usage
+		-----
+		features = TrajectoryFeatures(0.03, 0.97).load(trajectories)
+		category = features.categorize(left_indices, right_indices)
+		start, stop = features.get_window_bounds(left_indices, right_indices, category)
+	Parameters
+	----------
+	detection_limit, fixed_limit: float
+	"""
+
+	def __init__(self, detection_limit: float, fixed_limit: float):
+		self.detection_limit = detection_limit
+		self.fixed_limit = fixed_limit
+
+		self.labels: List[str] = list()
+		self.index: Dict[str, int] = dict()
+		self.columns: List[Any] = list()
+		self.rank: Optional[numpy.ndarray] = None
+		# The column position of each timepoint rank. The inverse of `self.rank`.
+		self.position: Optional[numpy.ndarray] = None
+
+		# Timepoint masks. Each has the same shape as the trajectory table.
+		self.mask_fixed: Optional[numpy.ndarray] = None
+		self.mask_intermediate: Optional[numpy.ndarray] = None
+		self.mask_detected: Optional[numpy.ndarray] = None
+		self.mask_detected_unfixed: Optional[numpy.ndarray] = None
+
+		# Per-trajectory values.
+		self.is_fixed: Optional[numpy.ndarray] = None
+		self.is_intermediate: Optional[numpy.ndarray] = None
+		# The rank of the first and last detected timepoints. Trajectories which are never detected have a first rank equal
+		# to the number of timepoints and a last rank of -1.
+		self.first_detected: Optional[numpy.ndarray] = None
+		self.last_detected: Optional[numpy.ndarray] = None
+		# Same as above, but values above `VALID_POINTS_MASK` are treated as undetected.
+		self.first_detected_unfixed: Optional[numpy.ndarray] = None
+		self.last_detected_unfixed: Optional[numpy.ndarray] = None
+		# The rank of the first fixed timepoint.
+		self.first_fixed: Optional[numpy.ndarray] = None
+
+	def __len__(self) -> int:
+		return len(self.labels)
+
+	def load(self, trajectories: pandas.DataFrame) -> 'TrajectoryFeatures':
+		values = numpy.ascontiguousarray(trajectories.values, dtype = float)
+		return self.load_array(list(trajectories.index), list(trajectories.columns), values)
+
+	def load_array(self, labels: List[str], columns: List[Any], values: numpy.ndarray) -> 'TrajectoryFeatures':
+		self.labels = list(labels)
+		self.index = {label: position for position, label in enumerate(self.labels)}
+		self.columns = list(columns)
+		self.rank = get_timepoint_rank(self.columns)
+		self.position = numpy.argsort(self.rank)
+
+		self.mask_fixed = values >= self.fixed_limit
+		self.mask_intermediate = (self.detection_limit <= values) & (values <= self.fixed_limit)
+		self.mask_detected = values > self.detection_limit
+		self.mask_detected_unfixed = numpy.where(values > VALID_POINTS_MASK, -1, values) > self.detection_limit
+
+		# Same bounds as `widgets.get_fixed` and `widgets.get_intermediate`.
+		self.is_fixed = ((self.fixed_limit <= values) & (values <= 2)).any(axis = 1)
+		self.is_intermediate = self.mask_intermediate.any(axis = 1)
+
+		self.first_detected, self.last_detected = self._get_bounds(self.mask_detected)
+		self.first_detected_unfixed, self.last_detected_unfixed = self._get_bounds(self.mask_detected_unfixed)
+		self.first_fixed, _ = self._get_bounds(self.mask_fixed)
+		return self
+
+	def _get_bounds(self, mask: numpy.ndarray) -> Tuple[numpy.ndarray, numpy.ndarray]:
+		""" Returns the lowest and highest timepoint rank where `mask` is true for each trajectory."""
+		total = len(self.columns)
+		first = numpy.where(mask, self.rank, total).min(axis = 1, initial = total)
+		last = numpy.where(mask, self.rank, -1).max(axis = 1, initial = -1)
+		return first, last
+
+	def categorize(self, left: numpy.ndarray, right: numpy.ndarray) -> numpy.ndarray:
+		""" Array version of `distance_calculator.get_pair_category`. Returns the category code for each pair."""
+		fixed_left = self.is_fixed[left]
+		fixed_right = self.is_fixed[right]
+		intermediate_left = self.is_intermediate[left]
+		intermediate_right = self.is_intermediate[right]
+
+		both_fixed = fixed_left & fixed_right
+		category = numpy.full(numpy.shape(left), CATEGORY_NOT_FIXED, dtype = numpy.int8)
+		category[fixed_left ^ fixed_right] = CATEGORY_ONE_FIXED
+		category[both_fixed] = CATEGORY_PARTIALLY_FIXED
+		category[both_fixed & ~intermediate_left & ~intermediate_right] = CATEGORY_ONLY_FIXED
+		category[both_fixed & intermediate_left & intermediate_right] = CATEGORY_BOTH_FIXED
+		return category
+
+	def get_window_bounds(self, left: numpy.ndarray, right: numpy.ndarray, category: numpy.ndarray) -> Tuple[numpy.ndarray, numpy.ndarray]:
+		"""
+			Array version of `distance_calculator.filter_timepoints`. Returns the [`start`, `stop`) column positions of the
+			timepoints each pair should be compared over. The range is empty when neither trajectory was detected.
+		"""
+		use_fixed_limit = category != CATEGORY_ONE_FIXED
+		first = numpy.minimum(
+			numpy.where(use_fixed_limit, self.first_detected_unfixed[left], self.first_detected[left]),
+			numpy.where(use_fixed_limit, self.first_detected_unfixed[right], self.first_detected[right])
+		)
+		last = numpy.maximum(
+			numpy.where(use_fixed_limit, self.last_detected_unfixed[left], self.last_detected[left]),
+			numpy.where(use_fixed_limit, self.last_detected_unfixed[right], self.last_detected[right])
+		)
+		detected = last >= 0
+		start = numpy.where(detected, self.position[numpy.where(detected, first, 0)], 0)
+		stop = numpy.where(detected, self.position[numpy.where(detected, last, 0)] + 1, 0)
+		return start, stop
+
+	def get_pair_window(self, left: str, right: str) -> Optional[Tuple[int, int]]:
+		"""
+			Scalar version of `get_window_bounds` which uses trajectory labels. Returns `None` if both trajectories are
+			only fixed, which is when `distance_calculator.filter_timepoints` returns `None`.
+		"""
+		left = numpy.array([self.index[left]])
+		right = numpy.array([self.index[right]])
+		category = self.categorize(left, right)
+		if category[0] == CATEGORY_ONLY_FIXED:
+			return None
+		start, stop = self.get_window_bounds(left, right, category)
+		return int(start[0]), int(stop[0])
+
+	def get_windows(self, left: numpy.ndarray, right: numpy.ndarray, category: numpy.ndarray) -> numpy.ndarray:
+		""" Same as `get_window_bounds`, but returns a boolean mask of the timepoints for each pair."""
+		start, stop = self.get_window_bounds(left, right, category)
+		positions = numpy.arange(len(self.columns))
+		return (positions >= start[:, numpy.newaxis]) & (positions < stop[:, numpy.newaxis])
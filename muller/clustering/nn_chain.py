@@ -0,0 +1,200 @@
+"""
+	Hierarchical clustering with the nearest-neighbor-chain algorithm, which is the same algorithm `scipy.cluster.hierarchy.linkage`
+	uses for the 'ward', 'average', 'complete' and 'weighted' methods. scipy needs two in-memory float64 copies of the condensed
+	distance vector while this version updates a single working copy, which is memory-mapped when the input distances are.
+	Apart from the working copy only O(n) memory is used, and the linkage matrix is identical to the one scipy generates.
+"""
+from pathlib import Path
+from typing import Optional
+
+import numpy
+from loguru import logger
+
+try:
+	from muller.clustering.metrics import distance_engine
+except ModuleNotFoundError:
+	from .metrics import distance_engine
+
+
+def _update_complete(d_xi: numpy.ndarray, d_yi: numpy.ndarray, d_xy: float, size_x: int, size_y: int, size_i: numpy.ndarray) -> numpy.ndarray:
+	return numpy.maximum(d_xi, d_yi)
+
+
+def _update_average(d_xi: numpy.ndarray, d_yi: numpy.ndarray, d_xy: float, size_x: int, size_y: int, size_i: numpy.ndarray) -> numpy.ndarray:
+	return (size_x * d_xi + size_y * d_yi) / (size_x + size_y)
+
+
+def _update_weighted(d_xi: numpy.ndarray, d_yi: numpy.ndarray, d_xy: float, size_x: int, size_y: int, size_i: numpy.ndarray) -> numpy.ndarray:
+	return 0.5 * (d_xi + d_yi)
+
+
+def _update_ward(d_xi: numpy.ndarray, d_yi: numpy.ndarray, d_xy: float, size_x: int, size_y: int, size_i: numpy.ndarray) -> numpy.ndarray:
+	# The operations are in the same order as scipy's implementation so the results are identical.
+	size_i = size_i.astype(float)
+	t = 1.0 / (size_x + size_y + size_i)
+	return numpy.sqrt(
+		(size_i + size_x) * t * d_xi * d_xi + (size_i + size_y) * t * d_yi * d_yi - size_i * t * d_xy * d_xy
+	)
+
+
+# The Lance-Williams update for each supported linkage method. Each method must be reducible for the nearest-neighbor
+# chain to produce the correct hierarchy, so 'centroid' and 'median' are not supported. scipy uses a minimum spanning
+# tree for 'single', which breaks ties differently.
+LINKAGE_UPDATES = {
+	'complete': _update_complete,
+	'average':  _update_average,
+	'weighted': _update_weighted,
+	'ward':     _update_ward
+}
+
+
+def copy_distances(distances: numpy.ndarray, filename: Optional[Path] = None,
+		chunk_size: int = distance_engine.CHUNK_SIZE) -> numpy.ndarray:
+	""" Copies `distances` as float64, into a memory-mapped file at `filename` if given."""
+	if filename is None:
+		return numpy.array(distances, dtype = numpy.float64)
+	output = numpy.lib.format.open_memmap(str(filename), mode = 'w+', dtype = numpy.float64, shape = (len(distances),))
+	for start, stop in distance_engine.iterate_chunks(len(distances), chunk_size):
+		output[start:stop] = distances[start:stop]
+	return output
+
+
+def label_linkage(Z: numpy.ndarray, n: int, sizes: Optional[numpy.ndarray] = None) -> numpy.ndarray:
+	"""
+		Relabels the clusters in a linkage matrix whose rows were sorted by distance. Before this, each merge refers to the
+		clusters by the index of one of their original members. `Z` may have fewer than `n - 1` rows if not every
+		observation is merged. `sizes` is the number of observations each of the `n` rows represents, if not 1.
+		Modifies `Z` in place.
+	"""
+	parent = numpy.arange(2 * n - 1)
+	size = numpy.ones(2 * n - 1, dtype = numpy.int64)
+	if sizes is not None:
+		size[:n] = sizes
+
+	def find(x: int) -> int:
+		root = x
+		while parent[root] != root:
+			root = parent[root]
+		while parent[x] != root:
+			parent[x], x = root, parent[x]
+		return root
+
+	for index in range(len(Z)):
+		x = find(int(Z[index, 0]))
+		y = find(int(Z[index, 1]))
+		label = n + index
+		Z[index, 0], Z[index, 1] = min(x, y), max(x, y)
+		parent[x] = parent[y] = label
+		size[label] = size[x] + size[y]
+		Z[index, 3] = size[label]
+	return Z
+
+
+def scale_ward_distances(distances: numpy.ndarray, sizes: numpy.ndarray, chunk_size: int = distance_engine.CHUNK_SIZE) -> numpy.ndarray:
+	"""
+		Converts the distances between single observations into the ward distances between clusters of `sizes` identical
+		observations, which is the distance multiplied by sqrt(2 * size_i * size_j / (size_i + size_j)). Modifies `distances` in place.
+	"""
+	sizes = numpy.asarray(sizes, dtype = numpy.float64)
+	offsets = distance_engine.get_row_offsets(len(sizes))
+	for start, stop in distance_engine.iterate_chunks(len(distances), chunk_size):
+		left, right = distance_engine.condensed_index_to_pairs(numpy.arange(start, stop), len(sizes), offsets)
+		distances[start:stop] *= numpy.sqrt(2 * sizes[left] * sizes[right] / (sizes[left] + sizes[right]))
+	return distances
+
+
+def linkage(distances: numpy.ndarray, n: int, method: str = 'ward', in_place: bool = False,
+		filename: Optional[Path] = None, sizes: Optional[numpy.ndarray] = None) -> numpy.ndarray:
+	"""
+		Generates the same linkage matrix as `scipy.cluster.hierarchy.linkage(distances, method)`.
+	Parameters
+	----------
+	distances: numpy.ndarray
+		The condensed distance vector for `n` observations. May be a `numpy.memmap`.
+	n: int
+		The number of observations.
+	method: str
+		One of `LINKAGE_UPDATES`.
+	in_place: bool
+		Use `distances` as the working copy. The distances are overwritten.
+	filename: Optional[Path]
+		Where to memory-map the working copy. Defaults to a file next to `distances` if it is memory-mapped and is
+		removed once the linkage matrix is generated.
+	sizes: Optional[numpy.ndarray]
+		The number of identical observations each of the `n` rows represents. The linkage matrix is the same as the one
+		generated from every copy, without the merges between copies of the same observation.
+	"""
+	try:
+		update = LINKAGE_UPDATES[method]
+	except KeyError:
+		message = f"The nearest-neighbor chain does not support the '{method}' method. Expected one of {sorted(LINKAGE_UPDATES)}"
+		raise ValueError(message)
+	if len(distances) != n * (n - 1) // 2:
+		message = f"Expected a condensed distance vector for {n} observations, got {len(distances)} distances."
+		raise ValueError(message)
+
+	if in_place:
+		D = distances
+		filename = None
+	else:
+		if filename is None and isinstance(distances, numpy.memmap) and distances.filename:
+			filename = Path(distances.filename).with_suffix('.linkage.npy')
+		D = copy_distances(distances, filename)
+	if sizes is not None and method == 'ward':
+		scale_ward_distances(D, sizes)
+
+	Z = numpy.empty((max(n - 1, 0), 4))
+	size = numpy.ones(n, dtype = numpy.int64) if sizes is None else numpy.array(sizes, dtype = numpy.int64)
+	# The clusters which have not been merged into another cluster, in ascending order.
+	active = numpy.arange(n)
+	# The position of (i, j) in the condensed vector is `shifted[i] + j` for i < j.
+	shifted = distance_engine.get_row_offsets(n) - numpy.arange(n) - 1
+
+	def get_indices(x: int, others: numpy.ndarray) -> numpy.ndarray:
+		return numpy.where(others < x, shifted[others] + x, shifted[x] + others)
+
+	chain = list()
+	for step in range(n - 1):
+		if not chain:
+			chain.append(int(active[0]))
+		# Follow the chain of nearest neighbors until two clusters are each other's nearest neighbor.
+		while True:
+			x = chain[-1]
+			others = active[active != x]
+			row = D[get_indices(x, others)]
+			# The first of several equally-close clusters is used, unless it is the previous cluster in the chain.
+			nearest = int(numpy.argmin(row))
+			y = int(others[nearest])
+			current_min = row[nearest]
+			if len(chain) > 1:
+				previous = chain[-2]
+				previous_distance = D[get_indices(x, numpy.array([previous]))[0]]
+				if not current_min < previous_distance:
+					y = previous
+					current_min = previous_distance
+				if y == previous:
+					break
+			chain.append(y)
+		del chain[-2:]
+
+		x, y = min(x, y), max(x, y)
+		size_x = size[x]
+		size_y = size[y]
+		Z[step] = [x, y, current_min, size_x + size_y]
+
+		# Cluster `y` is replaced with the merged cluster and cluster `x` is dropped.
+		size[x] = 0
+		size[y] = size_x + size_y
+		active = active[active != x]
+		others = active[active != y]
+		if len(others):
+			indices_y = get_indices(y, others)
+			D[indices_y] = update(D[get_indices(x, others)], D[indices_y], current_min, size_x, size_y, size[others])
+
+	if filename is not None:
+		del D
+		Path(filename).unlink()
+		logger.debug(f"Removed the working copy of the distances at {filename}")
+
+	Z = Z[numpy.argsort(Z[:, 2], kind = 'mergesort')]
+	return label_linkage(Z, n, sizes)
@@ -0,0 +1,356 @@
+"""
+	Clusters trajectories using only the pairs which are closer than a fixed distance bound. The pairwise distances are
+	calculated one block at a time and only the pairs within the bound are kept, so memory scales with the number of
+	close pairs rather than with the square of the number of trajectories. Used for datasets which are too large for
+	the full condensed distance vector and the linkage table generated from it.
+"""
+import heapq
+import math
+from typing import *
+
+import numpy
+import pandas
+from loguru import logger
+from scipy import sparse
+from scipy.sparse import csgraph
+
+try:
+	from muller.clustering import hierarchy, nn_chain
+	from muller.clustering.metrics import distance_engine
+	from muller.clustering.metrics.distance_cache import DistanceCache
+	from muller.clustering.metrics.distance_engine import DistanceEngine
+	from muller.dataio import projectdata
+except ModuleNotFoundError:
+	from . import hierarchy, nn_chain
+	from .metrics import distance_engine
+	from .metrics.distance_cache import DistanceCache
+	from .metrics.distance_engine import DistanceEngine
+	from ..dataio import projectdata
+
+# 'components' joins every pair within the cutoff, which gives the same clusters as cutting a single-linkage table.
+# 'single' also generates the (partial) single-linkage table. 'average' merges the clusters with the smallest mean
+# distance, treating the pairs outside the bound as being at the bound.
+SPARSE_METHODS = ['components', 'single', 'average']
+
+
+class DistanceGraph:
+	"""
+		Holds the pairwise distances which are at most `bound`, as positions in the condensed distance vector of `labels`.
+		Pairs which could not be compared are never included. The summary statistics needed to calculate the cutoff
+		quantile (see `hierarchy.calculate_cutoff_quantile`) are collected over every pair as the distances are added.
+
+		Usage
+		-----
+		graph = DistanceGraph.from_engine(engine, trajectories, bound = 0.5)
+		graph = DistanceGraph.from_distance_cache(cache, bound = 0.5)
+	Parameters
+	----------
+	labels: List[str]
+		The labels, in the same order as the condensed distance vector.
+	bound: float
+		The largest distance kept in the graph.
+	"""
+
+	def __init__(self, labels: Iterable[str], bound: float):
+		self.labels: List[str] = list(labels)
+		self.index: Dict[str, int] = {label: position for position, label in enumerate(self.labels)}
+		self.bound = bound
+
+		self.positions: numpy.ndarray = numpy.empty(0, dtype = numpy.int64)
+		self.values: numpy.ndarray = numpy.empty(0, dtype = numpy.float64)
+
+		# Collected over every pair, including the pairs outside the bound.
+		self.maximum = -math.inf
+		self.count_maximum = 0
+		self.count_positive = 0
+
+	def __len__(self) -> int:
+		""" The number of pairs in the graph."""
+		return len(self.positions)
+
+	@property
+	def total_pairs(self) -> int:
+		n = len(self.labels)
+		return n * (n - 1) // 2
+
+	def _add_statistics(self, values: numpy.ndarray):
+		# Pruned pairs are farther apart than the bound, so they are positive but are assumed to be below the maximum.
+		pruned = values == distance_engine.PRUNED_DISTANCE
+		self.count_positive += int(pruned.sum())
+		values = values[~numpy.isnan(values) & ~pruned]
+		if len(values) == 0:
+			return
+		maximum = float(values.max())
+		if maximum > self.maximum:
+			self.maximum = maximum
+			self.count_maximum = 0
+		if maximum == self.maximum:
+			self.count_maximum += int((values == maximum).sum())
+		self.count_positive += int((values > 0).sum())
+
+	def add_blocks(self, blocks: Iterable[Tuple[int, numpy.ndarray]]) -> 'DistanceGraph':
+		"""
+			Adds consecutive blocks of the condensed distance vector. Each block is given as the position of its first
+			pair and its distances. Missing distances should be NaN and pruned pairs `distance_engine.PRUNED_DISTANCE`.
+		"""
+		positions = [self.positions]
+		values = [self.values]
+		for start, block in blocks:
+			block = numpy.asarray(block, dtype = numpy.float64)
+			self._add_statistics(block)
+			# NaN is never within the bound.
+			selected = numpy.flatnonzero(block <= self.bound)
+			positions.append(start + selected)
+			values.append(block[selected])
+		self.positions = numpy.concatenate(positions)
+		self.values = numpy.concatenate(values)
+		return self
+
+	@classmethod
+	def from_engine(cls, engine: DistanceEngine, trajectories: pandas.DataFrame, bound: float) -> 'DistanceGraph':
+		""" Calculates the distances between every pair of `trajectories` with `engine`, keeping only the pairs within `bound`."""
+		# Sort the trajectories so the labels are in the same order used by `DistanceCache`.
+		trajectories = trajectories.loc[sorted(trajectories.index)]
+		engine.load(trajectories)
+		logger.debug(f"Generating pairwise combinations with {len(engine)} items resulting in {engine.total_pairs} combinations...")
+		graph = cls(engine.labels, bound)
+		graph.add_blocks((start, block) for start, _, block in engine.iterate_blocks())
+		logger.debug(f"Kept {len(graph)} of {graph.total_pairs} pairs within a distance of {bound}")
+		return graph
+
+	@classmethod
+	def from_distance_cache(cls, cache: DistanceCache, bound: float, chunk_size: int = distance_engine.CHUNK_SIZE) -> 'DistanceGraph':
+		""" Keeps the pairs of `cache` within `bound`. Pairs without a value are treated as 0, as in `DistanceCache.triangle`."""
+		values = cache.triangle()
+		graph = cls(cache.labels, bound)
+		graph.add_blocks((start, values[start:stop]) for start, stop in distance_engine.iterate_chunks(len(values), chunk_size))
+		return graph
+
+	def get_pairs(self) -> Tuple[numpy.ndarray, numpy.ndarray]:
+		""" Returns the positions of the left and right label of each pair in the graph."""
+		return distance_engine.condensed_index_to_pairs(self.positions, len(self.labels))
+
+	def set_group(self, labels: Iterable[str], value: float = 0) -> List[str]:
+		"""
+			Sets the distance between every pair of `labels` to `value`. Labels which are not in the graph are ignored.
+			The pairs of the group which were outside the bound are assumed to be positive and less than the maximum
+			distance when the summary statistics are updated, since their distances were not kept.
+		Returns
+		-------
+		List[str]
+			The labels which were not found.
+		"""
+		labels = list(labels)
+		missing = [i for i in labels if i not in self.index]
+		members = numpy.array(sorted({self.index[i] for i in labels if i in self.index}), dtype = numpy.int64)
+		if len(members) < 2:
+			return missing
+		left, right = distance_engine.condensed_index_to_pairs(numpy.arange(len(members) * (len(members) - 1) // 2), len(members))
+		group = distance_engine.pairs_to_condensed_index(members[left], members[right], len(self.labels))
+
+		stored = numpy.isin(self.positions, group)
+		previous = self.values[stored]
+		outside = len(group) - len(previous)
+		self.count_positive -= int((previous > 0).sum()) + outside
+		if self.maximum > 0:
+			self.count_maximum -= int((previous == self.maximum).sum())
+		if value > 0:
+			self.count_positive += len(group)
+
+		self.positions = self.positions[~stored]
+		self.values = self.values[~stored]
+		if value <= self.bound:
+			order = numpy.argsort(numpy.concatenate([self.positions, group]), kind = 'mergesort')
+			self.positions = numpy.concatenate([self.positions, group])[order]
+			self.values = numpy.concatenate([self.values, numpy.full(len(group), value, dtype = numpy.float64)])[order]
+		return missing
+
+	def calculate_cutoff_quantiles(self, quantiles: Iterable[float]) -> List[Optional[float]]:
+		"""
+			Same as `hierarchy.calculate_cutoff_quantiles` applied to the full condensed distance vector. The result is
+			exact when the order statistics needed for a quantile are within the bound. Otherwise the quantile is None.
+		"""
+		quantiles = list(quantiles)
+		# Missing distances are replaced with the maximum in the full distance vector, so they are never counted.
+		total = self.count_positive - (self.count_maximum if self.maximum > 0 else 0)
+		selected = self.values[(self.values > 0) & (self.values < self.maximum)]
+
+		def select(ranks: List[int]) -> List[float]:
+			if ranks and ranks[-1] >= len(selected):
+				raise IndexError(ranks[-1])
+			return hierarchy.select_order_statistics(selected, ranks, 0, self.maximum)
+
+		result = list()
+		for quantile in quantiles:
+			try:
+				result += hierarchy.interpolate_quantiles([quantile], total, select)
+			except IndexError:
+				result.append(None)
+		return result
+
+	def calculate_cutoff_quantile(self, quantile: float) -> Optional[float]:
+		return self.calculate_cutoff_quantiles([quantile])[0]
+
+
+def cut_linkage(Z: numpy.ndarray, n: int, cutoff: float) -> numpy.ndarray:
+	"""
+		Same as `scipy.cluster.hierarchy.fcluster(Z, cutoff, criterion = 'distance')`, but `Z` may have fewer than
+		`n - 1` rows. Each observation is assigned the index of its cluster, in order of the first member.
+	"""
+	parent = numpy.arange(2 * n - 1)
+	height = numpy.zeros(2 * n - 1)
+	for index, (left, right, distance, _) in enumerate(Z):
+		label = n + index
+		left, right = int(left), int(right)
+		height[label] = max(distance, height[left], height[right])
+		if height[label] <= cutoff:
+			parent[left] = parent[right] = label
+
+	roots = numpy.empty(n, dtype = numpy.int64)
+	for observation in range(n):
+		root = observation
+		while parent[root] != root:
+			root = parent[root]
+		roots[observation] = root
+	_, first, clusters = numpy.unique(roots, return_index = True, return_inverse = True)
+	# Number the clusters in order of their first member.
+	order = numpy.argsort(numpy.argsort(first))
+	return order[clusters] + 1
+
+
+class SparseGraphCluster:
+	"""
+		Clusters a `DistanceGraph`. The linkage methods only merge clusters connected by at least one pair in the graph,
+		so the linkage table may have fewer than `n - 1` rows.
+	Parameters
+	----------
+	method: str
+		One of `SPARSE_METHODS`.
+	"""
+
+	def __init__(self, method: str = 'components'):
+		if method not in SPARSE_METHODS:
+			message = f"'{method}' is not a valid sparse clustering method. Expected one of {SPARSE_METHODS}"
+			raise ValueError(message)
+		self.method = method
+
+	@staticmethod
+	def cluster_components(graph: DistanceGraph, cutoff: float) -> numpy.ndarray:
+		""" Assigns each connected component of the pairs within `cutoff` a cluster index."""
+		n = len(graph.labels)
+		selected = graph.values <= cutoff
+		left, right = distance_engine.condensed_index_to_pairs(graph.positions[selected], n)
+		matrix = sparse.csr_matrix((numpy.ones(len(left)), (left, right)), shape = (n, n))
+		_, clusters = csgraph.connected_components(matrix, directed = False)
+		return clusters
+
+	@staticmethod
+	def link_single(graph: DistanceGraph) -> numpy.ndarray:
+		""" Generates the single-linkage table from the minimum spanning forest of the graph."""
+		n = len(graph.labels)
+		left, right = graph.get_pairs()
+		# Use the rank of each distance as the weight so pairs with a distance of 0 are not dropped from the sparse matrix.
+		order = numpy.argsort(graph.values, kind = 'mergesort')
+		ranks = numpy.empty(len(order), dtype = numpy.float64)
+		ranks[order] = numpy.arange(1, len(order) + 1)
+		matrix = sparse.csr_matrix((ranks, (left, right)), shape = (n, n))
+		tree = csgraph.minimum_spanning_tree(matrix).tocoo()
+
+		edges = order[numpy.sort(tree.data.astype(numpy.int64)) - 1]
+		Z = numpy.column_stack([left[edges], right[edges], graph.values[edges], numpy.zeros(len(edges))]).astype(numpy.float64)
+		return nn_chain.label_linkage(Z, n)
+
+	@staticmethod
+	def link_average(graph: DistanceGraph) -> numpy.ndarray:
+		"""
+			Generates the average-linkage table. The distance between two clusters is the mean distance between their
+			members, where the pairs outside the graph are assigned the bound. Clusters without a pair in the graph are
+			not merged.
+		"""
+		n = len(graph.labels)
+		bound = graph.bound
+		left, right = graph.get_pairs()
+		# Maps each cluster to the sum and number of the distances to each of its neighbors.
+		neighbors: Dict[int, Dict[int, List[float]]] = {i: dict() for i in range(n)}
+		heap = list()
+		for i, j, value in zip(left.tolist(), right.tolist(), graph.values.tolist()):
+			neighbors[i][j] = neighbors[j][i] = [value, 1]
+			heap.append((value, i, j))
+		heapq.heapify(heap)
+		size = {i: 1 for i in range(n)}
+
+		# Each merged cluster gets a new label, so the distance between two existing clusters never changes.
+		rows = list()
+		while heap:
+			distance, x, y = heapq.heappop(heap)
+			if x not in size or y not in size:
+				continue
+			label = n + len(rows)
+			size_x, size_y = size.pop(x), size.pop(y)
+			size[label] = size_x + size_y
+			rows.append([x, y, distance, size_x + size_y])
+
+			merged = dict()
+			for cluster in (x, y):
+				for other, (total, count) in neighbors.pop(cluster).items():
+					if other in (x, y):
+						continue
+					del neighbors[other][cluster]
+					current = merged.setdefault(other, [0.0, 0])
+					current[0] += total
+					current[1] += count
+			neighbors[label] = merged
+			for other, pair in merged.items():
+				neighbors[other][label] = pair
+				pairs = size[label] * size[other]
+				value = (pair[0] + (pairs - pair[1]) * bound) / pairs
+				heapq.heappush(heap, (value, other, label))
+
+		return numpy.array(rows, dtype = numpy.float64).reshape(-1, 4)
+
+	def link_clusters(self, graph: DistanceGraph) -> Optional[numpy.ndarray]:
+		if self.method == 'single':
+			return self.link_single(graph)
+		elif self.method == 'average':
+			return self.link_average(graph)
+		return None
+
+	def run(self, graph: DistanceGraph, starting_genotypes: Optional[List[List[str]]] = None,
+			similarity_cutoff: Optional[float] = None) -> projectdata.DataHierarchalCluster:
+		"""
+		Parameters
+		----------
+		graph: DistanceGraph
+		starting_genotypes: List[List[str]]
+			Each element should be a list of trajectories known to be in the same genotype.
+		similarity_cutoff: Optional[float]
+			The quantile of the pairwise distances used as the distance cutoff. Defaults to 0.05. If the quantile is
+			outside the bound of the graph, the bound is used instead.
+		"""
+		for genotype in (starting_genotypes or []):
+			missing = graph.set_group(genotype, 0)
+			if missing:
+				logger.warning(f"The following members of a known genotype are not in the distance graph and will be ignored: {missing}")
+
+		quantile = 0.05 if similarity_cutoff is None else similarity_cutoff
+		distance_cutoff = graph.calculate_cutoff_quantile(quantile)
+		if distance_cutoff is None or math.isnan(distance_cutoff):
+			logger.warning(f"The {quantile} quantile of the pairwise distances is outside the bound of {graph.bound}. Using the bound as the distance cutoff.")
+			distance_cutoff = graph.bound
+		logger.debug(f"Using the '{self.method}' sparse graph clustering with distance cutoff {distance_cutoff}")
+
+		n = len(graph.labels)
+		Z = self.link_clusters(graph)
+		if Z is None:
+			clusters = self.cluster_components(graph, distance_cutoff)
+			linkage_table = None
+		else:
+			clusters = cut_linkage(Z, n, distance_cutoff)
+			linkage_table = hierarchy.format_linkage_matrix(Z, n)
+
+		return projectdata.DataHierarchalCluster(
+			clusters = hierarchy.HierarchalCluster._label_clusters(clusters, graph.labels),
+			table_linkage = linkage_table,
+			distance_cutoff = distance_cutoff,
+			distance_quantile = quantile
+		)
@@ -106,6 +106,25 @@ class FixedBreakpointParser(argparse.Action):
 		setattr(namespace, self.dest, values)
 
 
+class CutoffRangeParser(argparse.Action):
+	""" Parses a list of similarity cutoffs. Each value is either a single cutoff or a `start:stop:step` range which includes `stop`."""
+	def __call__(self, parser, namespace, values, option_string = None):
+		cutoffs = list()
+		for value in values:
+			if ':' in value:
+				try:
+					start, stop, step = [float(i) for i in value.split(':')]
+				except ValueError:
+					parser.error(f"Expected a cutoff range formatted as 'start:stop:step', got '{value}'")
+				if step <= 0:
+					parser.error(f"The step of the cutoff range '{value}' must be positive.")
+				total = int(round((stop - start) / step)) + 1
+				cutoffs += [round(start + step * i, 10) for i in range(total) if start + step * i <= stop + step / 2]
+			else:
+				cutoffs.append(float(value))
+		setattr(namespace, self.dest, cutoffs)
+
+
 #####################################################################################
 ############################# Lineage Parser Groups #################################
 #####################################################################################
@@ -142,6 +161,13 @@ def _create_parser_lineage_group_graphics(parser: argparse.ArgumentParser):
 		action = 'store_false',
 		dest = 'draw_outline'
 	)
+	group_graphics.add_argument(
+		"--fast-linkage",
+		help = "Skips the optimal leaf ordering of the linkage table when drawing the dendrogram. "
+			   "The genotypes are the same, but the dendrogram is harder to read. Useful for large datasets.",
+		action = "store_true",
+		dest = "fast_linkage"
+	)
 	group_graphics.add_argument(
 		"--highlight",
 		help = "A comma-separated list of genotype names or annotations to highlight in the generated graphics.",
@@ -168,9 +194,11 @@ def _create_parser_lineage_group_data(parser: argparse.ArgumentParser):
 	group_data = parser.add_argument_group(title = "Input Data", description = "Additional data that can be used to improve the analysis.")
 	group_data.add_argument(
 		"--filename-pairwise",
-		help = "Path to a table with pairwise distance calculations from a previous run using identical input parameters. Should be located " \
-			   "in `tables/.distances.tsv in the output folder generated from the previous run. This table will be used rather than re-calculating " \
-			   "all the pairwise distances again which may take a long time for very large datasets.",
+		help = "Path to the pairwise distance calculations from a previous run using identical input parameters. Should be located " \
+			   "in `tables/.distance.npz` in the output folder generated from the previous run. These distances will be used rather than re-calculating " \
+			   "all the pairwise distances again which may take a long time for very large datasets. The `tables/.distance.tsv` table " \
+			   "can also be used, but the parameters used to generate it cannot be verified. The output folder of the previous run can also be given. " \
+			   "Trajectories which were removed from the input table are dropped and only the distances to new trajectories are calculated.",
 		action = "store",
 		dest = "filename_pairwise",
 		type = Path,
@@ -215,6 +243,41 @@ def _create_parser_lineage_group_genotype_generation(parser: argparse.ArgumentPa
 		type = int,
 		default = 1
 	)
+	analysis_group.add_argument(
+		"--memory-map",
+		help = "Writes the pairwise distances to a memory-mapped file in the output folder rather than holding them in memory. "
+			   "Use this for very large datasets where the distance matrix does not fit in memory.",
+		action = "store_true",
+		dest = "memory_map"
+	)
+	analysis_group.add_argument(
+		"--distance-cache",
+		help = "A folder used to store the pairwise distances between runs. Pairs of trajectories which were already "
+			   "calculated in a previous run with the same metric and limits are reused rather than calculated again.",
+		action = "store",
+		dest = "distance_cache",
+		type = Path,
+		default = None
+	)
+	analysis_group.add_argument(
+		"--distance-cache-size",
+		help = "The maximum number of pairwise distances to keep in the `--distance-cache` folder. "
+			   "The least-recently used pairs are removed first.",
+		action = "store",
+		dest = "distance_cache_size",
+		type = int,
+		default = 10_000_000
+	)
+	analysis_group.add_argument(
+		"--pair-statistics",
+		help = "A file used to store the per-pair sums of the binomial distance between runs. If the trajectories are the same "
+			   "as the previous run with additional timepoints, only the new timepoints are added to the distances. "
+			   "The file is created if it does not exist. Only used with the binomial, similarity and binomialp metrics.",
+		action = "store",
+		dest = "filename_statistics",
+		type = Path,
+		default = None
+	)
 
 	analysis_group.add_argument(
 		"--metric",
@@ -232,6 +295,24 @@ def _create_parser_lineage_group_genotype_generation(parser: argparse.ArgumentPa
 		type = float,
 		default = None
 	)
+	analysis_group.add_argument(
+		"--similarity-cutoffs",
+		help = "Cuts the linkage table at each of these similarity cutoffs and saves the number of genotypes and the quality of the "
+			   "clusters for each to the `.cutoffs` table. Values can be single cutoffs or ranges formatted as `start:stop:step`.",
+		action = CutoffRangeParser,
+		nargs = '+',
+		dest = "similarity_cutoffs",
+		default = None
+	)
+	analysis_group.add_argument(
+		"--select-cutoff",
+		help = "Uses the similarity cutoff with the best value of this statistic rather than `--similarity-cutoff`. "
+			   "Tests the `--similarity-cutoffs` values if given, otherwise 0.01 to 0.20.",
+		action = "store",
+		dest = "cutoff_criterion",
+		choices = ['silhouette', 'calinski-harabasz'],
+		default = None
+	)
 	analysis_group.add_argument(
 		"-p", "--pvalue",
 		help = "The p-value to use for the statistics tests",
@@ -273,6 +354,65 @@ def _create_parser_lineage_group_genotype_generation(parser: argparse.ArgumentPa
 		dest = "derivative_cutoff",
 		type = float
 	)
+	analysis_group.add_argument(
+		"--linkage-backend",
+		help = "How the linkage table used to cluster trajectories is generated. 'nn-chain' generates the same table as 'scipy' "
+			   "while using about half the memory, and keeps its working copy of the distances on disk with `--memory-map`.",
+		action = "store",
+		dest = "linkage_backend",
+		choices = ['scipy', 'nn-chain'],
+		default = 'scipy'
+	)
+	analysis_group.add_argument(
+		"--sparse-graph",
+		help = "Only keeps the pairs of trajectories within this distance and clusters them without generating the full distance "
+			   "matrix. Used for datasets with too many trajectories for the full matrix. The similarity cutoff is limited to this distance.",
+		action = "store",
+		dest = "sparse_graph_bound",
+		type = float,
+		default = None
+	)
+	analysis_group.add_argument(
+		"--sparse-method",
+		help = "How the sparse distance graph is clustered. 'components' and 'single' give the same genotypes, but 'single' "
+			   "also saves the linkage table. 'average' treats the pairs outside `--sparse-graph` as being at that distance.",
+		action = "store",
+		dest = "sparse_method",
+		choices = ['components', 'single', 'average'],
+		default = 'components'
+	)
+	analysis_group.add_argument(
+		"--prune-distance",
+		help = "Skips the pairs of trajectories whose detected and fixed timepoints guarantee a distance above this value and "
+			   "assigns them the maximum distance. Defaults to the `--sparse-graph` distance. Only used with the binomial, similarity, "
+			   "binomialp and minkowski metrics.",
+		action = "store",
+		dest = "prune_bound",
+		type = float,
+		default = None
+	)
+	analysis_group.add_argument(
+		"--verify-pruning",
+		help = "Also calculates the pruned pairs and reports any which are within `--prune-distance`.",
+		action = "store_true",
+		dest = "verify_pruning"
+	)
+	analysis_group.add_argument(
+		"--deduplicate",
+		help = "Only calculates the distances between trajectories with different frequencies. Trajectories with identical "
+			   "frequencies are clustered as a single weighted trajectory and are always assigned to the same genotype.",
+		action = "store_true",
+		dest = "deduplicate"
+	)
+	analysis_group.add_argument(
+		"--area-backend",
+		help = "How the areas of each pair of genotypes are calculated during lineage inference and for the `jaccard` metric. "
+			   "'numeric' integrates the series directly, 'shapely' builds a polygon for each series (slower).",
+		action = "store",
+		dest = "area_backend",
+		choices = ['numeric', 'shapely'],
+		default = 'numeric'
+	)
 	analysis_group.add_argument(
 		"--liberal",
 		help = "Whether to allow genotypes to be placed under more recent nested genotypes when an earlier genotype also passes the score check.",
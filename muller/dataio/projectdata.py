@@ -66,10 +66,10 @@ class DataGenotypeInference:
 		# Save the data
 		self.table_trajectories.to_csv(filename_table_trajectory, sep = delimiter)
 		self.table_genotypes.to_csv(filename_table_genotypes, sep = delimiter)
-		if self.clusterdata is not None:
+		if self.clusterdata is not None and self.clusterdata.table_linkage is not None:
 			self.clusterdata.table_linkage.to_csv(filename_table_linkage_matrix, sep = delimiter)
 		if self.matrix_distance is not None:
-			self.matrix_distance.squareform().to_csv(filename_table_distance_matrix, sep = delimiter)
+			self.matrix_distance.save_squareform(filename_table_distance_matrix, delimiter)
 
 		# Need to remove the `members` column from the genotype table so that the graphics workflow uses a purely numeric table
 		self.table_genotypes.pop('members')
@@ -81,6 +81,8 @@ class DataHierarchalCluster:
 	table_linkage: Optional[pandas.DataFrame]
 	distance_cutoff: float
 	distance_quantile: float
+	# The number of clusters and quality indices for each similarity cutoff tested, if any.
+	table_cutoffs: Optional[pandas.DataFrame] = None
 	def to_dict(self)->Dict[str,Any]:
 		data = {
 			'clusters': self.clusters,
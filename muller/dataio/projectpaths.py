@@ -43,7 +43,11 @@ class OutputFilenames:
 		self.filename_table_muller: Path = self.folder_tables / (name + f".muller.{suffix}")
 		self.filename_table_lineage_scores: Path = self.folder_tables / (name + '.lineagescores.tsv')
 		self.filename_table_linkage = self.folder_tables / (name + f".linkagematrix.tsv")
+		# Only used when more than one similarity cutoff is tested.
+		self.filename_table_cutoffs = self.folder_tables / (name + f".cutoffs.{suffix}")
 		self.filename_table_distance: Path = self.folder_tables / (name + f".distance.{suffix}")
+		# Binary copy of the distance table which can be reused with `--filename-pairwise`.
+		self.filename_table_distance_binary: Path = self.folder_tables / (name + ".distance.npz")
 
 		# graphics
 		# The extensions fo reach figure will be generated based on which file formats the
@@ -87,6 +91,10 @@ class OutputFilenames:
 		self.filename_parameters: Path = self.folder_supplementary / (name + '.options.json')
 		self.filename_clusterdata: Path = self.folder_supplementary / (name + '.clusterdata.json')
 		self.genotype_information: Path = self.folder_supplementary / (name + '.genotypeinformation.json')
+		# Only used with `--distance-cache`.
+		self.filename_distance_cache_statistics: Path = self.folder_supplementary / (name + '.distancecache.json')
+		# Only used with `--memory-map`.
+		self.filename_distance_memmap: Path = self.folder_supplementary / (name + '.distance.npy')
 
 	@staticmethod
 	def get_template(folder: Path, template: str, extension: str):
@@ -118,9 +126,14 @@ class OutputFilenames:
 		data.table_genotypes['members'] = [members[i] for i in data.table_genotypes.index]
 		data.table_genotypes.to_csv(self.filename_table_genotypes, sep = self.delimiter)
 		if data.matrix_distance is not None:
-			data.matrix_distance.squareform().to_csv(self.filename_table_distance, sep = self.delimiter)
+			data.matrix_distance.save_squareform(self.filename_table_distance, self.delimiter)
+			data.matrix_distance.save_binary(self.filename_table_distance_binary)
 		if data.clusterdata is not None:
-			data.clusterdata.table_linkage.to_csv(self.filename_table_linkage, sep = self.delimiter)
+			# The linkage table is not generated when the connected components of a sparse distance graph are used.
+			if data.clusterdata.table_linkage is not None:
+				data.clusterdata.table_linkage.to_csv(self.filename_table_linkage, sep = self.delimiter)
+			if data.clusterdata.table_cutoffs is not None:
+				data.clusterdata.table_cutoffs.to_csv(self.filename_table_cutoffs, sep = self.delimiter, index = False)
 
 		self.filename_data_genotype_members.write_text(json.dumps(data.genotype_members, indent = 4, sort_keys = True))
 
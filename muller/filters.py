@@ -1,8 +1,14 @@
 from typing import List, Optional
 
+import numpy
 import pandas
 from loguru import logger
 
+try:
+	from muller.inheritance import timepoint_detection
+except ModuleNotFoundError:
+	from .inheritance import timepoint_detection
+
 
 class TrajectoryFilter:
 	""" Filters trajectories (not genotypes) based on a set of criteria aimed at removing erroneous measurements.
@@ -162,20 +168,26 @@ class GenotypeFilter:
 		# backgrounds = _get_backgrounds_present_at_multiple_timepoints(backgrounds, detection_cutoff)
 		# We want to iterate over the non-background genotypes to check if they appear both before and after any genotypes that fix.
 		not_backgrounds = genotypes[~genotypes.index.isin(backgrounds.index)]
+		# The first and last detected timepoints of the non-background genotypes are the same for every background.
+		first, last = timepoint_detection.get_crossings(not_backgrounds.values, [self.detection_cutoff])
+		timepoints = numpy.asarray(not_backgrounds.columns, dtype = object)
+		# Genotypes which are undetected at all timepoints or are only detected once are also treated as invalid.
+		detected = first[0] < last[0]
+		first_detected = timepoints[timepoint_detection.to_positions(first[0])]
+		last_detected = timepoints[timepoint_detection.to_positions(last[0])]
+
 		# Iterate over the detected backgrounds.
 		for _, background in backgrounds.iterrows():
 			# Find the timepoint where the background first fixes.
 			first_detected_point: int = self.get_first_timepoint_above_cutoff(background, self.detection_cutoff)
 			first_fixed_point: int = self.get_first_timepoint_above_cutoff(background, self.fuzzy_fixed_cutoff)
 			background_value_at_first_fixed_point = background.loc[first_fixed_point]
-			# Iterate over the non-background genotypes.
-			for genotype_label, genotype in not_backgrounds.iterrows():
-				# Double check that it is not a background
-				if genotype_label in backgrounds.index: continue
-				# Check if it is invalid.
-				is_invalid = self.check_if_genotype_is_invalid(genotype, first_detected_point, first_fixed_point,background_value_at_first_fixed_point)
-				if is_invalid is not None:
-					return genotype_label
+			invalid = ~detected | self.check_if_genotypes_are_invalid(
+				not_backgrounds[first_fixed_point].values, first_detected, last_detected,
+				first_detected_point, first_fixed_point, background_value_at_first_fixed_point
+			)
+			if invalid.any():
+				return not_backgrounds.index[numpy.flatnonzero(invalid)[0]]
 
 	# noinspection PyTypeChecker
 	@staticmethod
@@ -183,15 +195,18 @@ class GenotypeFilter:
 		""" Extracts the first timepoint that exceeds the cutoff."""
 		return series[series > cutoff].idxmin()
 
-	# noinspection PyTypeChecker
-	def check_if_genotype_is_invalid(self, genotype: pandas.Series, background_detected: int, background_fixed: int, background_value: float) -> Optional[str]:
+	def check_if_genotypes_are_invalid(self, value_at_fixed_point: numpy.ndarray, first_detected: numpy.ndarray, last_detected: numpy.ndarray,
+			background_detected: int, background_fixed: int, background_value: float) -> numpy.ndarray:
 		"""
-			Checks if a genotype does not adhere to certain assumptions related to the background.
+			Checks which genotypes do not adhere to certain assumptions related to the background.
 			1. The genotype should not be present both before and after a background fixes, and should be nonzero when the background fixes.
 		Parameters
 		----------
-		genotype: pandas.Series
-			The genotype being tested.
+		value_at_fixed_point: numpy.ndarray
+			The frequency of each genotype at `background_fixed`.
+		first_detected, last_detected: numpy.ndarray
+			The first and last timepoints each genotype was detected. Genotypes detected at fewer than two timepoints
+			should be checked by the caller.
 		background_detected: int
 			The first timepoint the background was detected.
 		background_fixed: int
@@ -201,29 +216,18 @@ class GenotypeFilter:
 
 		Returns
 		-------
-		bool
+		numpy.ndarray
+			Whether each genotype was detected before and after the background fixed.
 		"""
-		# get the nonzero timepoints for the genotype.
-		detected_points = genotype[genotype > self.detection_cutoff]
-
-		if len(detected_points) < 2:
-			# The genotype is either undetected at all timepoints or is detected once.
-			return "notEnoughTimpoints"
-
-		first_detected = detected_points.first_valid_index()
-		last_detected = detected_points.last_valid_index()
-
-		# Check if the genotype was detected prior to the background. Skip those that were not.
-		was_detected_before_and_after_background = first_detected < background_detected < last_detected
+		# Check if the genotype was detected prior to the background.
+		was_detected_before_and_after_background = (first_detected < background_detected) & (background_detected < last_detected)
 		# Check if the genotype was detected before and after the timepoint the current backgound fixed.
-		was_detected_before_and_after_fixed = first_detected < background_fixed < last_detected
-		# print(genotype.name, (first_detected, background_detected), (last_detected, background_detected), was_detected_before_and_after_fixed, was_detected_before_and_after_background)
-		if was_detected_before_and_after_background and was_detected_before_and_after_fixed:
+		was_detected_before_and_after_fixed = (first_detected < background_fixed) & (background_fixed < last_detected)
+		invalid = (was_detected_before_and_after_background & was_detected_before_and_after_fixed).astype(bool)
+		if not self.strict:
 			# To confirm that it is an invalid genotype rather than a genotype that was wiped out by a background and then reapeared,
 			# Check to see if it was undetected at the timpont the background fixed.
-			value_at_fixed_point = genotype.loc[background_fixed]
-			fixed_point_value = value_at_fixed_point + background_value
-			if self.strict or (value_at_fixed_point > self.detection_cutoff and fixed_point_value > (1 + self.detection_cutoff)):
-				# The genotype was detected at the first fixed timepoint.
-				return "presentBeforeAndAfterFixedGenotype"
-		return None
+			with numpy.errstate(invalid = 'ignore'):
+				fixed_point_value = value_at_fixed_point + background_value
+				invalid &= (value_at_fixed_point > self.detection_cutoff) & (fixed_point_value > (1 + self.detection_cutoff))
+		return invalid
@@ -1,24 +1,61 @@
 from pathlib import Path
-from typing import List, Optional
+from typing import Optional, Sequence, Tuple
 
 import matplotlib.pyplot as plt
+import numpy
 import seaborn
 
 # plt.style.use("/home/cld100/Documents/sandbox/matplotlibrc")
 
+CHUNK_SIZE = 2 ** 22
 
-def generate_distance_plot(distances: List[float], similarity_cutoff: float, filename: Optional[Path] = None, ax: plt.Axes = None):
-	""" Shows the spread of computed pairwise distances as a histogram."""
+
+def calculate_histogram(distances: Sequence[float], bins: int = 20, chunk_size: int = CHUNK_SIZE) -> Tuple[numpy.ndarray, numpy.ndarray]:
+	"""
+		Same as `numpy.histogram(distances, bins)`, but `distances` is read in chunks so that memory-mapped distance vectors
+		are never loaded into memory all at once. NaN values are ignored.
+	Returns
+	-------
+	numpy.ndarray, numpy.ndarray
+		The count in each bin and the edges of the bins.
+	"""
+	minimum, maximum = numpy.inf, -numpy.inf
+	for start in range(0, len(distances), chunk_size):
+		chunk = numpy.asarray(distances[start:start + chunk_size], dtype = float)
+		chunk = chunk[~numpy.isnan(chunk)]
+		if len(chunk):
+			minimum, maximum = min(minimum, chunk.min()), max(maximum, chunk.max())
+	if minimum > maximum:
+		minimum, maximum = 0, 1
+
+	edges = numpy.histogram_bin_edges([], bins = bins, range = (minimum, maximum))
+	counts = numpy.zeros(bins, dtype = numpy.int64)
+	for start in range(0, len(distances), chunk_size):
+		chunk = numpy.asarray(distances[start:start + chunk_size], dtype = float)
+		counts += numpy.histogram(chunk[~numpy.isnan(chunk)], bins = edges)[0]
+	return counts, edges
+
+
+def generate_distance_plot(distances: Sequence[float], similarity_cutoff: float, filename: Optional[Path] = None, ax: plt.Axes = None,
+		maximum_rug: int = 10000):
+	"""
+		Shows the spread of computed pairwise distances as a histogram. `distances` may be the condensed distance vector,
+		which is read in chunks. The individual distances are only marked along the x-axis if there are at most
+		`maximum_rug` of them.
+	"""
 	if not ax:
 		fig, ax = plt.subplots(figsize = (12, 10))
 
-	seaborn.distplot(distances, ax = ax, kde = False, rug = True, bins = 20)
+	counts, edges = calculate_histogram(distances, bins = 20)
+	ax.hist(edges[:-1], bins = edges, weights = counts, alpha = 0.4)
+	if len(distances) <= maximum_rug:
+		seaborn.rugplot(numpy.asarray(distances), ax = ax)
 	ax.axvline(similarity_cutoff, color = 'red')
 
 	ax.set_title("Pairwise distances between each pair of trajectories")
 	ax.set_xlabel("Distance")
 	ax.set_ylabel("Count")
-	ax.set_xlim(0, max(distances))
+	ax.set_xlim(0, edges[-1])
 	plt.tight_layout()
 	if filename:
 		plt.savefig(filename)
@@ -1,9 +1,12 @@
+import math
 from pathlib import Path
 from typing import Dict, List, Optional
 
 import pandas
+from loguru import logger
 
 from muller import graphics
+from muller.clustering import hierarchy
 from muller.graphics import Palette
 
 # The filenames should be mapped to their corresponding palette.
@@ -68,13 +71,25 @@ class OutputGeneratorGraphics:
 	##############################################################################################################################################
 
 	@staticmethod
-	def generate_dendrogram(linkage_matrix, distance_matrix, filename: Path) -> Path:
-		# Only need the distance matrix fpr the labels
-		labels = distance_matrix.squareform().index
+	def generate_dendrogram(linkage_matrix, distance_matrix, filename: Path, optimal_ordering: bool = True) -> Path:
+		"""
+			Plots the dendrogram. The leaves are reordered with `hierarchy.order_linkage_table` unless `optimal_ordering`
+			is disabled, in which case the leaves are drawn in the order they were merged.
+		"""
+		labels = distance_matrix.labels
+		if optimal_ordering:
+			linkage_matrix = hierarchy.order_linkage_table(linkage_matrix, distance_matrix.triangle())
 		graphics.plot_dendrogram(linkage_matrix, labels, filename)
 		return filename
 	@staticmethod
-	def generate_heatmap(squareform: pandas.DataFrame, filename: Path) -> Path:
-
-		graphics.plot_heatmap(squareform, filename)
+	def generate_heatmap(distance_matrix, filename: Path, maximum_size: int = 1000) -> Path:
+		"""
+			Plots the pairwise distance matrix. Only an evenly-spaced subset of at most `maximum_size` trajectories is
+			included for larger datasets so that the full square matrix never has to be built.
+		"""
+		labels = distance_matrix.labels
+		if len(labels) > maximum_size:
+			logger.info(f"Only including {maximum_size} of {len(labels)} trajectories in the distance heatmap.")
+			labels = labels[::math.ceil(len(labels) / maximum_size)]
+		graphics.plot_heatmap(distance_matrix.squareform(labels), filename)
 		return filename
@@ -0,0 +1,155 @@
+"""
+	Array-based calculation of the areas used to compare two series.
+	Each series is treated as the piecewise-linear curve through its values, which is the same curve `polygon.get_vertices`
+	builds for shapely. Since both series of a pair share the same timepoints, the intersection of the two polygons is just
+	the area under `min(left, right)`, so every area can be integrated exactly one segment at a time without building any
+	geometry. All functions operate on the last axis, so a 2-D array of pairs is processed at once.
+"""
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy
+import pandas
+
+try:
+	from muller.inheritance.polygon import MINIMUM
+except ModuleNotFoundError:
+	from .polygon import MINIMUM
+
+# 'numeric' uses this module, 'shapely' builds a polygon for every series.
+AREA_BACKENDS = ['numeric', 'shapely']
+
+
+@dataclass
+class PairAreas:
+	""" The areas of each pair of series. Each attribute is an array with one value per pair."""
+	left: numpy.ndarray
+	right: numpy.ndarray
+	# Area under both `left` and `right`.
+	intersection: numpy.ndarray
+	# Area under either `left` or `right`.
+	union: numpy.ndarray
+	# Area under `left` but not `right` and vice versa.
+	difference_left: numpy.ndarray
+	difference_right: numpy.ndarray
+
+
+def _get_window_bounds(window: numpy.ndarray):
+	""" Returns masks of the first and last timepoint of each contiguous `window`."""
+	first = window & ~numpy.concatenate([numpy.zeros_like(window[..., :1]), window[..., :-1]], axis = -1)
+	last = window & ~numpy.concatenate([window[..., 1:], numpy.zeros_like(window[..., :1])], axis = -1)
+	return first, last
+
+
+def get_heights(values: numpy.ndarray, window: Optional[numpy.ndarray] = None) -> numpy.ndarray:
+	"""
+		Array version of the y-values from `polygon.get_vertices`. Values below `polygon.MINIMUM` are raised to the minimum
+		except at the first and last timepoint, so a series is always a single polygon.
+	Parameters
+	----------
+	values: numpy.ndarray
+	window: Optional[numpy.ndarray]
+		A boolean mask with the same shape as `values` selecting a contiguous range of timepoints for each series.
+		Timepoints outside the window are set to 0.
+	"""
+	values = numpy.asarray(values, dtype = float)
+	heights = numpy.maximum(values, MINIMUM)
+	if window is None:
+		heights[..., 0] = values[..., 0]
+		heights[..., -1] = values[..., -1]
+	else:
+		first, last = _get_window_bounds(window)
+		endpoints = first | last
+		heights = numpy.where(endpoints, values, heights)
+		heights = numpy.where(window, heights, 0)
+	return heights
+
+
+def get_segments(window: Optional[numpy.ndarray], shape) -> numpy.ndarray:
+	""" Returns a mask of the line segments between consecutive timepoints which are both in `window`."""
+	if window is None:
+		return numpy.ones(shape[:-1] + (shape[-1] - 1,), dtype = bool)
+	return window[..., :-1] & window[..., 1:]
+
+
+def get_widths(timepoints: Optional[numpy.ndarray], shape) -> numpy.ndarray:
+	""" The width of each segment. Timepoints are evenly spaced by default, as in `polygon.get_vertices`."""
+	if timepoints is None:
+		return numpy.ones(shape[-1] - 1)
+	return numpy.diff(numpy.asarray(timepoints, dtype = float))
+
+
+def _integrate(heights: numpy.ndarray, segments: numpy.ndarray, widths: numpy.ndarray) -> numpy.ndarray:
+	""" Trapezoidal integral of each series over the selected segments."""
+	trapezoids = (heights[..., :-1] + heights[..., 1:]) / 2 * widths
+	return numpy.where(segments, trapezoids, 0).sum(axis = -1)
+
+
+def _integrate_absolute(difference: numpy.ndarray, segments: numpy.ndarray, widths: numpy.ndarray) -> numpy.ndarray:
+	""" Exact integral of |difference| where `difference` is linear between timepoints and may change sign within a segment."""
+	start = difference[..., :-1]
+	stop = difference[..., 1:]
+	total = numpy.abs(start) + numpy.abs(stop)
+	crossing = (start * stop) < 0
+	# When the sign changes the segment is split into two triangles at the root.
+	triangles = numpy.divide(start ** 2 + stop ** 2, 2 * total, out = numpy.zeros_like(total), where = crossing)
+	areas = numpy.where(crossing, triangles, total / 2) * widths
+	return numpy.where(segments, areas, 0).sum(axis = -1)
+
+
+def calculate_area(values: numpy.ndarray, window: Optional[numpy.ndarray] = None,
+		timepoints: Optional[numpy.ndarray] = None) -> numpy.ndarray:
+	""" Array version of `areascore.area_of_series`."""
+	values = numpy.asarray(values, dtype = float)
+	heights = get_heights(values, window)
+	return _integrate(heights, get_segments(window, values.shape), get_widths(timepoints, values.shape))
+
+
+def calculate_areas(left: numpy.ndarray, right: numpy.ndarray, window: Optional[numpy.ndarray] = None,
+		timepoints: Optional[numpy.ndarray] = None) -> PairAreas:
+	"""
+		Calculates the area, intersection, union and difference of each pair of series.
+	Parameters
+	----------
+	left, right: numpy.ndarray
+		Arrays of the same shape. Each row (or the array itself, if 1-D) is one series.
+	window: Optional[numpy.ndarray]
+		Restricts each pair to a contiguous range of timepoints. See `get_heights`.
+	timepoints: Optional[numpy.ndarray]
+		The x-value of each timepoint. Defaults to evenly-spaced timepoints.
+	"""
+	left = numpy.asarray(left, dtype = float)
+	right = numpy.asarray(right, dtype = float)
+	segments = get_segments(window, left.shape)
+	widths = get_widths(timepoints, left.shape)
+
+	heights_left = get_heights(left, window)
+	heights_right = get_heights(right, window)
+	area_left = _integrate(heights_left, segments, widths)
+	area_right = _integrate(heights_right, segments, widths)
+	area_absolute = _integrate_absolute(heights_left - heights_right, segments, widths)
+
+	# min(l, r) = (l + r - |l - r|) / 2 and max(l, r) = (l + r + |l - r|) / 2
+	intersection = (area_left + area_right - area_absolute) / 2
+	union = (area_left + area_right + area_absolute) / 2
+
+	return PairAreas(
+		left = area_left,
+		right = area_right,
+		intersection = intersection,
+		union = union,
+		difference_left = area_left - intersection,
+		difference_right = area_right - intersection
+	)
+
+
+def calculate_series_areas(left: pandas.Series, right: pandas.Series) -> PairAreas:
+	""" Same as `calculate_areas`, but accepts two series which share the same timepoints."""
+	return calculate_areas(left.values, right.values)
+
+
+def jaccard_distance(left: numpy.ndarray, right: numpy.ndarray, window: Optional[numpy.ndarray] = None) -> numpy.ndarray:
+	""" Array version of `distance_methods.jaccard_distance`."""
+	areas = calculate_areas(left, right, window)
+	with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+		return 1 - areas.intersection / areas.union
@@ -203,9 +203,11 @@ def is_subset(left: pandas.Series, right: pandas.Series) -> bool:
 def is_subset_polygon(left: geometry.MultiPolygon, right: geometry.MultiPolygon) -> bool:
 	area_union = left.union(right).area
 	area_intersection = left.intersection(right).area
-	area_left = left.area
-	area_right = right.area
+	return is_subset_numeric(left.area, right.area, area_intersection, area_union)
 
+
+def is_subset_numeric(area_left: float, area_right: float, area_intersection: float, area_union: float) -> bool:
+	""" Same as `is_subset_polygon`, but operates on pre-computed areas (see `area_engine.calculate_areas`)."""
 	result = math.isclose(area_intersection, area_right, abs_tol = 0.03 ** 2)
 
 	jaccard_expected = (area_left - area_right) / area_left
@@ -6,10 +6,12 @@ from loguru import logger
 try:
 	from muller.inheritance import scoring
 	from muller.inheritance.genotype_ancestry import Ancestry
+	from muller.inheritance.score_engine import ScoreEngine
 	from muller import widgets, dataio
 except ModuleNotFoundError:
 	from . import scoring
 	from .genotype_ancestry import Ancestry
+	from .score_engine import ScoreEngine
 	from .. import widgets, dataio
 
 
@@ -24,16 +26,22 @@ class LineageWorkflow:
 		The cutoff value to consider a genotype "fixed"
 	pvalue: float
 		The pvalue to use for statistical tests.
+	area_backend: str
+		How the area scores are calculated. Either 'numeric' or 'shapely'.
+	threads: Optional[int]
+		The number of processes used to score the genotypes.
 	"""
 
-	def __init__(self, dlimit: float, flimit: float, pvalue: float, weights = (1, 1, 2, 2), conservative:bool = False,debug: bool = False):
+	def __init__(self, dlimit: float, flimit: float, pvalue: float, weights = (1, 1, 2, 2), conservative:bool = False,debug: bool = False,
+			area_backend: str = 'numeric', threads: Optional[int] = None):
 		self.dlimit = dlimit
+		self.threads = threads
 		self.flimit = flimit
 		self.pvalue = pvalue
 		self.debug = debug
 		self.genotype_nests: Optional[Ancestry] = None
 		self.conservative = conservative
-		self.scorer = scoring.Score(self.dlimit, self.flimit, self.pvalue, weights)
+		self.scorer = scoring.Score(self.dlimit, self.flimit, self.pvalue, weights, area_backend = area_backend)
 
 	def __repr__(self)->str:
 		return f"LineageWorkflow(dlimit = {self.dlimit}, flimit = {self.flimit}, pvalue = {self.pvalue})"
@@ -70,14 +78,15 @@ class LineageWorkflow:
 
 		score_records: List[Dict[str, float]] = list()  # Keeps track of the individual score values for each pair
 
-		for unnested_label, unnested_trajectory in sorted_genotypes[1:].iterrows():
-			# Iterate over the rest of the table in reverse order. Basically, we start with the newest nest and iterate until we find a nest that satisfies the filters.
-			test_table = sorted_genotypes[:unnested_label].iloc[::-1]
-			for nested_label, nested_genotype in test_table.iterrows():
-				if nested_label == unnested_label: continue
-				score_data = self.scorer.score_pair(nested_genotype, unnested_trajectory)
+		# Each genotype is scored against every older genotype at once. The records are the same as `Score.score_pair`.
+		# The genotypes may be scored in parallel, but the records are added to the ancestry in the same order as the table.
+		engine = ScoreEngine(self.scorer, threads = self.threads).load(sorted_genotypes)
+		for position, genotype_records in engine.iterate_genotypes():
+			unnested_label = sorted_genotypes.index[position]
+			# The candidates start with the newest nest and continue until the first genotype in the table.
+			for score_data in genotype_records:
 				score_records.append(score_data)
-				self.genotype_nests.add_genotype_to_background(unnested_label, nested_label, score_data['totalScore'])
+				self.genotype_nests.add_genotype_to_background(unnested_label, score_data['nestedGenotype'], score_data['totalScore'])
 
 		self.show_ancestry(sorted_genotypes)
 
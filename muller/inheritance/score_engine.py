@@ -0,0 +1,410 @@
+"""
+	Array-based version of `scoring.Score.score_pair`. One unnested genotype is scored against every candidate background
+	at once, with a row of each array for each candidate. Every window of timepoints `widgets.get_valid_points` would select
+	is calculated as a boolean mask, so no series are sliced. Sums, means and dot products are calculated from the selected
+	timepoints of each row in the same order as the pandas and numpy calls in `scoring`, so the scores are identical to
+	the scores from `score_pair`. The genotypes can be scored in parallel, since the scores only depend on the genotype table.
+"""
+import multiprocessing
+import statistics
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy
+import pandas
+import scipy.stats as stats
+from loguru import logger
+
+try:
+	from multiprocessing import shared_memory
+except ImportError:
+	# Python < 3.8. Each worker receives a copy of the genotype array instead.
+	shared_memory = None
+
+try:
+	from muller.inheritance import area_engine
+	from muller.inheritance import scoring
+except ModuleNotFoundError:
+	from . import area_engine
+	from . import scoring
+
+# `widgets.get_valid_points` treats any value above this as undetected when given a fixed limit.
+VALID_POINTS_FIXED_LIMIT = 0.97
+
+
+@dataclass
+class PairScores:
+	""" The scores of each candidate background. Each attribute is an array with one value per candidate."""
+	greater: numpy.ndarray
+	fixed: numpy.ndarray
+	area: numpy.ndarray
+	derivative: numpy.ndarray
+	total: numpy.ndarray
+	# Whether the candidate and the unnested genotype were both detected at any timepoint.
+	overlap: numpy.ndarray
+
+
+def get_timepoint_keys(columns: Sequence[Any]) -> numpy.ndarray:
+	""" The value `widgets.get_valid_points` orders the timepoints by. Labels which are not numbers are ordered by position."""
+	try:
+		return numpy.array([float(column) for column in columns], dtype = float)
+	except (TypeError, ValueError):
+		return numpy.arange(len(columns), dtype = float)
+
+
+def iterate_selected(mask: numpy.ndarray) -> Iterator[Tuple[numpy.ndarray, numpy.ndarray]]:
+	"""
+		Groups the rows of `mask` by the number of selected timepoints. Yields the rows in each group and the positions of
+		their selected timepoints, in order. Gathering the selected values into an array with one row per series makes
+		numpy reduce each row exactly like the 1-D series the scalar version operates on.
+	"""
+	counts = mask.sum(axis = 1)
+	order = numpy.argsort(~mask, axis = 1, kind = 'stable')
+	for count in numpy.unique(counts):
+		rows = numpy.flatnonzero(counts == count)
+		yield rows, order[rows, :count]
+
+
+def sum_selected(values: numpy.ndarray, mask: numpy.ndarray) -> numpy.ndarray:
+	""" The sum of the selected values of each row. Rows without any selected values sum to 0."""
+	result = numpy.zeros(len(values))
+	for rows, positions in iterate_selected(mask):
+		result[rows] = values[rows[:, numpy.newaxis], positions].sum(axis = 1)
+	return result
+
+
+def dot_selected(left: numpy.ndarray, right: numpy.ndarray, mask: numpy.ndarray) -> numpy.ndarray:
+	""" The dot product of the selected values of each pair of rows, calculated with the same BLAS call as `numpy.dot`."""
+	result = numpy.zeros(len(left))
+	for rows, positions in iterate_selected(mask):
+		index = (rows[:, numpy.newaxis], positions)
+		result[rows] = numpy.matmul(left[index][:, numpy.newaxis, :], right[index][:, :, numpy.newaxis])[:, 0, 0]
+	return result
+
+
+def isclose(left: numpy.ndarray, right: numpy.ndarray, abs_tol: float, rel_tol: float = 1E-9) -> numpy.ndarray:
+	""" Array version of `math.isclose`. Unlike `numpy.isclose`, the comparison is symmetric."""
+	with numpy.errstate(invalid = 'ignore'):
+		difference = numpy.abs(right - left)
+		result = (difference <= numpy.abs(rel_tol * right)) | (difference <= numpy.abs(rel_tol * left)) | (difference <= abs_tol)
+	result &= numpy.isfinite(left) & numpy.isfinite(right)
+	return result | (left == right)
+
+
+def is_subset(area_left: numpy.ndarray, area_right: numpy.ndarray, area_intersection: numpy.ndarray, area_union: numpy.ndarray) -> numpy.ndarray:
+	"""
+		Array version of `areascore.is_subset_numeric`. Pairs with an empty area, which raise a `ZeroDivisionError` in the
+		scalar version, are not subsets.
+	"""
+	with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+		jaccard_expected = (area_left - area_right) / area_left
+		jaccard_actual = (area_union - area_intersection) / area_union
+	return isclose(jaccard_expected, jaccard_actual, abs_tol = 0.1)
+
+
+class ScoreEngine:
+	"""
+		Scores an unnested genotype against every candidate background at once. Uses the parameters and weights of `scorer`.
+
+		Usage
+		-----
+		engine = ScoreEngine(scorer).load(sorted_genotypes)
+		score_records = engine.score_genotype(5)
+	Parameters
+	----------
+	scorer: scoring.Score
+	threads: Optional[int]
+		The number of processes used by `iterate_genotypes`. The genotype array is shared with every process.
+	"""
+
+	def __init__(self, scorer: scoring.Score, threads: Optional[int] = None):
+		self.scorer = scorer
+		self.threads = threads
+		self.dlimit = scorer.dlimit
+		self.flimit = scorer.flimit
+		self.slimit = scorer.slimit
+		self.pvalue = scorer.pvalue
+
+		self.labels: List[Any] = list()
+		self.columns: List[Any] = list()
+		self.values = numpy.empty((0, 0))
+		self.keys = numpy.empty(0)
+
+	def load(self, genotypes: pandas.DataFrame) -> 'ScoreEngine':
+		""" Saves the genotype frequencies as an array. Each row is one genotype."""
+		return self.load_array(list(genotypes.index), list(genotypes.columns), genotypes.to_numpy(dtype = float))
+
+	def load_array(self, labels: List[Any], columns: List[Any], values: numpy.ndarray) -> 'ScoreEngine':
+		""" Same as `load`, but uses an existing 2-D array of genotype frequencies. Used by the worker processes."""
+		self.labels = list(labels)
+		self.columns = list(columns)
+		self.values = values
+		self.keys = get_timepoint_keys(self.columns)
+		return self
+
+	def get_windows(self, mask: numpy.ndarray) -> numpy.ndarray:
+		"""
+			The timepoints `widgets.get_valid_points` keeps for each row, given the timepoints which satisfy the detection
+			criteria. This is every timepoint between the earliest and latest selected timepoint.
+		"""
+		selected = mask.any(axis = 1)
+		start = numpy.where(mask, self.keys, numpy.inf).argmin(axis = 1)
+		stop = numpy.where(mask, self.keys, -numpy.inf).argmax(axis = 1) + 1
+		start = numpy.where(selected, start, 0)
+		stop = numpy.where(selected, stop, 0)
+		timepoints = numpy.arange(mask.shape[1])
+		return (timepoints >= start[:, numpy.newaxis]) & (timepoints < stop[:, numpy.newaxis])
+
+	def _is_significantly_above_fixed(self, mean: numpy.ndarray, count: numpy.ndarray) -> numpy.ndarray:
+		""" The t-test from `Score._multiple_sample_ttest`, converted to a one-sided test."""
+		statistic, pvalue = stats.ttest_ind_from_stats(
+			mean1 = mean,
+			std1 = self.dlimit ** 2,
+			nobs1 = count,
+			mean2 = 1 + self.dlimit,
+			std2 = self.dlimit ** 2,
+			nobs2 = count
+		)
+		return (pvalue / 2 < self.pvalue) & (statistic > 0)
+
+	def _calculate_ttest(self, combined: numpy.ndarray, mask: numpy.ndarray) -> numpy.ndarray:
+		"""
+			The scalar version uses `statistics.mean`, which is exact. The mean calculated by numpy can differ by a few
+			units in the last place, so the test is repeated at both ends of that error and only the pairs where the result
+			changes use `statistics.mean`.
+		"""
+		count = mask.sum(axis = 1)
+		mean = sum_selected(combined, mask) / count
+		error = 2 * (count + 1) * numpy.finfo(float).eps * sum_selected(numpy.abs(combined), mask) / count
+		result = self._is_significantly_above_fixed(mean - error, count)
+		uncertain = numpy.flatnonzero(result != self._is_significantly_above_fixed(mean + error, count))
+		for row in uncertain:
+			exact_mean = statistics.mean(combined[row][mask[row]].tolist())
+			result[row] = self._is_significantly_above_fixed(numpy.array([exact_mean]), count[[row]])[0]
+		return result
+
+	def calculate_score_fixed(self, nested: numpy.ndarray, unnested: numpy.ndarray, window: numpy.ndarray) -> numpy.ndarray:
+		""" `LegacyScore.calculate_summation_score` for windows with fewer than 3 timepoints, `Score.calculate_score_above_fixed` otherwise."""
+		result = numpy.zeros(len(nested), dtype = int)
+		size = window.sum(axis = 1)
+		combined = nested + unnested
+		with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+			# Same as `pandas.Series.mean`, which fills missing values with 0 and divides by the number of values which are not missing.
+			above_fixed = combined - self.flimit
+			present = window & ~numpy.isnan(above_fixed)
+			mean = sum_selected(numpy.where(present, above_fixed, 0), window) / present.sum(axis = 1)
+			result[size < 3] = (mean > self.pvalue)[size < 3]
+
+			# Only the timepoints where both genotypes were detected, not including the first timepoint.
+			detected = self.get_windows(window & (nested > self.dlimit) & (unnested > self.dlimit))
+			selected = detected & (detected.cumsum(axis = 1) > 1)
+			count = selected.sum(axis = 1)
+			single = (size >= 3) & (count == 1)
+			position = selected.argmax(axis = 1)
+			result[single] = combined[single, position[single]] > self.flimit
+			multiple = (size >= 3) & (count > 1)
+			if multiple.any():
+				result[multiple] = self._calculate_ttest(combined[multiple], selected[multiple])
+		return result
+
+	def calculate_score_greater(self, nested: numpy.ndarray, unnested: numpy.ndarray, window: numpy.ndarray) -> Tuple[numpy.ndarray, numpy.ndarray]:
+		""" `Score.calculate_score_greater`. Also returns whether each pair overlaps, since those scores are not weighted."""
+		overlap = (window & (nested > self.dlimit) & (unnested > self.dlimit)).any(axis = 1)
+		difference = nested - unnested
+		cutoff = window.sum(axis = 1) * 0.5
+
+		def get_evidence(selected: numpy.ndarray) -> numpy.ndarray:
+			timepoints = selected.sum(axis = 1)
+			total = sum_selected(difference, selected)
+			with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+				mean = numpy.abs(total / timepoints)
+			is_consistent = (timepoints > cutoff) & (mean > self.dlimit)
+			is_significant = numpy.abs(total) > self.slimit
+			return is_consistent | is_significant
+
+		with numpy.errstate(invalid = 'ignore'):
+			greater = get_evidence(window & (difference > self.dlimit))
+			less = get_evidence(window & (difference < -self.dlimit))
+		# Ambiguous pairs are scored as 0.
+		score = numpy.where(greater & ~less, 1.0, numpy.where(less & ~greater, -1.0, 0.0))
+		score = numpy.where(overlap, score, -self.scorer.weight_greater)
+		return score, overlap
+
+	def calculate_areas(self, nested: numpy.ndarray, unnested: numpy.ndarray, other: numpy.ndarray) -> List[numpy.ndarray]:
+		""" Array version of `Score._calculate_areas_numeric`. Falls back to the polygons for each pair with the shapely backend."""
+		if self.scorer.area_backend != 'numeric':
+			areas = [
+				self.scorer.calculate_areas_polygon(*(pandas.Series(series, index = self.columns) for series in pair))
+				for pair in zip(nested, unnested, other)
+			]
+			return [numpy.array(values) for values in zip(*areas)]
+
+		count = len(nested)
+		areas = area_engine.calculate_areas(numpy.concatenate([nested, other]), numpy.concatenate([unnested, unnested]))
+		area_left, area_right, area_intersection, area_union = areas.left, areas.right, areas.intersection, areas.union
+		return [
+			is_subset(area_left[:count], area_right[:count], area_intersection[:count], area_union[:count]),
+			is_subset(area_left[count:], area_right[count:], area_intersection[count:], area_union[count:]),
+			is_subset(area_right[:count], area_left[:count], area_intersection[:count], area_union[:count]),
+			area_left[:count],
+			area_right[:count],
+			area_intersection[:count],
+			areas.difference_right[:count],
+			area_intersection[count:]
+		]
+
+	def calculate_score_area(self, nested: numpy.ndarray, unnested: numpy.ndarray) -> numpy.ndarray:
+		""" `Score.calculate_score_area`."""
+		difference = nested - unnested
+		present = ~numpy.isnan(difference)
+		with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+			mean = numpy.where(present, difference, 0).sum(axis = 1) / present.sum(axis = 1)
+			other = numpy.where((mean > 0)[:, numpy.newaxis], self.flimit - nested, self.flimit - unnested)
+			other = numpy.where(other < 0, 0.0001, other)
+
+		areas = self.calculate_areas(nested, unnested, other)
+		is_subset_nested, is_subset_other, is_subset_nested_reversed, nested_area, unnested_area, common_area_nested, xor_area_unnested, common_area_other = areas
+
+		score = numpy.zeros(len(nested), dtype = int)
+		score[is_subset_nested_reversed & ~is_subset_other] = -1
+		score[is_subset_nested] = 1
+		both = is_subset_nested & is_subset_other
+		score[both] = (common_area_nested > 2 * common_area_other)[both]
+
+		score = numpy.where((score == 0) & (xor_area_unnested > common_area_nested * 2), -1, numpy.where(unnested_area > 2 * nested_area, -1, score))
+		return score * self.scorer.weight_jaccard
+
+	def calculate_score_derivative(self, nested: numpy.ndarray, unnested: numpy.ndarray) -> numpy.ndarray:
+		""" `Score.calculate_score_derivative` over the timepoints where both genotypes were detected."""
+		detected = self.get_windows((nested > self.dlimit) & (unnested > self.dlimit))
+		masked_nested = numpy.where(nested > VALID_POINTS_FIXED_LIMIT, -1, nested)
+		masked_unnested = numpy.where(unnested > VALID_POINTS_FIXED_LIMIT, -1, unnested)
+		window = self.get_windows(detected & (masked_nested > self.dlimit) & (masked_unnested > self.dlimit))
+
+		# The change between consecutive timepoints in the window.
+		segments = window[:, 1:] & window[:, :-1]
+		dotproduct = dot_selected(numpy.diff(nested, axis = 1), numpy.diff(unnested, axis = 1), segments)
+		score = numpy.where(dotproduct > 0.01, 1, numpy.where(dotproduct < -0.01, -1, 0))
+		return score * self.scorer.weight_derivative
+
+	def score(self, unnested: numpy.ndarray, candidates: numpy.ndarray) -> PairScores:
+		"""
+			Scores the unnested genotype against each candidate background.
+		Parameters
+		----------
+		unnested: numpy.ndarray
+			The frequencies of the unnested genotype.
+		candidates: numpy.ndarray
+			2-D array of the frequencies of each candidate background.
+		"""
+		nested = numpy.asarray(candidates, dtype = float).reshape(-1, len(self.columns))
+		unnested = numpy.broadcast_to(numpy.asarray(unnested, dtype = float), nested.shape)
+
+		with numpy.errstate(invalid = 'ignore'):
+			window = self.get_windows((nested > self.dlimit) | (unnested > self.dlimit))
+			score_fixed = self.calculate_score_fixed(nested, unnested, window)
+			score_greater, overlap = self.calculate_score_greater(nested, unnested, window)
+			score_area = self.calculate_score_area(nested, unnested)
+			total = score_fixed + score_greater + score_area
+
+			# The derivative score is only used to decide between candidates which already have evidence for them.
+			score_derivative = numpy.zeros(len(nested), dtype = int)
+			positive = total > 0
+			if positive.any():
+				score_derivative[positive] = self.calculate_score_derivative(nested[positive], unnested[positive])
+		total = total + score_derivative
+
+		return PairScores(
+			greater = score_greater,
+			fixed = score_fixed,
+			area = score_area,
+			derivative = score_derivative,
+			total = total,
+			overlap = overlap
+		)
+
+	def score_genotype(self, position: int) -> List[Dict[str, float]]:
+		"""
+			Scores the genotype at `position` against every genotype before it in the table, starting with the closest.
+			Returns the same records as `Score.score_pair`, including the python types of each score.
+		"""
+		candidates = numpy.arange(position - 1, -1, -1)
+		scores = self.score(self.values[position], self.values[candidates])
+		unnested_label = self.labels[position]
+
+		records = list()
+		for index, candidate in enumerate(candidates):
+			score_fixed = scores.fixed[index].item()
+			score_greater = float(scores.greater[index])
+			if not scores.overlap[index] or score_greater == 0:
+				score_greater = int(score_greater)
+			score_area = scores.area[index].item()
+			total_score = score_fixed + score_greater + score_area
+			score_derivative = scores.derivative[index].item()
+			if total_score > 0:
+				total_score += score_derivative
+			records.append({
+				'nestedGenotype':   self.labels[candidate],
+				'unnestedGenotype': unnested_label,
+				'scoreGreater':     score_greater,
+				'scoreFixed':       score_fixed,
+				'scoreArea':        score_area,
+				'scoreDerivative':  score_derivative,
+				'totalScore':       total_score
+			})
+		return records
+
+	def iterate_genotypes(self) -> Iterator[Tuple[int, List[Dict[str, float]]]]:
+		"""
+			Scores every genotype after the first against the genotypes before it. Yields the position of each genotype
+			and its score records, in the same order as the table.
+		"""
+		positions = list(range(1, len(self.labels)))
+		if self.threads and self.threads > 1 and len(positions) > 1:
+			logger.debug(f"Using {self.threads} processes...")
+			yield from self._iterate_genotypes_parallel(positions)
+			return
+		for position in positions:
+			yield position, self.score_genotype(position)
+
+	def _iterate_genotypes_parallel(self, positions: List[int]) -> Iterator[Tuple[int, List[Dict[str, float]]]]:
+		""" Distributes the genotypes to a process pool. `imap` yields the records in order, so the output is deterministic."""
+		parameters = (self.scorer, self.labels, self.columns)
+		memory = None
+		if shared_memory is not None:
+			memory = shared_memory.SharedMemory(create = True, size = max(1, self.values.nbytes))
+			shared_values = numpy.ndarray(self.values.shape, dtype = self.values.dtype, buffer = memory.buf)
+			shared_values[:] = self.values
+			initargs = (parameters, (memory.name, self.values.shape, self.values.dtype.str))
+		else:
+			initargs = (parameters, self.values)
+
+		try:
+			with multiprocessing.Pool(processes = self.threads, initializer = _initialize_worker, initargs = initargs) as pool:
+				for position, records in zip(positions, pool.imap(_score_worker_genotype, positions)):
+					yield position, records
+		finally:
+			if memory is not None:
+				memory.close()
+				memory.unlink()
+
+
+# The engine used by each worker process. Set by `_initialize_worker`.
+_worker_engine: Optional[ScoreEngine] = None
+_worker_memory = None
+
+
+def _initialize_worker(parameters: Tuple, values) -> None:
+	""" Attaches a worker process to the shared genotype array. `values` is either the shared memory description or the array itself."""
+	global _worker_engine, _worker_memory
+	scorer, labels, columns = parameters
+	if isinstance(values, tuple):
+		name, shape, dtype = values
+		_worker_memory = shared_memory.SharedMemory(name = name)
+		values = numpy.ndarray(shape, dtype = numpy.dtype(dtype), buffer = _worker_memory.buf)
+	_worker_engine = ScoreEngine(scorer).load_array(labels, columns, values)
+
+
+# Keep this as a separate function. Class methods are finicky when used with multiprocessing.
+def _score_worker_genotype(position: int) -> List[Dict[str, float]]:
+	return _worker_engine.score_genotype(position)
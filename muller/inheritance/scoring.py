@@ -9,9 +9,11 @@ from loguru import logger
 try:
 	from muller import widgets
 	from muller.inheritance import areascore
+	from muller.inheritance import area_engine
 	from muller.inheritance import polygon
 except ModuleNotFoundError:
 	from . import areascore
+	from . import area_engine
 	from . import polygon
 
 
@@ -116,13 +118,23 @@ class LegacyScore:
 
 
 class Score:
-	""" Refactored as a class so that all the dlimit,flimit,pvalue,etc variables don't have to be passed around"""
-
-	def __init__(self, dlimit: float, flimit: float, pvalue: float, weights:Tuple[int,int,int,int] = (1, 2, 1, 2)):
+	""" Refactored as a class so that all the dlimit,flimit,pvalue,etc variables don't have to be passed around
+	Parameters
+	----------
+	area_backend: str
+		How the areas used by `calculate_score_area` are computed. One of `area_engine.AREA_BACKENDS`.
+		'numeric' integrates the series directly while 'shapely' builds a polygon for each series.
+	"""
+
+	def __init__(self, dlimit: float, flimit: float, pvalue: float, weights:Tuple[int,int,int,int] = (1, 2, 1, 2), area_backend: str = 'numeric'):
+		if area_backend not in area_engine.AREA_BACKENDS:
+			message = f"'{area_backend}' is not an available area backend. Expected one of {area_engine.AREA_BACKENDS}"
+			raise ValueError(message)
 		self.pvalue = pvalue
 		self.dlimit = dlimit
 		self.flimit = flimit
 		self.slimit = 0.15
+		self.area_backend = area_backend
 
 		# Keep this around as a fallback
 		# Shapely has been having issues, so may need to fallback to the legacy area score.
@@ -274,20 +286,11 @@ class Score:
 
 		other_genotypes = other_genotypes.mask(lambda s: s < 0, 0.0001)  # Since the flimit is not exactly 1.
 
-		unnested_polygon = polygon.as_polygon(unnested_genotype)
-
-		nested_polygon = polygon.as_polygon(nested_genotype)
-		other_polygon = polygon.as_polygon(other_genotypes)
-
-		is_subset_nested = areascore.is_subset_polygon(nested_polygon, unnested_polygon)
-		is_subset_other = areascore.is_subset_polygon(other_polygon, unnested_polygon)
-		is_subset_nested_reversed = areascore.is_subset_polygon(unnested_polygon, nested_polygon)  # Check the reverse case
-
-		nested_area = areascore.area_of_series(nested_genotype)
-		unnested_area = areascore.area_of_series(unnested_genotype)
-		common_area_nested = areascore.X_and_Y_polygon(unnested_polygon, nested_polygon)
-		xor_area_unnested = areascore.difference_polygon(unnested_polygon, nested_polygon)  # This does not distinguish between xor left vs xor right
-
+		if self.area_backend == 'numeric':
+			areas = self._calculate_areas_numeric(nested_genotype, unnested_genotype, other_genotypes)
+		else:
+			areas = self.calculate_areas_polygon(nested_genotype, unnested_genotype, other_genotypes)
+		is_subset_nested, is_subset_other, is_subset_nested_reversed, nested_area, unnested_area, common_area_nested, xor_area_unnested, common_area_other = areas
 
 		if self.debug:
 			logger.debug(
@@ -296,8 +299,6 @@ class Score:
 			# Evidence for both scenarios
 			# Test if the nested genotype is sufficiently large to assume the unnested genotype is a subset.
 			# Test only the area where the unnested genotype was detected.
-			other_polygon = polygon.as_polygon(other_genotypes)
-			common_area_other = areascore.X_and_Y_polygon(unnested_polygon, other_polygon)
 			score = int(common_area_nested > 2 * common_area_other)
 
 		elif is_subset_nested:
@@ -313,6 +314,49 @@ class Score:
 		score = score * self.weight_jaccard
 		return score
 
+	@staticmethod
+	def calculate_areas_polygon(nested_genotype: pandas.Series, unnested_genotype: pandas.Series, other_genotypes: pandas.Series) -> Tuple:
+		""" Calculates the values used by `calculate_score_area` with shapely polygons."""
+		unnested_polygon = polygon.as_polygon(unnested_genotype)
+
+		nested_polygon = polygon.as_polygon(nested_genotype)
+		other_polygon = polygon.as_polygon(other_genotypes)
+
+		is_subset_nested = areascore.is_subset_polygon(nested_polygon, unnested_polygon)
+		is_subset_other = areascore.is_subset_polygon(other_polygon, unnested_polygon)
+		is_subset_nested_reversed = areascore.is_subset_polygon(unnested_polygon, nested_polygon)  # Check the reverse case
+
+		nested_area = areascore.area_of_series(nested_genotype)
+		unnested_area = areascore.area_of_series(unnested_genotype)
+		common_area_nested = areascore.X_and_Y_polygon(unnested_polygon, nested_polygon)
+		xor_area_unnested = areascore.difference_polygon(unnested_polygon, nested_polygon)  # This does not distinguish between xor left vs xor right
+		common_area_other = areascore.X_and_Y_polygon(unnested_polygon, other_polygon)
+		return is_subset_nested, is_subset_other, is_subset_nested_reversed, nested_area, unnested_area, common_area_nested, xor_area_unnested, common_area_other
+
+	@staticmethod
+	def _calculate_areas_numeric(nested_genotype: pandas.Series, unnested_genotype: pandas.Series, other_genotypes: pandas.Series) -> Tuple:
+		""" Same as `calculate_areas_polygon`, but both pairs are integrated at once with `area_engine`."""
+		areas = area_engine.calculate_areas(
+			[nested_genotype.values, other_genotypes.values],
+			[unnested_genotype.values, unnested_genotype.values]
+		)
+		# Convert to python floats so any division by zero behaves the same as with the shapely areas.
+		area_left = areas.left.tolist()
+		area_right = areas.right.tolist()
+		area_intersection = areas.intersection.tolist()
+		area_union = areas.union.tolist()
+
+		is_subset_nested = areascore.is_subset_numeric(area_left[0], area_right[0], area_intersection[0], area_union[0])
+		is_subset_other = areascore.is_subset_numeric(area_left[1], area_right[1], area_intersection[1], area_union[1])
+		is_subset_nested_reversed = areascore.is_subset_numeric(area_right[0], area_left[0], area_intersection[0], area_union[0])
+
+		nested_area = area_left[0]
+		unnested_area = area_right[0]
+		common_area_nested = area_intersection[0]
+		xor_area_unnested = float(areas.difference_right[0])
+		common_area_other = area_intersection[1]
+		return is_subset_nested, is_subset_other, is_subset_nested_reversed, nested_area, unnested_area, common_area_nested, xor_area_unnested, common_area_other
+
 	def calculate_score_derivative(self, left: pandas.Series, right: pandas.Series) -> float:
 		"""
 			Tests whther the two series are correlated or anticorrelated with each other. The scoring is as follows:
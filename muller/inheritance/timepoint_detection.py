@@ -1,6 +1,44 @@
+from typing import Sequence, Tuple
+
+import numpy
 import pandas
 
 
+def get_crossings(values: numpy.ndarray, cutoffs: Sequence[float]) -> Tuple[numpy.ndarray, numpy.ndarray]:
+	"""
+		Finds the first and last timepoint each series exceeds each cutoff. Every cutoff is tested in a single pass over a
+		(cutoff, series, timepoint) boolean array, so callers which need several cutoffs should request them together.
+	Parameters
+	----------
+	values: numpy.ndarray
+		2-D array with a row for each series and a column for each timepoint. Missing values never exceed a cutoff.
+	cutoffs: Sequence[float]
+		The threshold a frequency must exceed to be considered a valid timepoint.
+
+	Returns
+	-------
+	Tuple[numpy.ndarray, numpy.ndarray]
+		The column positions of the first and last timepoints above each cutoff, with shape (cutoff, series).
+		Series which never exceed a cutoff are NaN.
+	"""
+	values = numpy.asarray(values, dtype = float)
+	cutoffs = numpy.atleast_1d(numpy.asarray(cutoffs, dtype = float))
+	with numpy.errstate(invalid = 'ignore'):
+		above = values[numpy.newaxis, :, :] > cutoffs[:, numpy.newaxis, numpy.newaxis]
+	if values.shape[1] == 0:
+		missing = numpy.full(above.shape[:2], numpy.nan)
+		return missing, missing.copy()
+	crossed = above.any(axis = 2)
+	first = numpy.where(crossed, above.argmax(axis = 2), numpy.nan)
+	last = numpy.where(crossed, values.shape[1] - 1 - above[:, :, ::-1].argmax(axis = 2), numpy.nan)
+	return first, last
+
+
+def to_positions(crossings: numpy.ndarray, default: int = 0) -> numpy.ndarray:
+	""" Converts the output of `get_crossings` into integer positions, replacing series which never crossed with `default`."""
+	return numpy.where(numpy.isnan(crossings), default, crossings).astype(numpy.int64)
+
+
 # noinspection PyTypeChecker,PyUnresolvedReferences
 def _get_timepoint_above_threshold(transposed_timepoints: pandas.DataFrame, cutoff: float, name: str = None) -> pandas.Series:
 	"""
@@ -18,7 +56,10 @@ def _get_timepoint_above_threshold(transposed_timepoints: pandas.DataFrame, cuto
 		A series mapping series name to the first timepoint that series first exceeded the threshold value.
 		Series that never exceed the threshold are mapped to a value of 0.
 	"""
-	threshold_series: pandas.Series = (transposed_timepoints > cutoff).idxmax(0).sort_values()
+	first, _ = get_crossings(transposed_timepoints.values.T, [cutoff])
+	# Same as `idxmax`, which returns the first timepoint for the series which never exceed the cutoff.
+	timepoints = transposed_timepoints.index[to_positions(first[0])]
+	threshold_series = pandas.Series(timepoints, index = transposed_timepoints.columns).sort_values()
 	if name:
 		threshold_series.name = name
 	return threshold_series
@@ -56,16 +97,12 @@ def get_first_significant_timepoint(transposed_genotypes: pandas.DataFrame, cuto
 	-------
 	"""
 
-	initial_genotype_values = transposed_genotypes.iloc[0].transpose()
-	first_above_threshold = _get_timepoint_above_threshold(transposed_genotypes, cutoff, 'firstSignificant')
-	first_above_threshold_reduced_dict = dict()
-	for key, value in first_above_threshold.items():
-		initial_value = initial_genotype_values[key]
-		if value == transposed_genotypes.index[0]:
-			value = value if initial_value > cutoff else transposed_genotypes.index[-1]
-		first_above_threshold_reduced_dict[key] = value
-
-	first_above_threshold_reduced = pandas.Series(first_above_threshold_reduced_dict, name = 'firstThreshold')
+	first_above_threshold = _get_timepoint_above_threshold(transposed_genotypes, cutoff)
+	initial_genotype_values = transposed_genotypes.iloc[0].reindex(first_above_threshold.index)
+	# Genotypes which were assigned the first timepoint without exceeding the cutoff there never exceeded it.
+	never_above = (first_above_threshold == transposed_genotypes.index[0]) & ~(initial_genotype_values > cutoff)
+	first_above_threshold_reduced = first_above_threshold.mask(never_above, transposed_genotypes.index[-1])
+	first_above_threshold_reduced.name = 'firstThreshold'
 	return first_above_threshold_reduced
 
 
@@ -59,7 +59,14 @@ else:
 def run_genotype_inference_workflow(trajectoryio: Union[str, Path, pandas.DataFrame], metric: str, dlimit: float,
 		flimit: float,
 		similarity_cutoff: float, known_genotypes: Optional[Path] = None, threads: Optional[int] = None,
-		is_genotype: bool = False) -> projectdata.DataGenotypeInference:
+		is_genotype: bool = False, filename_distances: Optional[Path] = None,
+		filename_pairwise: Optional[Path] = None,
+		distance_cache: Optional[clustering.metrics.PersistentDistanceCache] = None,
+		area_backend: str = 'numeric', similarity_cutoffs: Optional[List[float]] = None,
+		cutoff_criterion: Optional[str] = None, linkage_backend: str = 'scipy', sparse_graph_bound: Optional[float] = None,
+		sparse_method: str = 'components', prune_bound: Optional[float] = None,
+		verify_pruning: bool = False, deduplicate: bool = False,
+		filename_statistics: Optional[Path] = None) -> projectdata.DataGenotypeInference:
 	"""
 	Parameters
 	----------
@@ -77,6 +84,32 @@ def run_genotype_inference_workflow(trajectoryio: Union[str, Path, pandas.DataFr
 	known_genotypes
 	threads
 	is_genotype: bool
+	filename_distances: Optional[Path]
+		Writes the pairwise distances to a memory-mapped file at this location rather than holding them in memory.
+	filename_pairwise: Optional[Path]
+		Reuses the pairwise distances from a previous run.
+	distance_cache: Optional[clustering.metrics.PersistentDistanceCache]
+		Reuses any pairwise distances stored in a cache shared between runs.
+	area_backend: str
+		How the areas are calculated for the 'jaccard' metric. Either 'numeric' or 'shapely'.
+	similarity_cutoffs: Optional[List[float]]
+		Additional similarity cutoffs to test using the same linkage table.
+	cutoff_criterion: Optional[str]
+		If given, the best cutoff is selected automatically using this statistic.
+	linkage_backend: str
+		How the linkage table is generated. Either 'scipy' or 'nn-chain'.
+	sparse_graph_bound: Optional[float]
+		If given, only the pairs of trajectories within this distance are kept and clustered with `sparse_method`.
+	sparse_method: str
+		One of 'components', 'single' or 'average'.
+	prune_bound: Optional[float]
+		Skips the pairs which are guaranteed to be farther apart than this distance.
+	verify_pruning: bool
+		Checks that none of the pruned pairs are within `prune_bound`.
+	deduplicate: bool
+		Clusters each group of trajectories with identical frequencies as a single weighted trajectory.
+	filename_statistics: Optional[Path]
+		Saves the per-pair binomial sums between runs so only new timepoints are calculated.
 	"""
 	if isinstance(trajectoryio, (str, Path)):
 		logger.info(f"Reading '{trajectoryio}' as the trajectory table.")
@@ -94,7 +127,18 @@ def run_genotype_inference_workflow(trajectoryio: Union[str, Path, pandas.DataFr
 		dlimit = dlimit,
 		flimit = flimit,
 		starting_genotypes = known_genotypes,
-		threads = threads
+		threads = threads,
+		filename_distances = filename_distances,
+		filename_pairwise = filename_pairwise,
+		distance_cache = distance_cache,
+		area_backend = area_backend,
+		linkage_backend = linkage_backend,
+		sparse_graph_bound = sparse_graph_bound,
+		sparse_method = sparse_method,
+		prune_bound = prune_bound,
+		verify_pruning = verify_pruning,
+		deduplicate = deduplicate,
+		filename_statistics = filename_statistics
 	)
 	if is_genotype:
 		logger.info(f"Skipping genotype infeerence...")
@@ -114,13 +158,19 @@ def run_genotype_inference_workflow(trajectoryio: Union[str, Path, pandas.DataFr
 			table_trajectories_info = None
 		)
 	else:
-		genotype_data = genotype_generator.run(trajectories, distance_cutoff = similarity_cutoff)
+		genotype_data = genotype_generator.run(
+			trajectories,
+			distance_cutoff = similarity_cutoff,
+			similarity_cutoffs = similarity_cutoffs,
+			cutoff_criterion = cutoff_criterion
+		)
 	genotype_data.table_trajectories_info = trajectory_info
 	return genotype_data
 
 
 def run_genotype_lineage_workflow(genotypeio: Union[str, Path, pandas.DataFrame], dlimit: float, flimit: float,
-		pvalue: float, known_ancestry: Optional[Path], conservative:bool) -> projectdata.DataGenotypeLineage:
+		pvalue: float, known_ancestry: Optional[Path], conservative:bool, area_backend: str = 'numeric',
+		threads: Optional[int] = None) -> projectdata.DataGenotypeLineage:
 	"""
 
 	Parameters
@@ -130,6 +180,10 @@ def run_genotype_lineage_workflow(genotypeio: Union[str, Path, pandas.DataFrame]
 	flimit
 	pvalue
 	known_ancestry
+	area_backend: str
+		Whether the area scores are calculated with the 'numeric' area engine or with 'shapely' polygons.
+	threads: Optional[int]
+		The number of processes used to score the genotypes.
 
 	Returns
 	-------
@@ -139,7 +193,9 @@ def run_genotype_lineage_workflow(genotypeio: Union[str, Path, pandas.DataFrame]
 		dlimit = dlimit,
 		flimit = flimit,
 		pvalue = pvalue,
-		conservative = conservative
+		conservative = conservative,
+		area_backend = area_backend,
+		threads = threads
 	)
 
 	# Read in the input data if it is not already a pandas.DataFrame object
@@ -235,6 +291,14 @@ def run_workflow(program_options: argparse.Namespace):
 	trajectory_table, trajectory_info = dataio.parse_trajectory_table(program_options.filename,
 		program_options.sheetname)
 
+	if program_options.distance_cache:
+		distance_cache = clustering.metrics.PersistentDistanceCache(
+			program_options.distance_cache,
+			maximum_size = program_options.distance_cache_size
+		)
+	else:
+		distance_cache = None
+
 	# Need to read in the input dataset.
 	logger.info("Generating genotypes...")
 	result_genotype_inference = run_genotype_inference_workflow(
@@ -245,8 +309,23 @@ def run_workflow(program_options: argparse.Namespace):
 		similarity_cutoff = program_options.similarity_cutoff,
 		known_genotypes = program_options.known_genotypes,
 		threads = program_options.threads,
-		is_genotype = program_options.is_genotype
+		is_genotype = program_options.is_genotype,
+		filename_distances = paths.filename_distance_memmap if program_options.memory_map else None,
+		filename_pairwise = program_options.filename_pairwise,
+		distance_cache = distance_cache,
+		area_backend = program_options.area_backend,
+		similarity_cutoffs = program_options.similarity_cutoffs,
+		cutoff_criterion = program_options.cutoff_criterion,
+		linkage_backend = program_options.linkage_backend,
+		sparse_graph_bound = program_options.sparse_graph_bound,
+		sparse_method = program_options.sparse_method,
+		prune_bound = program_options.prune_bound,
+		verify_pruning = program_options.verify_pruning,
+		deduplicate = program_options.deduplicate,
+		filename_statistics = program_options.filename_statistics
 	)
+	if distance_cache is not None:
+		distance_cache.save_statistics(paths.filename_distance_cache_statistics)
 
 	if result_genotype_inference.table_trajectories_info is None:
 		result_genotype_inference.table_trajectories_info = trajectory_info
@@ -259,7 +338,9 @@ def run_workflow(program_options: argparse.Namespace):
 		flimit = program_options.flimit,
 		pvalue = program_options.pvalue,
 		known_ancestry = program_options.known_ancestry,
-		conservative = program_options.conservative
+		conservative = program_options.conservative,
+		area_backend = program_options.area_backend,
+		threads = program_options.threads
 	)
 
 	paths.save_projectdata_basic(data_basic)
@@ -322,7 +403,7 @@ def save_tables(data_basic: projectdata.DataWorkflowBasic, data_inference: proje
 
 	data_inference.table_genotypes.to_csv(filename_table_genotypes, sep = delimiter)
 	data_inference.table_trajectories.to_csv(filename_table_trajectories, sep = delimiter)
-	data_inference.matrix_distance.squareform().to_csv(filename_table_distances, sep = delimiter)
+	data_inference.matrix_distance.save_squareform(filename_table_distances, delimiter)
 	data_inference.clusterdata.table_linkage.to_csv(filename_table_linkage, sep = delimiter)
 	
 	data_lineage.table_edges.to_csv(filename_table_edges, sep = delimiter)
@@ -364,15 +445,16 @@ def render_graphics(paths: projectpaths.OutputFilenames, data_basic: projectdata
 	)
 
 	# Plot the figures that aren't parametrized
-	if data_inference.clusterdata is not None:
+	# The linkage table generated from a sparse distance graph may be incomplete and cannot be drawn.
+	table_linkage = data_inference.clusterdata.table_linkage if data_inference.clusterdata is not None else None
+	if data_inference.matrix_distance is not None and table_linkage is not None and len(table_linkage) == len(data_inference.matrix_distance.labels) - 1:
 		workflow_graphics.generate_dendrogram(data_inference.clusterdata.table_linkage, data_inference.matrix_distance,
-			paths.filename_figure_linkage_plot)
+			paths.filename_figure_linkage_plot, optimal_ordering = not data_basic.program_options.fast_linkage)
 	if data_inference.matrix_distance is not None:
-		workflow_graphics.generate_heatmap(data_inference.matrix_distance.squareform(),
-			paths.filename_figure_distance_heatmap)
+		workflow_graphics.generate_heatmap(data_inference.matrix_distance, paths.filename_figure_distance_heatmap)
 	if data_inference.clusterdata is not None and data_inference.matrix_distance is not None:
 		graphics.generate_distance_plot(
-			data_inference.matrix_distance.values,
+			data_inference.matrix_distance.triangle(),
 			data_inference.clusterdata.distance_cutoff,
 			paths.filename_figure_distribution
 		)
@@ -66,4 +66,136 @@ def test_calculate_mean_genotype(genotype_generator):
 )
 def test_generate_genotype_name(members, expected):
 	result = generate_genotypes.generate_genotype_name(12,members)
-	assert result == expected
\ No newline at end of file
+	assert result == expected
+
+def test_group_identical_trajectories():
+	trajectories = pandas.read_csv(StringIO(trajectory_csv), index_col = 0)
+	trajectories.index = [str(i) for i in trajectories.index]
+	copies = trajectories.loc[['2', '13', '2']]
+	copies.index = ['2b', '13b', '2c']
+	trajectories = pandas.concat([trajectories, copies])
+
+	unique, duplicates = generate_genotypes.group_identical_trajectories(trajectories)
+	assert list(unique.index) == [str(i) for i in [1, 2, 3, 4, 6, 7, 8, 10, 11, 13, 14, 16, 20]]
+	assert duplicates['2'] == ['2', '2b', '2c']
+	assert duplicates['13'] == ['13', '13b']
+	assert duplicates['7'] == ['7']
+
+
+def test_run_deduplicate():
+	trajectories = pandas.read_csv(StringIO(trajectory_csv), index_col = 0)
+	trajectories.index = [str(i) for i in trajectories.index]
+	copies = trajectories.loc[['2', '2', '13', '4', '4', '4']]
+	copies.index = ['2b', '2c', '13b', '4b', '4c', '4d']
+	trajectories = pandas.concat([trajectories, copies])
+
+	expected = ClusterMutations('binomial', 0.03, 0.97).run(trajectories)
+	result = ClusterMutations('binomial', 0.03, 0.97, deduplicate = True).run(trajectories)
+
+	assert sorted(map(sorted, result.clusterdata.clusters)) == sorted(map(sorted, expected.clusterdata.clusters))
+	assert result.clusterdata.distance_cutoff == pytest.approx(expected.clusterdata.distance_cutoff)
+	assert sorted(result.genotype_members.values()) == sorted(expected.genotype_members.values())
+	assert len(result.matrix_distance.labels) == 13
+
+
+def test_update_pairwise_distances(tmp_path):
+	trajectories = pandas.read_csv(StringIO(trajectory_csv), index_col = 0)
+	trajectories.index = [str(i) for i in trajectories.index]
+	expected = ClusterMutations('binomial', 0.03, 0.97).get_pairwise_distances(trajectories)
+
+	# The previous run is missing two of the trajectories and has one which was removed since then.
+	previous_trajectories = trajectories.drop(['2', '14']).copy()
+	previous_trajectories.loc['99'] = [0, 0, 0.1, 0.2, 0.3, 0.4, 0.5]
+	previous = ClusterMutations('binomial', 0.03, 0.97).get_pairwise_distances(previous_trajectories)
+	(tmp_path / "tables").mkdir()
+	previous.save_binary(tmp_path / "tables" / "previous.distance.npz")
+
+	result = ClusterMutations('binomial', 0.03, 0.97, filename_pairwise = tmp_path).get_pairwise_distances(trajectories)
+	assert result.labels == expected.labels
+	assert result.triangle().tolist() == pytest.approx(expected.triangle().tolist())
+
+
+def test_update_pairwise_distances_missing_pairs(tmp_path):
+	# 'a' and 'b' are only ever fixed and never overlap, so they cannot be compared and are assigned the maximum distance.
+	trajectories = pandas.DataFrame(
+		[
+			[0, 0, 1, 1, 0, 0, 0],
+			[0, 0, 0, 0, 0, 1, 1],
+			[0, 0.2, 0.3, 0.1, 0.5, 0.2, 0.1],
+			[0, 0.1, 0.3, 0.8, 0.9, 0.4, 0.9]
+		],
+		index = ['a', 'b', 'c', 'd'], columns = [0, 17, 25, 44, 66, 75, 90]
+	)
+	expected = ClusterMutations('binomial', 0.03, 0.97).get_pairwise_distances(trajectories)
+
+	# The added trajectory increases the maximum distance, so the missing pairs from the previous run should be updated.
+	previous = ClusterMutations('binomial', 0.03, 0.97).get_pairwise_distances(trajectories.drop('d'))
+	assert previous.get('a', 'b') < expected.get('a', 'b')
+	(tmp_path / "tables").mkdir()
+	previous.save_binary(tmp_path / "tables" / "previous.distance.npz")
+
+	result = ClusterMutations('binomial', 0.03, 0.97, filename_pairwise = tmp_path).get_pairwise_distances(trajectories)
+	assert result.labels == expected.labels
+	assert result.triangle().tolist() == pytest.approx(expected.triangle().tolist())
+
+
+def test_pairwise_distances_table_round_trip(tmp_path):
+	trajectories = pandas.read_csv(StringIO(trajectory_csv), index_col = 0)
+	trajectories.index = [str(i) for i in trajectories.index]
+	expected = ClusterMutations('binomial', 0.03, 0.97).get_pairwise_distances(trajectories)
+	filename_table = tmp_path / "previous.distance.tsv"
+	expected.squareform().to_csv(filename_table, sep = "\t")
+
+	# Distances loaded from the table are saved with the parameters of the run, so the saved file can be reused.
+	loaded = ClusterMutations('binomial', 0.03, 0.97, filename_pairwise = filename_table).get_pairwise_distances(trajectories)
+	(tmp_path / "tables").mkdir()
+	loaded.save_binary(tmp_path / "tables" / "previous.distance.npz")
+
+	result = ClusterMutations('binomial', 0.03, 0.97, filename_pairwise = tmp_path).get_pairwise_distances(trajectories)
+	assert result.parameters == {'metric': 'binomial', 'dlimit': 0.03, 'flimit': 0.97, 'prune_bound': None}
+	assert result.labels == expected.labels
+	assert result.triangle().tolist() == pytest.approx(expected.triangle().tolist())
+
+
+def test_pairwise_distances_prune_bound(tmp_path):
+	trajectories = pandas.read_csv(StringIO(trajectory_csv), index_col = 0)
+	trajectories.index = [str(i) for i in trajectories.index]
+	pruned = ClusterMutations('binomial', 0.03, 0.97, prune_bound = 1.0).get_pairwise_distances(trajectories)
+	assert pruned.parameters['prune_bound'] == 1.0
+	(tmp_path / "tables").mkdir()
+	pruned.save_binary(tmp_path / "tables" / "previous.distance.npz")
+
+	# The pruned pairs were assigned the maximum distance, so the distances cannot be reused without the same bound.
+	with pytest.raises(ValueError):
+		ClusterMutations('binomial', 0.03, 0.97, filename_pairwise = tmp_path).get_pairwise_distances(trajectories)
+	result = ClusterMutations('binomial', 0.03, 0.97, prune_bound = 1.0, filename_pairwise = tmp_path).get_pairwise_distances(trajectories)
+	assert result.triangle().tolist() == pytest.approx(pruned.triangle().tolist())
+
+	# Metrics which cannot be pruned are not affected by the bound.
+	assert ClusterMutations('pearson', 0.03, 0.97, prune_bound = 1.0).distance_parameters['prune_bound'] is None
+
+
+def test_pair_statistics_memory_mapped(tmp_path):
+	trajectories = pandas.read_csv(StringIO(trajectory_csv), index_col = 0)
+	trajectories.index = [str(i) for i in trajectories.index]
+	expected = ClusterMutations('binomial', 0.03, 0.97).get_pairwise_distances(trajectories)
+
+	filename_distances = tmp_path / "distances.npy"
+	generator = ClusterMutations('binomial', 0.03, 0.97, filename_statistics = tmp_path / "statistics.npz", filename_distances = filename_distances)
+	result = generator.get_pairwise_distances(trajectories)
+	assert filename_distances.exists()
+	assert result.labels == expected.labels
+	assert result.triangle().tolist() == pytest.approx(expected.triangle().tolist())
+
+
+def test_generate_genotype_table(genotype_generator):
+	trajectories = pandas.read_csv(StringIO(trajectory_csv), index_col = 0)
+	trajectories.index = [str(i) for i in trajectories.index]
+	trajectories.loc['3', '44'] = float('nan')
+	genotypes = [['7'], ['4', '8'], ['3', '2'], ['13', '20', '11']]
+
+	table, members = genotype_generator.generate_genotype_table(trajectories, genotypes)
+	assert members == {f"genotype-{index}": genotype for index, genotype in enumerate(genotypes, start = 1)}
+	for name, genotype in members.items():
+		expected = trajectories.loc[genotype].mean()
+		assert table.loc[name].tolist() == pytest.approx(expected.tolist())
@@ -0,0 +1,98 @@
+import itertools
+import math
+import statistics
+
+import numpy
+import pytest
+
+from muller.clustering.clustercalc import ClusterSet
+from muller.clustering.metrics import DistanceCache
+
+
+@pytest.fixture
+def distances() -> DistanceCache:
+	generator = numpy.random.default_rng(11)
+	labels = [f"trajectory-{i}" for i in range(25)]
+	return DistanceCache.from_condensed(labels, generator.random(25 * 24 // 2))
+
+
+@pytest.fixture
+def clusters(distances) -> list:
+	generator = numpy.random.default_rng(5)
+	labels = list(generator.permutation(distances.labels))
+	# Includes a cluster with a single member.
+	return [labels[:1], labels[1:9], labels[9:12], labels[12:]]
+
+
+def _between_cluster_distance(distances, left, right, method):
+	values = [distances.get(i, j) for i in left for j in right]
+	return {'min': min, 'max': max, 'mean': statistics.mean}[method](values)
+
+
+def _silhouette_coefficients(distances, clusters):
+	coefficients = dict()
+	for cluster in clusters:
+		if len(cluster) == 1: continue
+		others = [i for i in clusters if i is not cluster]
+		closest = min(others, key = lambda other: _between_cluster_distance(distances, cluster, other, 'min'))
+		for member in cluster:
+			distances_own = [distances.get(member, other) for other in cluster]
+			distances_closest = [distances.get(member, other) for other in closest]
+			average = sum(distances_own) / (len(cluster) - 1)
+			average_closest = sum(distances_closest) / len(closest)
+			coefficients[member] = (average_closest - average) / max(distances_own + distances_closest)
+	return coefficients
+
+
+def _index(distances, clusters):
+	within = 0
+	for cluster in clusters:
+		values = [distances.get(i, j) for i, j in itertools.combinations(cluster, 2)] or [0]
+		mean = statistics.mean(values)
+		within += sum((i - mean) ** 2 for i in values) / len(cluster)
+	between_distances = [_between_cluster_distance(distances, i, j, 'min') for i, j in itertools.combinations(clusters, 2)]
+	mean = statistics.mean(between_distances)
+	between = sum((i - mean) ** 2 for i in between_distances) / len(clusters)
+	return (within / len(clusters) - 1) / (between / (len(distances.labels) - len(clusters)))
+
+
+@pytest.mark.parametrize("block_size", [10, 2 ** 22])
+def test_cluster_statistics(distances, clusters, block_size):
+	cluster_set = ClusterSet(clusters, distances, block_size = block_size)
+
+	assert cluster_set.calculate_index() == pytest.approx(_index(distances, clusters))
+
+	result = cluster_set.calculate_silhouette_coefficients()
+	expected = _silhouette_coefficients(distances, clusters)
+	assert list(result.keys()) == list(expected.keys())
+	assert list(result.values()) == pytest.approx(list(expected.values()))
+
+	for method in ['min', 'max', 'mean']:
+		cluster_distances = cluster_set.get_cluster_distances()[method]
+		for (i, left), (j, right) in itertools.product(enumerate(clusters), repeat = 2):
+			expected = _between_cluster_distance(distances, left, right, method)
+			assert cluster_distances[i, j] == pytest.approx(expected)
+			assert cluster_set.calculate_distance_between_clusters(left, right, method) == pytest.approx(expected)
+
+
+def test_cluster_statistics_single_cluster(distances):
+	cluster_set = ClusterSet([distances.labels], distances)
+	with pytest.raises(ValueError):
+		cluster_set.calculate_index()
+	with pytest.raises(ValueError):
+		cluster_set.calculate_silhouette_coefficients()
+	with pytest.raises(ValueError):
+		cluster_set.calculate_distance_between_clusters(distances.labels, distances.labels, 'median')
+	assert math.isclose(
+		cluster_set.calculate_within_cluster_variations(),
+		ClusterSet.calculate_within_cluster_variation(distances.labels, distances)
+	)
+
+
+def test_get_genotypes(distances, clusters):
+	genotypes = [['trajectory-2'], ['trajectory-3', 'trajectory-4'], ['trajectory-7', 'trajectory-8'], ['trajectory-3']]
+	result = ClusterSet(clusters, distances).get_genotypes(genotypes)
+
+	# The second genotype cannot use 'genotype-2' since it was already derived from the members of the first genotype.
+	assert list(result.keys()) == ['genotype-2', 'genotype-2.2', 'genotype-3', 'genotype-4']
+	assert list(result.values()) == genotypes
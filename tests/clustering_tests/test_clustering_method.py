@@ -1,10 +1,13 @@
 from pathlib import Path
 
+import numpy
 import pandas
 import pytest
 
 from muller import dataio
 from muller.clustering import ClusterMutations
+from muller.clustering.hierarchy import HierarchalCluster
+from muller.clustering.metrics import DistanceCache
 from .. import filenames
 
 
@@ -54,3 +57,39 @@ def test_clustering_algorithm_on_real_tables(cluster, filename):
 	result = cluster.run(trajectories, distance_cutoff = 0.2)
 
 	assert sorted(result.genotype_members.values()) == sorted(expected_members.values())
+
+
+def test_hierarchy_with_starting_genotypes():
+	data = {
+		('1', '2'): .1,
+		('1', '3'): .9,
+		('1', '4'): .8,
+		('2', '3'): .9,
+		('2', '4'): .9,
+		('3', '4'): .2
+	}
+	expected = [['1', '2'], ['3', '4']]
+	result = HierarchalCluster().run(DistanceCache(data), similarity_cutoff = 0.5)
+	assert sorted(sorted(i) for i in result.clusters) == expected
+
+	# Force '1' and '4' into the same genotype.
+	pair_array = DistanceCache(data)
+	result = HierarchalCluster().run(pair_array, starting_genotypes = [['1', '4']], similarity_cutoff = 0.5)
+	assert ['1', '4'] in [sorted(i) for i in result.clusters]
+	# The known genotypes should not modify the original distances, which are saved and can be reused.
+	assert pair_array.get('1', '4') == .8
+
+
+def test_hierarchy_with_starting_genotypes_memory_mapped(tmp_path):
+	labels = ['1', '2', '3', '4']
+	filename = tmp_path / "distances.npy"
+	values = numpy.lib.format.open_memmap(str(filename), mode = 'w+', dtype = numpy.float64, shape = (6,))
+	values[:] = [.1, .9, .8, .9, .9, .2]
+	pair_array = DistanceCache.from_condensed(labels, values)
+
+	result = HierarchalCluster().run(pair_array, starting_genotypes = [['1', '4']], similarity_cutoff = 0.5)
+	assert ['1', '4'] in [sorted(i) for i in result.clusters]
+	assert pair_array.get('1', '4') == .8
+	assert numpy.load(filename).tolist() == [.1, .9, .8, .9, .9, .2]
+	# The modified copy is removed after clustering.
+	assert [i.name for i in tmp_path.iterdir()] == ["distances.npy"]
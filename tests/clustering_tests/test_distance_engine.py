@@ -0,0 +1,130 @@
+import itertools
+
+import numpy
+import pandas
+import pytest
+
+from muller import dataio, widgets
+from muller.clustering.metrics import DistanceCache, DistanceCalculator, DistanceEngine, distance_calculator, distance_engine
+from tests import filenames
+
+
+@pytest.fixture
+def b1_data() -> pandas.DataFrame:
+	f = filenames.real_tables["B1"]
+	t = dataio.import_table(f, sheet_name = 'trajectory', index = 'Trajectory')
+	t.index = [str(i) for i in t.index]
+	return t
+
+
+def test_condensed_index_to_pairs():
+	n = 7
+	expected = list(itertools.combinations(range(n), 2))
+	left, right = distance_engine.condensed_index_to_pairs(numpy.arange(len(expected)), n)
+	assert list(zip(left.tolist(), right.tolist())) == expected
+
+	indices = distance_engine.pairs_to_condensed_index(right, left, n)
+	assert indices.tolist() == list(range(len(expected)))
+
+
+@pytest.mark.parametrize(
+	"left, right, expected",
+	[
+		([0.00, 0.00, 0.00, 1.00, 1.00, 1.00, 1.00], [0.00, 1.00, 1.00, 1.00, 1.00, 1.00, 1.00], "onlyFixed"),
+		([0.00, 0.00, 0.00, 1.00, 1.00, 1.00, 1.00], [0.00, 0.00, 0.00, 0.52, 0.45, 0.91, 0.91], "partiallyFixed"),
+		([0.00, 0.01, 0.26, 1.00, 1.00, 1.00, 1.00], [0.00, 0.00, 0.00, 0.52, 0.45, 0.91, 0.91], "bothFixed"),
+		([0.00, 0.01, 0.26, 1.00, 1.00, 1.00, 1.00], [0.00, 0.00, 0.00, 0.18, 0.17, 0.23, 0.24], "oneFixed"),
+		([0.00, 0.00, 0.00, 0.11, 0.00, 0.11, 0.12], [0.00, 0.00, 0.00, 0.18, 0.17, 0.23, 0.24], "notFixed"),
+	]
+)
+def test_categorize(left, right, expected):
+	categories = {
+		distance_engine.CATEGORY_ONLY_FIXED:      'onlyFixed',
+		distance_engine.CATEGORY_PARTIALLY_FIXED: 'partiallyFixed',
+		distance_engine.CATEGORY_BOTH_FIXED:      'bothFixed',
+		distance_engine.CATEGORY_ONE_FIXED:       'oneFixed',
+		distance_engine.CATEGORY_NOT_FIXED:       'notFixed'
+	}
+	table = pandas.DataFrame([left, right], index = ['left', 'right'])
+	engine = DistanceEngine(0.03, 0.90, 'binomial').load(table)
+	result = engine.categorize(numpy.array([0]), numpy.array([1]))
+	assert categories[result[0]] == expected
+	assert expected == distance_calculator.get_pair_category(left, right, dlimit = 0.03, flimit = 0.90)
+
+
+@pytest.mark.parametrize("metric", ['binomial', 'pearson', 'minkowski', 'combined', 'similarity'])
+def test_engine_matches_distance_calculator(b1_data, metric):
+	expected = DistanceCalculator(0.03, 0.97, metric).run(b1_data)
+	labels, distances = DistanceEngine(0.03, 0.97, metric, block_size = 16).run(b1_data)
+
+	assert len(distances) == widgets.calculate_number_of_combinations(len(b1_data))
+	result = distance_engine.to_pair_array(labels, distances)
+
+	assert sorted(result.keys()) == sorted(expected.keys())
+	for key, value in expected.items():
+		assert result[key] == pytest.approx(value)
+
+
+def test_engine_threaded_is_deterministic(b1_data):
+	_, expected = DistanceEngine(0.03, 0.97, 'binomial').run(b1_data)
+	labels, result = DistanceEngine(0.03, 0.97, 'binomial', block_size = 16, threads = 2).run(b1_data)
+
+	assert labels == list(b1_data.index)
+	assert numpy.array_equal(result, expected)
+
+
+def test_distance_calculator_threaded(b1_data):
+	expected = DistanceCalculator(0.03, 0.97, 'binomial').run(b1_data)
+	result = DistanceCalculator(0.03, 0.97, 'binomial', threads = 2).run(b1_data)
+
+	assert sorted(result.keys()) == sorted(expected.keys())
+	for key, value in expected.items():
+		assert result[key] == pytest.approx(value)
+
+
+def test_engine_memory_mapped(b1_data, tmp_path):
+	filename = tmp_path / "distances.npy"
+	# The cache only wraps the file directly when the labels are already sorted.
+	b1_data = b1_data.loc[sorted(b1_data.index)]
+	_, expected = DistanceEngine(0.03, 0.97, 'binomial').run(b1_data)
+	labels, result = DistanceEngine(0.03, 0.97, 'binomial').run(b1_data, filename)
+
+	assert isinstance(result, numpy.memmap)
+	assert numpy.array_equal(numpy.load(filename), expected)
+
+	cache = DistanceCache.from_condensed(labels, result)
+	assert cache.is_memory_mapped
+	cache.save_squareform(tmp_path / "memmap.tsv")
+	DistanceCache.from_condensed(labels, expected).squareform().to_csv(tmp_path / "expected.tsv", sep = "\t")
+	assert (tmp_path / "memmap.tsv").read_text() == (tmp_path / "expected.tsv").read_text()
+
+
+@pytest.mark.parametrize("metric", ['binomial', 'similarity', 'minkowski'])
+@pytest.mark.parametrize("filename", [filenames.real_tables["B1"], filenames.model_tables['model.clonalinterferance']])
+def test_pair_lower_bounds(filename, metric):
+	data = dataio.import_table(filename, sheet_name = 'trajectory', index = 'Trajectory')
+	data = data[widgets.get_numeric_columns(data.columns)].astype(float)
+	engine = DistanceEngine(0.03, 0.97, metric, prune_bound = 0).load(data)
+	left, right = distance_engine.condensed_index_to_pairs(numpy.arange(engine.total_pairs), len(engine))
+
+	expected = engine.calculate_pairs(left, right, prune = False)
+	bounds = engine.signatures.calculate_lower_bounds(left, right, engine.categorize(left, right))
+	compared = ~numpy.isnan(expected)
+	assert (bounds > 0).any()
+	assert (expected[compared] >= bounds[compared]).all()
+
+
+def test_engine_pruning(b1_data):
+	_, expected = DistanceEngine(0.03, 0.97, 'binomial').run(b1_data)
+	bound = float(numpy.quantile(expected, 0.2))
+	engine = DistanceEngine(0.03, 0.97, 'binomial', block_size = 16, prune_bound = bound, verify_pruning = True)
+	_, result = engine.run(b1_data)
+
+	assert engine.statistics['pruned'] > 0
+	assert engine.statistics['violations'] == 0
+	within = expected <= bound
+	assert numpy.allclose(result[within], expected[within])
+	assert (result[~within] > bound).all()
+
+	with pytest.raises(ValueError):
+		distance_engine.PairSignatures('pearson')
@@ -1,10 +1,11 @@
 from pathlib import Path
 
+import numpy
 import pandas
 import pytest
 from loguru import logger
 from muller import dataio
-from muller.clustering.metrics import DistanceCalculator, distance_calculator, distance_methods
+from muller.clustering.metrics import DistanceCalculator, DistanceEngine, distance_calculator, distance_engine, distance_methods
 import math
 from tests import filenames
 
@@ -108,3 +109,33 @@ def test_fixed_overlap(left, right, expected):
 	if math.isnan(result):
 		result = 1
 	assert expected == result
+
+
+def test_register_metric(b1_data):
+	def chebyshev(left: pandas.Series, right: pandas.Series) -> float:
+		return float((left - right).abs().max())
+
+	metric = distance_methods.register_metric('chebyshev', chebyshev, replace = True)
+	try:
+		assert distance_methods.get_metric('chebyshev') is metric
+		expected = DistanceCalculator(0.03, 0.97, 'chebyshev').run(b1_data)
+		# Without a batch kernel the engine calls the scalar version for each pair.
+		labels, distances = DistanceEngine(0.03, 0.97, 'chebyshev').run(b1_data)
+		result = distance_engine.to_pair_array(labels, distances)
+		for key, value in expected.items():
+			assert result[key] == pytest.approx(value)
+
+		with pytest.raises(ValueError):
+			distance_methods.register_metric('chebyshev', chebyshev)
+	finally:
+		del distance_methods.METRICS['chebyshev']
+	with pytest.raises(ValueError):
+		distance_methods.get_metric('chebyshev')
+
+
+def test_combined_reuses_intermediates():
+	values = numpy.array([[0, 0.0, 0.0, 0.273, 0.781, 1.0, 1.0], [0, 0.0, 0.0, 0.0, 0.345, 0.833, 0.793]])
+	windows = distance_methods.PairWindows(values[[0]], values[[1]], numpy.ones((1, 7), dtype = bool))
+	combined = windows.calculate('combined')
+	assert combined == pytest.approx(2 * windows.calculate('pearson') + windows.calculate('minkowski'))
+	assert {'metric:pearson', 'metric:minkowski', 'metric:combined'} <= set(windows._cache)
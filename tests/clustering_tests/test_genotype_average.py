@@ -31,9 +31,8 @@ def test_calculate_mean_genotype(genotype_generator, filename):
 	groups = trajectories.groupby(by = "Genotype")
 	for genotype_label, group in groups:
 		expected = genotypes.loc[genotype_label].astype(float)
-		mean_genotype = genotype_generator._calculate_mean_frequencies_of_trajectories(genotype_label, group,
-			group.index)
-		del mean_genotype['members']
-		mean_genotype = mean_genotype.astype(float)
+		table = genotype_generator.calculate_mean_genotype([list(group.index)], group.drop(columns = 'Genotype'))
+		mean_genotype = table.drop(columns = 'members').iloc[0].astype(float)
+		mean_genotype.name = genotype_label
 
 		pandas.testing.assert_series_equal(mean_genotype, expected, check_index_type = False)
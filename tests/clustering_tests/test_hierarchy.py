@@ -0,0 +1,116 @@
+import itertools
+import math
+
+import numpy
+import pandas
+import pytest
+from scipy.spatial.distance import pdist
+
+from muller.clustering import hierarchy
+from muller.clustering.metrics import DistanceCache
+
+
+def legacy_cutoff(quantile: float, distances: numpy.ndarray) -> float:
+	# The original implementation, which used both orientations of every pair.
+	values = list(distances) + list(distances)
+	maximum = max(values)
+	return pandas.Series([i for i in values if 0 < i < maximum], dtype = float).quantile(quantile)
+
+
+@pytest.mark.parametrize("quantile", [0, 0.01, 0.05, 0.1, 0.5, 0.77, 0.99, 1])
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_calculate_cutoff_quantile(quantile, seed):
+	generator = numpy.random.default_rng(seed)
+	distances = numpy.concatenate([
+		numpy.round(generator.random(101) * 3, 2),  # Includes ties and values equal to the maximum.
+		numpy.zeros(5)
+	])
+	assert hierarchy.calculate_cutoff_quantile(quantile, distances) == legacy_cutoff(quantile, distances)
+
+
+def test_calculate_cutoff_quantile_empty():
+	assert math.isnan(hierarchy.calculate_cutoff_quantile(0.05, numpy.array([0, 0, 1.0])))
+
+
+def test_calculate_cutoff_quantile_memory_mapped(tmp_path, monkeypatch):
+	generator = numpy.random.default_rng(7)
+	values = numpy.round(generator.random(20000) * 4, 3)
+	distances = numpy.lib.format.open_memmap(str(tmp_path / "distances.npy"), mode = 'w+', dtype = numpy.float64, shape = values.shape)
+	distances[:] = values
+
+	# Force several passes over the memory-mapped array.
+	monkeypatch.setattr(hierarchy, 'SELECTION_SIZE', 100)
+	for quantile in [0.05, 0.3, 0.99]:
+		result = hierarchy.calculate_cutoff_quantile(quantile, distances, chunk_size = 777)
+		assert result == legacy_cutoff(quantile, values)
+
+
+def test_select_order_statistics():
+	values = numpy.array([0, 5, 3, 3, 1, 9, 0.5, 2])
+	result = hierarchy.select_order_statistics(values, [0, 2, 3, 5], 0, 9)
+	assert result == [0.5, 2, 3, 5]
+
+
+@pytest.fixture
+def pair_array() -> DistanceCache:
+	# Two well-separated groups of three points each.
+	groups = [['a1', 'a2', 'a3'], ['b1', 'b2', 'b3']]
+	data = dict()
+	for left, right in itertools.combinations([i for group in groups for i in group], 2):
+		same_group = left[0] == right[0]
+		data[left, right] = 0.1 + 0.01 * (int(left[1]) + int(right[1])) if same_group else 0.8 + 0.01 * int(left[1])
+	return DistanceCache(data)
+
+
+def test_sweep(pair_array):
+	cluster = hierarchy.HierarchalCluster()
+	linkage_table = cluster.link_clusters(pair_array.triangle(), len(pair_array.labels))
+	table, clusters = cluster.sweep(linkage_table, pair_array, [0.01, 0.5, 0.99])
+
+	assert table['similarityCutoff'].tolist() == [0.01, 0.5, 0.99]
+	assert table['distanceCutoff'].tolist() == hierarchy.calculate_cutoff_quantiles([0.01, 0.5, 0.99], pair_array.triangle())
+	# The number of clusters can only decrease as the cutoff increases.
+	assert table['clusters'].is_monotonic_decreasing
+	assert table['clusters'].tolist() == [len(clusters[i]) for i in [0.01, 0.5, 0.99]]
+	assert sorted(sorted(i) for i in clusters[0.5]) == [['a1', 'a2', 'a3'], ['b1', 'b2', 'b3']]
+
+
+def test_run_selects_cutoff(pair_array):
+	result = hierarchy.HierarchalCluster().run(pair_array, similarity_cutoffs = [0.01, 0.5, 0.99], cutoff_criterion = 'silhouette')
+
+	table = result.table_cutoffs
+	assert result.distance_quantile == table.loc[table['silhouette'].idxmax(), 'similarityCutoff']
+	assert sorted(sorted(i) for i in result.clusters) == [['a1', 'a2', 'a3'], ['b1', 'b2', 'b3']]
+
+	with pytest.raises(ValueError):
+		hierarchy.HierarchalCluster.select_cutoff(table, 'variance')
+
+
+def test_order_linkage_table():
+	generator = numpy.random.default_rng(3)
+	distances = generator.random(40 * 39 // 2)
+	labels = [f"trajectory-{i}" for i in range(40)]
+	unordered = hierarchy.HierarchalCluster().link_clusters(distances, 40)
+	ordered = hierarchy.HierarchalCluster(optimal_ordering = True).link_clusters(distances, 40)
+
+	result = hierarchy.order_linkage_table(unordered, distances)
+	pandas.testing.assert_frame_equal(result, ordered)
+	assert unordered['distance'].tolist() == ordered['distance'].tolist()
+
+	columns = ['left', 'right', 'distance', 'observations']
+	cluster = hierarchy.HierarchalCluster()
+	for quantile in [0.01, 0.05, 0.2]:
+		cutoff = hierarchy.calculate_cutoff_quantile(quantile, distances)
+		assert cluster.cluster(unordered[columns], cutoff, labels) == cluster.cluster(ordered[columns], cutoff, labels)
+
+
+@pytest.mark.parametrize("quantile", [0.01, 0.05, 0.5, 0.99])
+def test_calculate_weighted_cutoff_quantiles(quantile):
+	generator = numpy.random.default_rng(5)
+	points = numpy.round(generator.random((30, 2)), 2)
+	weights = generator.integers(1, 4, 30)
+	expanded = numpy.repeat(points, weights, axis = 0)
+
+	expected = hierarchy.calculate_cutoff_quantile(quantile, pdist(expanded))
+	result = hierarchy.calculate_cutoff_quantiles([quantile], pdist(points), weights = weights)
+	assert result == [pytest.approx(expected)]
@@ -77,5 +77,19 @@ def test_parse_lf_options():
 	assert program_options.flimit == fixed_cutoff
 
 
+def test_parse_similarity_cutoffs():
+	commandline_parser = create_parser()
+	arguments = [
+		"lineage",
+		"--input", "test_table",
+		"--output", "output_files",
+		"--similarity-cutoffs", "0.01:0.05:0.02", "0.1",
+		"--select-cutoff", "silhouette"
+	]
+	program_options = parse_workflow_options(commandline_parser.parse_args(arguments))
+	assert program_options.similarity_cutoffs == [0.01, 0.03, 0.05, 0.1]
+	assert program_options.cutoff_criterion == 'silhouette'
+
+
 if __name__ == "__main__":
 	pass
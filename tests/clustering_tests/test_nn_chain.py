@@ -0,0 +1,67 @@
+import numpy
+import pytest
+from scipy.cluster import hierarchy as scipy_hierarchy
+from scipy.spatial.distance import pdist
+
+from muller.clustering import hierarchy, nn_chain
+
+
+@pytest.mark.parametrize("method", ['ward', 'average', 'complete', 'weighted'])
+@pytest.mark.parametrize("seed", [1, 2])
+def test_linkage_matches_scipy(method, seed):
+	generator = numpy.random.default_rng(seed)
+	distances = generator.random(60 * 59 // 2)
+	if seed == 2:
+		# Many ties.
+		distances = numpy.round(distances, 1)
+	original = distances.copy()
+
+	expected = scipy_hierarchy.linkage(distances, method)
+	result = nn_chain.linkage(distances, 60, method)
+	assert numpy.array_equal(result, expected)
+	# The input should not be modified unless `in_place` is used.
+	assert numpy.array_equal(distances, original)
+
+	result = nn_chain.linkage(distances, 60, method, in_place = True)
+	assert numpy.array_equal(result, expected)
+
+
+def test_linkage_memory_mapped(tmp_path):
+	generator = numpy.random.default_rng(4)
+	filename = tmp_path / "distances.npy"
+	distances = numpy.lib.format.open_memmap(str(filename), mode = 'w+', dtype = numpy.float64, shape = (30 * 29 // 2,))
+	distances[:] = generator.random(len(distances))
+
+	result = nn_chain.linkage(distances, 30)
+	assert numpy.array_equal(result, scipy_hierarchy.linkage(numpy.asarray(distances), 'ward'))
+	# The working copy is removed once the linkage table is generated.
+	assert [i.name for i in tmp_path.iterdir()] == ["distances.npy"]
+
+
+def test_linkage_invalid_input():
+	with pytest.raises(ValueError):
+		nn_chain.linkage(numpy.ones(3), 3, 'centroid')
+	with pytest.raises(ValueError):
+		nn_chain.linkage(numpy.ones(4), 3)
+	with pytest.raises(ValueError):
+		hierarchy.HierarchalCluster(linkage_backend = 'fastcluster')
+
+
+def test_linkage_backends_match():
+	distances = numpy.random.default_rng(8).random(25 * 24 // 2)
+	expected = hierarchy.HierarchalCluster().link_clusters(distances, 25)
+	result = hierarchy.HierarchalCluster(linkage_backend = 'nn-chain').link_clusters(distances, 25)
+	assert result.equals(expected)
+
+
+@pytest.mark.parametrize("method", ['ward', 'average', 'complete', 'weighted'])
+def test_linkage_sizes(method):
+	generator = numpy.random.default_rng(6)
+	points = generator.random((20, 3))
+	sizes = generator.integers(1, 4, 20)
+	expanded = scipy_hierarchy.linkage(pdist(numpy.repeat(points, sizes, axis = 0)), method)
+
+	result = nn_chain.linkage(pdist(points), 20, method, sizes = sizes)
+	# The merges between copies of the same point are at a distance of 0.
+	assert numpy.allclose(result[:, 2], expanded[-19:, 2])
+	assert result[-1, 3] == sizes.sum()
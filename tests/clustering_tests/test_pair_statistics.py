@@ -0,0 +1,58 @@
+import numpy
+import pandas
+import pytest
+
+from muller import dataio, widgets
+from muller.clustering.metrics import DistanceEngine, PairStatistics
+from tests import filenames
+
+
+@pytest.fixture
+def b1_data() -> pandas.DataFrame:
+	f = filenames.real_tables["B1"]
+	t = dataio.import_table(f, sheet_name = 'trajectory', index = 'Trajectory')
+	t.index = [str(i) for i in t.index]
+	t = t[widgets.get_numeric_columns(t.columns)].astype(float)
+	return t.loc[sorted(t.index)]
+
+
+def calculate_condensed(data: pandas.DataFrame, metric: str) -> numpy.ndarray:
+	return DistanceEngine(0.03, 0.97, metric).load(data).calculate_condensed()
+
+
+@pytest.mark.parametrize("metric", ['binomial', 'similarity'])
+def test_calculate_matches_engine(b1_data, metric):
+	result = PairStatistics.calculate(DistanceEngine(0.03, 0.97, metric, block_size = 50).load(b1_data))
+	assert numpy.array_equal(result.distances, calculate_condensed(b1_data, metric), equal_nan = True)
+
+
+@pytest.mark.parametrize("previous", [4, 6])
+def test_update_new_timepoints(b1_data, tmp_path, previous):
+	filename = tmp_path / "statistics.npz"
+	PairStatistics.calculate(DistanceEngine(0.03, 0.97, 'binomial').load(b1_data.iloc[:, :previous])).save(filename)
+
+	engine = DistanceEngine(0.03, 0.97, 'binomial', block_size = 50).load(b1_data)
+	result = PairStatistics.load_or_calculate(engine, filename)
+	expected = calculate_condensed(b1_data, 'binomial')
+
+	assert numpy.allclose(result.distances, expected, equal_nan = True)
+	assert result.statistics['reused'] + result.statistics['updated'] > 0
+	assert sum(result.statistics.values()) == engine.total_pairs
+
+
+def test_update_recalculates_incompatible(b1_data):
+	previous = PairStatistics.calculate(DistanceEngine(0.03, 0.97, 'binomial').load(b1_data.iloc[:, :5]))
+
+	# The previous timepoints were modified for a single trajectory.
+	modified = b1_data.copy()
+	modified.iloc[0, 2] = 0.5
+	result = previous.update(DistanceEngine(0.03, 0.97, 'binomial').load(modified))
+	assert numpy.allclose(result.distances, calculate_condensed(modified, 'binomial'), equal_nan = True)
+	assert result.statistics['recalculated'] >= len(modified) - 1
+
+	# A different set of trajectories.
+	result = previous.update(DistanceEngine(0.03, 0.97, 'binomial').load(b1_data.iloc[1:]))
+	assert result.statistics['recalculated'] == len(result.distances)
+
+	with pytest.raises(ValueError):
+		PairStatistics.calculate(DistanceEngine(0.03, 0.97, 'pearson').load(b1_data))
@@ -1,3 +1,4 @@
+import numpy
 import pandas
 import pytest
 
@@ -104,3 +105,112 @@ def test_update(small_cache):
 
 	assert small_cache.get('14', '1') == 2
 	assert small_cache.get('1', '14') == 2
+
+
+def test_triangle(small_cache):
+	expected = [.5, .6, .7, .2, .3, .8]
+	assert small_cache.triangle().tolist() == expected
+	assert small_cache.labels == ['1', '2', '3', '4']
+
+
+def test_from_condensed_sorts_labels(small_cache):
+	# Same distances as `small_cache` with the labels in the order 3, 1, 4, 2
+	values = [.6, .8, .2, .7, .5, .3]
+	result = DistanceCache.from_condensed(['3', '1', '4', '2'], numpy.array(values))
+
+	assert result.labels == small_cache.labels
+	assert result.triangle().tolist() == small_cache.triangle().tolist()
+	pandas.testing.assert_frame_equal(result.squareform(), small_cache.squareform())
+
+
+def test_from_squareform(small_cache):
+	result = DistanceCache.from_squareform(small_cache.squareform())
+	assert result.asdict() == small_cache.asdict()
+
+
+def test_reduce(small_cache):
+	small_cache.reduce(['1', '3', '4'])
+
+	assert small_cache.labels == ['1', '3', '4']
+	assert small_cache.triangle().tolist() == [.6, .7, .8]
+	assert small_cache.get('1', '2') is None
+	with pytest.raises(KeyError):
+		small_cache['1', '2']
+
+
+def test_get(small_cache):
+	assert small_cache['3', '2'] == .2
+	assert small_cache.get('2', '2') == 0
+	assert small_cache.get('1', '5', 10) == 10
+
+
+def test_float32():
+	cache = DistanceCache({('1', '2'): .5, ('1', '3'): .25}, dtype = numpy.float32)
+	assert cache.triangle().dtype == numpy.float32
+	assert cache.get('3', '1') == .25
+	# The missing pair is treated as 0 in the square matrix.
+	assert cache.squareform().loc['2', '3'] == 0
+
+
+def test_save_and_read_binary(small_cache, tmp_path):
+	filename = tmp_path / "distances.npz"
+	small_cache.parameters = {'metric': 'binomial', 'dlimit': 0.03, 'flimit': 0.97}
+	small_cache.save_binary(filename)
+
+	result = DistanceCache.read_binary(filename, {'metric': 'binomial', 'dlimit': 0.03})
+	assert result.labels == small_cache.labels
+	assert result.parameters == small_cache.parameters
+	assert result.asdict() == small_cache.asdict()
+
+	with pytest.raises(ValueError):
+		DistanceCache.read_binary(filename, {'metric': 'pearson', 'dlimit': 0.03})
+
+
+def test_save_and_read(small_cache, tmp_path):
+	filename = tmp_path / "distances.tsv"
+	small_cache.save(filename)
+
+	result = DistanceCache.read(filename)
+	assert result.asdict() == small_cache.asdict()
+
+
+def test_set_group(small_cache):
+	missing = small_cache.set_group(['4', '1', '7'], 0)
+
+	assert missing == ['7']
+	assert small_cache.labels == ['1', '2', '3', '4']
+	assert small_cache.triangle().tolist() == [.5, .6, 0, .2, .3, .8]
+
+
+def test_get_block(small_cache):
+	square = small_cache.squareform()
+	rows = [3, 0, 1]
+	columns = [1, 3, 2, 0, 3]
+	expected = square.iloc[rows, columns].values
+	assert small_cache.get_block(rows, columns).tolist() == expected.tolist()
+
+	small_cache.update({('1', '5'): 0.4})
+	# Pairs without a value are 0, as in `squareform`.
+	assert small_cache.get_block([4], [0, 1, 4]).tolist() == [[0.4, 0, 0]]
+
+
+def test_replace_missing(small_cache, tmp_path):
+	small_cache.update({('1', '2'): numpy.nan})
+	small_cache.replace_missing()
+	assert small_cache['1', '2'] == .8
+
+	# The pair keeps track of being missing, so it is updated when the maximum distance changes.
+	filename = tmp_path / "distances.npz"
+	small_cache.save_binary(filename)
+	result = DistanceCache.read_binary(filename, {})
+	result.reduce(['1', '2', '4'])
+	result.add_labels(['0'])
+	result.set_pairs([0, 0, 0], [1, 2, 3], [.9, .1, .1])
+	result.replace_missing()
+	assert result['1', '2'] == .9
+	assert result['2', '4'] == .3
+
+	# Pairs which are assigned a value are no longer missing.
+	result.set_group(['1', '2'], 0)
+	result.replace_missing()
+	assert result['1', '2'] == 0
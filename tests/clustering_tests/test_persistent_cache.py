@@ -0,0 +1,54 @@
+import json
+
+import numpy
+import pandas
+import pytest
+
+from muller import dataio
+from muller.clustering.metrics import DistanceEngine, PersistentDistanceCache
+from tests import filenames
+
+
+@pytest.fixture
+def b1_data() -> pandas.DataFrame:
+	f = filenames.real_tables["B1"]
+	t = dataio.import_table(f, sheet_name = 'trajectory', index = 'Trajectory')
+	t.index = [str(i) for i in t.index]
+	return t
+
+
+def test_cache_reuses_pairs(b1_data, tmp_path):
+	_, expected = DistanceEngine(0.03, 0.97, 'binomial').run(b1_data)
+	total = len(expected)
+
+	cache = PersistentDistanceCache(tmp_path, chunk_size = 50)
+	_, result = DistanceEngine(0.03, 0.97, 'binomial').run(b1_data, cache = cache)
+	assert numpy.array_equal(result, expected)
+	assert cache.statistics['hits'] == 0
+	assert cache.statistics['misses'] == total
+
+	# Reversing the table should not change the pair keys.
+	cache = PersistentDistanceCache(tmp_path)
+	reversed_data = b1_data.iloc[::-1]
+	_, expected_reversed = DistanceEngine(0.03, 0.97, 'binomial').run(reversed_data)
+	_, result = DistanceEngine(0.03, 0.97, 'binomial').run(reversed_data, cache = cache)
+	assert numpy.array_equal(result, expected_reversed)
+	assert cache.statistics['hits'] == total
+
+	# The pairs are keyed by the metric as well.
+	cache = PersistentDistanceCache(tmp_path)
+	DistanceEngine(0.03, 0.97, 'pearson').run(b1_data, cache = cache)
+	assert cache.statistics['hits'] == 0
+
+	cache.save_statistics(tmp_path / "statistics.json")
+	statistics = json.loads((tmp_path / "statistics.json").read_text())
+	assert statistics['misses'] == total
+	assert statistics['size'] == len(cache)
+
+
+def test_cache_eviction(b1_data, tmp_path):
+	cache = PersistentDistanceCache(tmp_path, maximum_size = 100)
+	DistanceEngine(0.03, 0.97, 'binomial').run(b1_data, cache = cache)
+
+	assert len(cache) == 100
+	assert cache.statistics['evicted'] > 0
@@ -0,0 +1,93 @@
+import numpy
+import pytest
+from scipy.cluster import hierarchy as scipy_hierarchy
+
+from muller.clustering import hierarchy, sparse_graph
+from muller.clustering.metrics import DistanceCache
+
+
+@pytest.fixture
+def distances() -> numpy.ndarray:
+	generator = numpy.random.default_rng(11)
+	# Rounded so some of the distances are tied.
+	return numpy.round(generator.random(60 * 59 // 2), 3)
+
+
+@pytest.fixture
+def labels():
+	return [f"trajectory-{i:02d}" for i in range(60)]
+
+
+def get_graph(labels, distances, bound) -> sparse_graph.DistanceGraph:
+	return sparse_graph.DistanceGraph(labels, bound).add_blocks([(0, distances[:700]), (700, distances[700:])])
+
+
+def test_add_blocks(labels, distances):
+	graph = get_graph(labels, distances, 0.2)
+	assert graph.positions.tolist() == numpy.flatnonzero(distances <= 0.2).tolist()
+	assert graph.values.tolist() == distances[distances <= 0.2].tolist()
+	assert graph.maximum == distances.max()
+
+
+@pytest.mark.parametrize("quantile", [0.01, 0.05, 0.1])
+def test_calculate_cutoff_quantile(labels, distances, quantile):
+	graph = get_graph(labels, distances, 0.2)
+	assert graph.calculate_cutoff_quantile(quantile) == hierarchy.calculate_cutoff_quantile(quantile, distances)
+	# The order statistics are outside the bound.
+	assert graph.calculate_cutoff_quantile(0.5) is None
+
+
+@pytest.mark.parametrize("method", ['components', 'single'])
+@pytest.mark.parametrize("cutoff", [0.01, 0.05, 0.15])
+def test_single_linkage_clusters(labels, distances, method, cutoff):
+	graph = get_graph(labels, distances, 0.2)
+	clusterer = sparse_graph.SparseGraphCluster(method)
+	Z = clusterer.link_clusters(graph)
+	clusters = clusterer.cluster_components(graph, cutoff) if Z is None else sparse_graph.cut_linkage(Z, len(labels), cutoff)
+
+	expected = scipy_hierarchy.fcluster(scipy_hierarchy.linkage(distances, 'single'), t = cutoff, criterion = 'distance')
+	label_clusters = hierarchy.HierarchalCluster._label_clusters
+	assert label_clusters(clusters, labels) == label_clusters(expected, labels)
+
+
+def test_link_single(labels, distances):
+	Z = sparse_graph.SparseGraphCluster.link_single(get_graph(labels, distances, 1))
+	expected = scipy_hierarchy.linkage(distances, 'single')
+	# Tied merges may be in a different order, but the heights are the same.
+	assert Z[:, 2].tolist() == expected[:, 2].tolist()
+
+
+def test_link_average():
+	# The distances between (a, b, c) and d, where (c, d) is outside the bound.
+	cache = DistanceCache({('a', 'b'): 0.1, ('a', 'c'): 0.2, ('b', 'c'): 0.3, ('a', 'd'): 0.4, ('b', 'd'): 0.5, ('c', 'd'): 0.9})
+	graph = sparse_graph.DistanceGraph.from_distance_cache(cache, 0.6)
+	Z = sparse_graph.SparseGraphCluster.link_average(graph)
+
+	assert Z[:, :2].tolist() == [[0, 1], [2, 4], [3, 5]]
+	assert Z[:, 2].tolist() == pytest.approx([0.1, 0.25, (0.4 + 0.5 + 0.6) / 3])
+	assert Z[:, 3].tolist() == [2, 3, 4]
+
+
+def test_average_is_partial():
+	cache = DistanceCache({('a', 'b'): 0.1, ('a', 'c'): 0.9, ('b', 'c'): 0.9})
+	graph = sparse_graph.DistanceGraph.from_distance_cache(cache, 0.5)
+	result = sparse_graph.SparseGraphCluster('average').run(graph, similarity_cutoff = 0.5)
+	assert result.table_linkage['left'].tolist() == [0]
+	assert sorted(result.clusters) == [['a', 'b'], ['c']]
+
+
+def test_set_group(labels, distances):
+	graph = get_graph(labels, distances, 0.2)
+	group = ['trajectory-01', 'trajectory-05', 'trajectory-40']
+	cache = DistanceCache.from_condensed(labels, distances.copy())
+
+	assert graph.set_group(group + ['trajectory-99'], 0) == ['trajectory-99']
+	cache.set_group(group, 0)
+	assert graph.positions.tolist() == numpy.flatnonzero(cache.triangle() <= 0.2).tolist()
+	assert graph.values.tolist() == cache.triangle()[cache.triangle() <= 0.2].tolist()
+	assert graph.calculate_cutoff_quantile(0.05) == hierarchy.calculate_cutoff_quantile(0.05, cache.triangle())
+
+
+def test_invalid_method():
+	with pytest.raises(ValueError):
+		sparse_graph.SparseGraphCluster('ward')
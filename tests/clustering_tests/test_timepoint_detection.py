@@ -1,3 +1,4 @@
+import numpy
 import pandas
 import pytest
 
@@ -119,3 +120,11 @@ def test_get_first_significant_timepoint(transposed_genotypes, transposed_mouse_
 	mouse_result = timepoint_detection.get_first_significant_timepoint(transposed_mouse_genotypes, 0.15)
 
 	assert expected_mouse == mouse_result.to_dict()
+
+
+def test_get_crossings():
+	values = numpy.array([[0, 0.2, 0.6, 1.0], [0.5, 0.5, 0.1, numpy.nan], [0, 0, 0, 0]])
+	first, last = timepoint_detection.get_crossings(values, [0.4, 0.9])
+	numpy.testing.assert_array_equal(first, [[2, 0, numpy.nan], [3, numpy.nan, numpy.nan]])
+	numpy.testing.assert_array_equal(last, [[3, 1, numpy.nan], [3, numpy.nan, numpy.nan]])
+	assert timepoint_detection.to_positions(first[1]).tolist() == [3, 0, 0]
@@ -0,0 +1,64 @@
+import itertools
+
+import numpy
+import pandas
+import pytest
+
+from muller import dataio, widgets
+from muller.clustering.metrics import distance_calculator
+from muller.clustering.metrics.trajectory_features import CATEGORY_NAMES, TrajectoryFeatures
+from tests import filenames
+
+
+def load_table(filename) -> pandas.DataFrame:
+	table = dataio.import_table(filename, sheet_name = 'trajectory', index = 'Trajectory')
+	table.index = [str(i) for i in table.index]
+	return table[widgets.get_numeric_columns(table.columns)].astype(float)
+
+
+@pytest.mark.parametrize("filename", [filenames.real_tables['B1'], filenames.model_tables['model.clonalinterferance']])
+def test_features_match_pairwise_functions(filename):
+	table = load_table(filename)
+	features = TrajectoryFeatures(0.03, 0.97).load(table)
+
+	pairs = list(itertools.combinations(range(len(table)), 2))
+	left = numpy.array([i for i, _ in pairs])
+	right = numpy.array([j for _, j in pairs])
+	categories = features.categorize(left, right)
+	starts, stops = features.get_window_bounds(left, right, categories)
+
+	for i, j, category, start, stop in zip(left, right, categories, starts, stops):
+		left_trajectory = table.iloc[i]
+		right_trajectory = table.iloc[j]
+		expected_category = distance_calculator.get_pair_category(left_trajectory, right_trajectory, 0.03, 0.97)
+		assert CATEGORY_NAMES[category] == expected_category
+
+		left_reduced, _ = distance_calculator.filter_timepoints(left_trajectory, right_trajectory, 0.03, 0.97)
+		if left_reduced is None:
+			assert features.get_pair_window(table.index[i], table.index[j]) is None
+		else:
+			assert list(left_trajectory.iloc[start:stop].index) == list(left_reduced.index)
+
+
+def test_features_unsorted_timepoints():
+	table = pandas.DataFrame(
+		[
+			[0.00, 0.20, 0.00, 0.50, 0.00],
+			[0.00, 0.00, 0.00, 0.00, 0.00],
+			[1.00, 0.40, 0.00, 0.00, 1.00]
+		],
+		columns = [0, 10, 5, 20, 15]
+	)
+	features = TrajectoryFeatures(0.03, 0.97).load(table)
+
+	# The values are timepoint ranks. The first trajectory is detected at timepoints 10 (rank 2) and 20 (rank 4).
+	assert features.first_detected.tolist() == [2, 5, 0]
+	assert features.last_detected.tolist() == [4, -1, 3]
+	assert features.first_fixed.tolist() == [5, 5, 0]
+
+	category = features.categorize(numpy.array([0, 0]), numpy.array([1, 2]))
+	assert [CATEGORY_NAMES[i] for i in category] == ['notFixed', 'oneFixed']
+
+	start, stop = features.get_window_bounds(numpy.array([0, 0]), numpy.array([1, 2]), category)
+	assert start.tolist() == [1, 0]
+	assert stop.tolist() == [4, 4]
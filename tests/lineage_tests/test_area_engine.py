@@ -0,0 +1,105 @@
+import itertools
+
+import numpy
+import pandas
+import pytest
+
+from muller import dataio, widgets
+from muller.clustering.metrics import DistanceEngine
+from muller.inheritance import area_engine, areascore, polygon, scoring
+from tests import filenames
+
+
+def load_table(filename) -> pandas.DataFrame:
+	table = dataio.import_table(filename, sheet_name = 'trajectory', index = 'Trajectory')
+	table.index = [str(i) for i in table.index]
+	return table[widgets.get_numeric_columns(table.columns)].astype(float)
+
+
+@pytest.fixture
+def trajectory_table() -> pandas.DataFrame:
+	filename_table = filenames.fake_tables['generic.model.area']
+	return dataio.import_table(filename_table, sheet_name = "data", index = 'Trajectory')
+
+
+def _get_shapely_areas(left: pandas.Series, right: pandas.Series):
+	left_polygon = polygon.as_polygon(left)
+	right_polygon = polygon.as_polygon(right)
+	return [
+		left_polygon.area,
+		right_polygon.area,
+		left_polygon.intersection(right_polygon).area,
+		left_polygon.union(right_polygon).area,
+		left_polygon.difference(right_polygon).area,
+		right_polygon.difference(left_polygon).area
+	]
+
+
+def _as_list(areas: area_engine.PairAreas):
+	return [areas.left, areas.right, areas.intersection, areas.union, areas.difference_left, areas.difference_right]
+
+
+def test_area_of_series(trajectory_table):
+	result = area_engine.calculate_area(trajectory_table.values)
+	expected = [areascore.area_of_series(row) for _, row in trajectory_table.iterrows()]
+	assert result.tolist() == pytest.approx(expected)
+
+
+@pytest.mark.parametrize(
+	"left, right",
+	[
+		([0, .2, .4, .2, 0], [0, .4, .2, .4, 0]),
+		([1, .5, 0, 0, .5], [0, 0, .5, 1, 1]),
+		([0, 0, 0, 0, 0], [0, .1, 0, .1, 0]),
+		([.3, .3, .3], [.3, .3, .3])
+	]
+)
+def test_calculate_areas_crossing(left, right):
+	left = pandas.Series(left)
+	right = pandas.Series(right)
+	result = area_engine.calculate_series_areas(left, right)
+	assert _as_list(result) == pytest.approx(_get_shapely_areas(left, right))
+
+
+@pytest.mark.parametrize("filename", [filenames.real_tables['B1'], filenames.model_tables['model.clonalinterferance']])
+def test_calculate_areas_matches_shapely(filename):
+	data = load_table(filename)
+	pairs = list(itertools.combinations(data.index, 2))
+	left = data.loc[[i for i, _ in pairs]].values
+	right = data.loc[[j for _, j in pairs]].values
+	result = numpy.array(_as_list(area_engine.calculate_areas(left, right))).T
+
+	expected = numpy.array([_get_shapely_areas(data.loc[i], data.loc[j]) for i, j in pairs])
+	assert numpy.allclose(result, expected)
+
+
+def test_calculate_areas_window():
+	values = numpy.array([[0, .5, 0, .2, .8, 0]] * 2)
+	window = numpy.array([
+		[True] * 6,
+		[False, False, True, True, True, False]
+	])
+	result = area_engine.calculate_area(values, window)
+	# The start of the second window is not raised to the minimum value since it is the first point of that polygon.
+	assert result.tolist() == pytest.approx([areascore.area_of_series(pandas.Series(values[0])), areascore.area_of_series(pandas.Series([0, .2, .8]))])
+
+
+@pytest.mark.parametrize("filename", [filenames.real_tables['B1'], filenames.model_tables['model.clonalinterferance']])
+def test_jaccard_metric_matches_shapely(filename):
+	data = load_table(filename)
+	_, expected = DistanceEngine(0.03, 0.97, 'jaccard', area_backend = 'shapely').run(data)
+	_, result = DistanceEngine(0.03, 0.97, 'jaccard').run(data)
+
+	assert len(result) == len(expected)
+	assert numpy.allclose(result, expected)
+
+
+def test_score_area_backends_match():
+	data = load_table(filenames.model_tables['model.clonalinterferance'])
+	numeric = scoring.Score(0.03, 0.97, 0.05)
+	shapely = scoring.Score(0.03, 0.97, 0.05, area_backend = 'shapely')
+	for left, right in itertools.permutations(data.index[:12], 2):
+		assert numeric.calculate_score_area(data.loc[left], data.loc[right]) == shapely.calculate_score_area(data.loc[left], data.loc[right])
+
+	with pytest.raises(ValueError):
+		scoring.Score(0.03, 0.97, 0.05, area_backend = 'polygon')
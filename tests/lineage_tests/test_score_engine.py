@@ -0,0 +1,64 @@
+import math
+
+import numpy
+import pandas
+import pytest
+
+from muller.inheritance import scoring
+from muller.inheritance.genotype_lineage import LineageWorkflow
+from muller.inheritance.score_engine import ScoreEngine, isclose
+from tests import filenames
+
+
+def _score_pairs(scorer: scoring.Score, table: pandas.DataFrame):
+	records = list()
+	for position in range(1, len(table)):
+		unnested = table.iloc[position]
+		for _, nested in table.iloc[:position].iloc[::-1].iterrows():
+			records.append(scorer.score_pair(nested, unnested))
+	return records
+
+
+@pytest.mark.parametrize("weights", [(1, 1, 2, 2), (1, 1, 1, 1)])
+def test_score_engine_matches_score_pair(weights):
+	table = pandas.read_excel(filenames.real_tables['nature12344'], sheet_name = 'genotype').set_index('Genotype')
+	scorer = scoring.Score(0.03, 0.97, 0.05, weights)
+	engine = ScoreEngine(scorer).load(table)
+
+	expected = _score_pairs(scorer, table)
+	result = [record for position in range(1, len(table)) for record in engine.score_genotype(position)]
+
+	assert result == expected
+	# The types should also match so the score tables are identical.
+	assert pandas.DataFrame(result).equals(pandas.DataFrame(expected))
+
+
+def test_score_engine_missing_values():
+	values = numpy.array([
+		[0, 0.2, 0.5, 0.9, 1.0, 1.0],
+		[0, 0.1, numpy.nan, 0.4, 0.6, 0.8],
+		[0, 0, 0.1, numpy.nan, 0.3, 0.5],
+		[0, 0, 0, 0.2, 0.1, 0]
+	])
+	table = pandas.DataFrame(values, index = ['A', 'B', 'C', 'D'], columns = [0, 1, 2, 3, 5, 8])
+	scorer = scoring.Score(0.03, 0.97, 0.05)
+	engine = ScoreEngine(scorer).load(table)
+
+	result = [record for position in range(1, len(table)) for record in engine.score_genotype(position)]
+	assert result == _score_pairs(scorer, table)
+
+
+def test_isclose():
+	left = numpy.array([1.0, 1.0, 0.0, math.inf, math.inf, math.nan, 0.5])
+	right = numpy.array([1.0 + 1E-10, 1.1, 0.05, math.inf, 1.0, math.nan, 0.45])
+	expected = [math.isclose(i, j, abs_tol = 0.1) for i, j in zip(left, right)]
+	assert isclose(left, right, abs_tol = 0.1).tolist() == expected
+
+
+def test_lineage_threaded_is_deterministic():
+	table = pandas.read_excel(filenames.real_tables['nature12344'], sheet_name = 'genotype').set_index('Genotype')
+	expected = LineageWorkflow(0.03, 0.97, 0.05).run(table)
+	result = LineageWorkflow(0.03, 0.97, 0.05, threads = 2).run(table)
+
+	assert result.table_scores.equals(expected.table_scores)
+	assert result.table_edges.equals(expected.table_edges)
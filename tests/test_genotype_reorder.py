@@ -47,3 +47,14 @@ def test_model_tables_are_sorted_correctly(sorter, filename):
 def test_real_tables_are_sorted_correctly(sorter, filename):
 	result, expected_table = helper_for_testing_tables(sorter, filename)
 	pandas.testing.assert_frame_equal(result, expected_table)
+
+
+def test_tied_genotypes_keep_their_order(sorter):
+	table = pandas.DataFrame(
+		[[0, 0.5, 1.0], [0, 0.2, 0.3], [0, 0.5, 1.0], [0, 0, 0]],
+		index = ['genotype-1', 'genotype-2', 'genotype-3', 'genotype-4'],
+		columns = [0, 10, 20]
+	)
+	result = sorter.run(table)
+	# genotype-4 is never detected, so it is not sorted under any breakpoint.
+	assert result.index.tolist() == ['genotype-1', 'genotype-3', 'genotype-2']